@@ -0,0 +1,93 @@
+"""
+The storages that can be selected in tag_storage_settings, by name. Each one is the path of its TagStorageSettings,
+which imports the storage, so only the selected one is imported: a worker of the pickle storage doesn't load the
+neo4j drivers. Other packages add storages with an entry point in the tagapi.storage_backends group, named as the
+backend and pointing to their settings class, e.g. `redis = tagapi_redis.settings:RedisSettings`.
+"""
+from __future__ import annotations
+
+import dataclasses
+import importlib
+import sys
+from typing import Any, Dict, Mapping, Optional, Type
+
+from pydantic import BaseModel
+
+from tag_storage.base_storage.tag_storage import TagStorage
+
+ENTRY_POINT_GROUP = "tagapi.storage_backends"
+BACKEND_KEY = "backend"  # in tag_storage_settings, the name of the storage
+
+
+class TagStorageSettings(BaseModel):
+
+    def get_storage(self) -> TagStorage:
+        raise NotImplementedError()
+
+
+class UnknownStorageBackend(ValueError):
+    """No backend has the name, or tag_storage_settings doesn't say which one it is"""
+
+
+@dataclasses.dataclass
+class StorageBackend:
+    name: str
+    settings: str  # module:class of its TagStorageSettings
+    key: Optional[str] = None  # a setting only it has, that selects it when the backend is not named
+
+    def settings_class(self) -> Type[TagStorageSettings]:
+        module, _, attribute = self.settings.partition(":")
+        return getattr(importlib.import_module(module), attribute)
+
+
+BACKENDS: Dict[str, StorageBackend] = {}
+
+
+def register_backend(name: str, settings: str, key: Optional[str] = None):
+    BACKENDS[name] = StorageBackend(name, settings, key)
+
+
+register_backend("pickle", "app.backends.pickle_db_settings:PickleDbSettings", "pickledb_path")
+register_backend("py2neo", "app.backends.py2neo_settings:Py2NeoSettings", "py2neo_url")
+register_backend("neo4j", "app.backends.neo4j_settings:Neo4jSettings", "neo4j_url")
+register_backend("sqlite", "app.backends.sqlite_settings:SqliteSettings", "sqlite_path")
+
+
+def _entry_points():
+    from importlib import metadata
+    if sys.version_info >= (3, 10):
+        return metadata.entry_points(group=ENTRY_POINT_GROUP)
+    return metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+
+
+def get_backend(name: str) -> StorageBackend:
+    # The entry points are only looked up for names that are not registered
+    if name not in BACKENDS:
+        for entry_point in _entry_points():
+            if entry_point.name == name:
+                register_backend(name, entry_point.value)
+                break
+        else:
+            raise UnknownStorageBackend(f"There is no storage backend {name}, the known ones are "
+                                        f"{', '.join(BACKENDS)} and the entry points of {ENTRY_POINT_GROUP}")
+    return BACKENDS[name]
+
+
+def find_backend(settings: Mapping[str, Any]) -> StorageBackend:
+    for backend in BACKENDS.values():
+        if backend.key is not None and backend.key in settings:
+            return backend
+    keys = ", ".join(backend.key for backend in BACKENDS.values() if backend.key is not None)
+    raise UnknownStorageBackend(f"The storage settings need a {BACKEND_KEY} or one of {keys}")
+
+
+def parse_storage_settings(settings: Any) -> TagStorageSettings:
+    """The settings of the backend named in settings, or of the first one whose key is in them"""
+    if isinstance(settings, TagStorageSettings):
+        return settings
+    if not isinstance(settings, Mapping):
+        raise TypeError("The storage settings must be an object")
+    settings = dict(settings)
+    name = settings.pop(BACKEND_KEY, None)
+    backend = get_backend(name) if name is not None else find_backend(settings)
+    return backend.settings_class().parse_obj(settings)
@@ -0,0 +1,22 @@
+from typing import Optional
+
+from app.backends import TagStorageSettings
+from tag_storage.neo4j_storage.neo4j_storage import Neo4jStorageConfig, Neo4jStorage
+
+
+class Neo4jSettings(TagStorageSettings):
+    neo4j_url: str
+    neo4j_username: Optional[str] = None
+    neo4j_password: Optional[str] = None
+    neo4j_database: Optional[str] = None
+    neo4j_max_connection_pool_size: int = 100
+    neo4j_connection_acquisition_timeout: float = 60.0
+    neo4j_max_connection_lifetime: float = 3600.0
+
+    def get_storage(self):
+        config = Neo4jStorageConfig(url=self.neo4j_url, username=self.neo4j_username, password=self.neo4j_password,
+                                    database=self.neo4j_database,
+                                    max_connection_pool_size=self.neo4j_max_connection_pool_size,
+                                    connection_acquisition_timeout=self.neo4j_connection_acquisition_timeout,
+                                    max_connection_lifetime=self.neo4j_max_connection_lifetime)
+        return Neo4jStorage(config)
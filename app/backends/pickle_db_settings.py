@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import datetime
+from typing import Optional
+
+from app.backends import TagStorageSettings
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorageConfiguration, PickledSetTagStorage, \
+    SnapshotMode
+from tag_storage.pickle_storage.pickle_storage_group_commit_synchronizer import Durability, \
+    PickledSetTagStorageGroupCommitSynchronizer, PickledSetTagStorageGroupCommitSynchronizerConfiguration
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration
+from tag_storage.pickle_storage.pickle_storage_periodic_synchronizer import \
+    PickledSetTagStoragePeriodicSynchronizer, PickledSetTagStoragePeriodicSynchronizerConfiguration
+from tag_storage.pickle_storage.pickle_storage_synchronizer import PickledSetTagStorageSynchronizer
+from tag_storage.pickle_storage.pickle_storage_workers import PickledSetTagStorageWorkersConfiguration, \
+    SharedPickledSetTagStorage
+from tag_storage.pickle_storage.tag_cooccurrence import TagCooccurrenceConfiguration
+
+
+class PickleDbSettings(TagStorageSettings):
+    pickledb_path: str
+    pickledb_journal: bool = False
+    pickledb_journal_checkpoint_bytes: int = 64 * 1024 * 1024
+    pickledb_snapshot_mode: Optional[SnapshotMode] = None
+    pickledb_compact: bool = False
+    pickledb_mapped: bool = False
+    pickledb_remove_chunk_size: int = 1000
+    pickledb_durability: Durability = Durability.ASYNC
+    pickledb_sync_interval_seconds: float = 1.0  # async
+    pickledb_flush_max_changes: int = 1000  # adaptive
+    pickledb_flush_max_delay_ms: Optional[float] = None  # 0 for group_commit and 10 for adaptive when None
+    pickledb_fsync: bool = True  # group_commit and adaptive
+    # Share the storage among the processes of `uvicorn --workers N`, see SharedPickledSetTagStorage
+    pickledb_workers: bool = False
+    pickledb_workers_refresh_seconds: float = 1.0
+    pickledb_workers_socket_path: Optional[str] = None
+    # Keep the counts of the tags used together for /tags/{tag}/related, see TagCooccurrence
+    pickledb_cooccurrence: bool = False
+    pickledb_cooccurrence_max_exact: int = 10000
+    pickledb_cooccurrence_sketch_size: int = 1000
+
+    def get_storage(self):
+        config = PickledSetTagStorageConfiguration(path=self.pickledb_path, compact=self.pickledb_compact,
+                                                   synchronizer=self.get_synchronizer(),
+                                                   mapped=self.pickledb_mapped,
+                                                   remove_chunk_size=self.pickledb_remove_chunk_size)
+        if self.pickledb_snapshot_mode is not None:
+            config.snapshot_mode = self.pickledb_snapshot_mode
+        if self.pickledb_journal:
+            config.journal = PickledSetTagStorageJournalConfiguration(
+                checkpoint_bytes=self.pickledb_journal_checkpoint_bytes)
+        if self.pickledb_cooccurrence:
+            config.cooccurrence = TagCooccurrenceConfiguration(max_exact=self.pickledb_cooccurrence_max_exact,
+                                                               sketch_size=self.pickledb_cooccurrence_sketch_size)
+        if self.pickledb_workers:
+            workers_config = PickledSetTagStorageWorkersConfiguration(
+                socket_path=self.pickledb_workers_socket_path,
+                refresh_interval=datetime.timedelta(seconds=self.pickledb_workers_refresh_seconds))
+            return SharedPickledSetTagStorage(config, workers_config)
+        storage = PickledSetTagStorage(config)
+        return storage
+
+    def get_synchronizer(self) -> PickledSetTagStorageSynchronizer:
+        if self.pickledb_durability == Durability.ASYNC:
+            return PickledSetTagStoragePeriodicSynchronizer(PickledSetTagStoragePeriodicSynchronizerConfiguration(
+                interval=datetime.timedelta(seconds=self.pickledb_sync_interval_seconds)))
+        max_delay_ms = self.pickledb_flush_max_delay_ms
+        if max_delay_ms is None:
+            max_delay_ms = 0 if self.pickledb_durability == Durability.GROUP_COMMIT else 10
+        return PickledSetTagStorageGroupCommitSynchronizer(PickledSetTagStorageGroupCommitSynchronizerConfiguration(
+            wait=self.pickledb_durability == Durability.GROUP_COMMIT, max_changes=self.pickledb_flush_max_changes,
+            max_delay=datetime.timedelta(milliseconds=max_delay_ms), fsync=self.pickledb_fsync))
@@ -0,0 +1,14 @@
+from typing import Optional
+
+from app.backends import TagStorageSettings
+from tag_storage.py2neo_storage.py2neo_storage import Py2NeoStorageConfig, Py2NeoStorage
+
+
+class Py2NeoSettings(TagStorageSettings):
+    py2neo_url: str
+    py2neo_username: Optional[str] = None
+    py2neo_password: Optional[str] = None
+
+    def get_storage(self):
+        config = Py2NeoStorageConfig(url=self.py2neo_url, username=self.py2neo_username, password=self.py2neo_password)
+        return Py2NeoStorage(config)
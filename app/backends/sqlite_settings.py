@@ -0,0 +1,14 @@
+from app.backends import TagStorageSettings
+from tag_storage.sqlite_storage.sqlite_storage import SqliteStorageConfig, SqliteStorage
+
+
+class SqliteSettings(TagStorageSettings):
+    sqlite_path: str
+    sqlite_max_workers: int = 8
+    sqlite_busy_timeout: float = 5.0
+    sqlite_synchronous: str = 'NORMAL'
+
+    def get_storage(self):
+        config = SqliteStorageConfig(path=self.sqlite_path, max_workers=self.sqlite_max_workers,
+                                     busy_timeout=self.sqlite_busy_timeout, synchronous=self.sqlite_synchronous)
+        return SqliteStorage(config)
@@ -0,0 +1,142 @@
+"""
+The writes made through the api as they are applied, in GET /changes as Server-Sent Events and in /changes/ws over a
+WebSocket, when a ChangeFeed is given to create_app. Each event carries the epoch and sequence of the change, a
+client that reconnects sends back the last one it got and gets what it missed while the feed still has it.
+"""
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import FastAPI, Header, Query, WebSocket
+from fastapi.responses import StreamingResponse
+from starlette.websockets import WebSocketDisconnect
+
+from app.responses import dump_json
+from tag_storage.base_storage.change_feed import ChangeEvent, ChangeFeed, ChangesLost, Subscription, \
+    SubscriberTooSlow
+from tag_storage.base_storage.tag_storage import TagStorage
+
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+KEEPALIVE_SECONDS = 15.0  # so proxies don't close an idle stream
+WS_CLOSE_TOO_SLOW = 1013  # try again later, from the last change received
+
+AFTER_QUERY = Query(None, description="Only the changes after this sequence. Last-Event-ID overrides it")
+EPOCH_QUERY = Query(None, description="Epoch of the sequence in after, changes of another one can't be resumed")
+TAG_QUERY = Query([], alias="tag", description="Only the changes of these tags")
+OBJECT_QUERY = Query([], alias="object", description="Only the changes of these objects")
+
+
+def _event_id(epoch: str, sequence: int) -> str:
+    return f"{epoch}-{sequence}"
+
+
+def _resume_from(after: Optional[int], epoch: Optional[str],
+                 last_event_id: Optional[str]) -> Tuple[Optional[int], Optional[str]]:
+    # The id of an event is epoch-sequence, as the EventSource of the browsers sends it back
+    if last_event_id:
+        epoch, _, sequence = last_event_id.rpartition("-")
+        try:
+            return int(sequence), epoch or None
+        except ValueError:
+            return None, None
+    return after, epoch
+
+
+def _subscribe(feed: ChangeFeed, after: Optional[int], epoch: Optional[str], tags: List[str],
+               objects: List[str]) -> Tuple[Subscription, Optional[dict]]:
+    # The changes asked for, or those from now on and a reset for the client to read everything again
+    try:
+        return feed.subscribe(after, epoch, tags, objects), None
+    except ChangesLost as e:
+        subscription = feed.subscribe(tags=tags, objects=objects)
+        return subscription, {"event": "reset", "epoch": feed.epoch, "sequence": feed.sequence, "detail": str(e)}
+
+
+async def _next(subscription: Subscription) -> Optional[ChangeEvent]:
+    # None when nothing changed for KEEPALIVE_SECONDS
+    try:
+        return await asyncio.wait_for(subscription.__anext__(), KEEPALIVE_SECONDS)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def _close_on_disconnect(websocket: WebSocket, subscription: Subscription):
+    # What the client sends is ignored, the subscription ends when it disconnects
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        subscription.close()
+
+
+def _text(data: dict) -> str:
+    return dump_json(data).decode("utf-8")
+
+
+def _server_sent_event(data: dict, event_id: Optional[str] = None, event: Optional[str] = None) -> bytes:
+    lines = ([f"event: {event}"] if event else []) + ([f"id: {event_id}"] if event_id else [])
+    return ("\n".join(lines + ["data: "]).encode("utf-8") + dump_json(data) + b"\n\n")
+
+
+async def _server_sent_events(subscription: Subscription, reset: Optional[dict]) -> AsyncIterator[bytes]:
+    try:
+        if reset is not None:
+            yield _server_sent_event(reset, _event_id(reset["epoch"], reset["sequence"]), "reset")
+        while True:
+            try:
+                change = await _next(subscription)
+            except StopAsyncIteration:
+                return
+            except SubscriberTooSlow as e:
+                yield _server_sent_event({"event": "overflow", "detail": str(e)}, event="overflow")
+                return
+            if change is None:
+                yield b": keepalive\n\n"
+                continue
+            yield _server_sent_event(dataclasses.asdict(change), _event_id(change.epoch, change.sequence))
+    finally:
+        subscription.close()
+
+
+def add_change_feed(app: FastAPI, tag_storage: TagStorage, feed: ChangeFeed):
+    tag_storage.watch_changes(feed)
+
+    @app.get("/changes", response_class=StreamingResponse, tags=["Changes"],
+             responses={200: {"content": {EVENT_STREAM_MEDIA_TYPE: {}}}})
+    async def get_changes(after: Optional[int] = AFTER_QUERY, epoch: Optional[str] = EPOCH_QUERY,
+                          tags: List[str] = TAG_QUERY, objects: List[str] = OBJECT_QUERY,
+                          last_event_id: Optional[str] = Header(None)):
+        subscription, reset = _subscribe(feed, *_resume_from(after, epoch, last_event_id), tags, objects)
+        return StreamingResponse(_server_sent_events(subscription, reset), media_type=EVENT_STREAM_MEDIA_TYPE,
+                                 headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
+
+    @app.websocket("/changes/ws")
+    async def watch_changes(websocket: WebSocket, after: Optional[int] = AFTER_QUERY,
+                            epoch: Optional[str] = EPOCH_QUERY, tags: List[str] = TAG_QUERY,
+                            objects: List[str] = OBJECT_QUERY):
+        await websocket.accept()
+        subscription, reset = _subscribe(feed, after, epoch, tags, objects)
+        disconnected = asyncio.create_task(_close_on_disconnect(websocket, subscription))
+        try:
+            if reset is not None:
+                await websocket.send_text(_text(reset))
+            while True:
+                try:
+                    change = await _next(subscription)
+                except StopAsyncIteration:
+                    return  # the client is gone
+                except SubscriberTooSlow as e:
+                    await websocket.send_text(_text({"event": "overflow", "detail": str(e)}))
+                    await websocket.close(WS_CLOSE_TOO_SLOW)
+                    return
+                if change is None:
+                    await websocket.send_text(_text({"event": "keepalive"}))
+                    continue
+                await websocket.send_text(_text(dict(dataclasses.asdict(change), event="change")))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            disconnected.cancel()
+            subscription.close()
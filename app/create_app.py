@@ -1,53 +1,161 @@
-from typing import List, cast, Dict
+import dataclasses
+from typing import List, cast, Dict, Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from app.change_feed import add_change_feed
+from app.export_import import NDJSON_MEDIA_TYPE, ImportResult, export_lines, import_batches, sync_export_lines
+from app.metrics import MetricsMiddleware, MetricsRegistry, PROMETHEUS_MEDIA_TYPE
+from app.responses import ListingResponses
 
 from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult
+from tag_storage.base_storage.change_feed import ChangeFeed
 from tag_storage.base_storage.sync_tag_storage import SyncTagStorage
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
 from tag_storage.base_storage.tag_storage import TagStorage
 
+ALL_TAGS_QUERY = Query([], alias="all", description="Only objects with all these tags")
+ANY_TAGS_QUERY = Query([], alias="any", description="Only objects with at least one of these tags")
+NONE_TAGS_QUERY = Query([], alias="none", description="Only objects with none of these tags")
+AFTER_QUERY = Query(None, description="Keyset cursor, only names after it are listed. Use the X-Next-Cursor header "
+                                      "of the previous page")
+PREFIX_QUERY = Query(None, description="Only names starting with it")
+START_QUERY = Query(None, description="Only names greater than or equal to it")
+END_QUERY = Query(None, description="Only names less than it")
+
+
+@dataclasses.dataclass
+class BatchGet:
+    keys: List[str]
+    limit: int = 100  # names listed for each key
+
 
-def create_app(tag_storage: TagStorage, app_name: str = 'Tagapi'):
+def create_app(tag_storage: TagStorage, app_name: str = 'Tagapi', metrics: Optional[MetricsRegistry] = None,
+               fast_responses: bool = False, change_feed: Optional[ChangeFeed] = None):
     app = FastAPI(name=app_name, title=app_name)
+    listings = ListingResponses(fast_responses)
+    if metrics is not None:
+        add_metrics(app, tag_storage, metrics)
+    if change_feed is not None:
+        add_change_feed(app, tag_storage, change_feed)
 
     if isinstance(tag_storage, AsyncTagStorage):
-        create_async_app(app, cast(AsyncTagStorage, tag_storage))
+        create_async_app(app, cast(AsyncTagStorage, tag_storage), listings)
     elif isinstance(tag_storage, TagStorage):
-        create_sync_app(app, tag_storage)
+        create_sync_app(app, tag_storage, listings)
     else:
         raise ValueError("Unknown type of TagStorage %s", type(tag_storage))
     return app
 
 
-def create_async_app(app: FastAPI, tag_store: AsyncTagStorage):
-    @app.get("/tags", response_model=List[str], tags=["Tags"])
-    async def get_tags(limit: int = 100, offset: int = 0) -> List[str]:
-        ret = await tag_store.get_tags(limit, offset)
-        return ret
+def add_metrics(app: FastAPI, tag_storage: TagStorage, metrics: MetricsRegistry):
+    tag_storage.instrument(metrics)
+    app.add_middleware(MetricsMiddleware, registry=metrics, routes=app.routes)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def get_metrics():
+        tag_storage.collect_metrics()
+        return Response(metrics.render(), media_type=PROMETHEUS_MEDIA_TYPE)
+
+
+def create_async_app(app: FastAPI, tag_store: AsyncTagStorage, listings: ListingResponses):
+    @app.get("/tags", response_model=List[str], responses=listings.responses, tags=["Tags"])
+    async def get_tags(request: Request, response: Response, limit: int = 100, offset: int = 0,
+                       after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                       start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        ret = await tag_store.get_tags(limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
 
-    @app.get("/tags/{tag_name}/objects", response_model=List[str], tags=["Tags"])
-    async def get_tagged_obects(tag_name: str, limit: int = 100, offset: int = 0) -> List[str]:
-        ret = await tag_store.get_tagged_objects(tag_name, limit, offset)
-        return ret
+    @app.get("/tags/{tag_name}/objects", response_model=List[str], responses=listings.responses, tags=["Tags"])
+    async def get_tagged_obects(tag_name: str, request: Request, response: Response, limit: int = 100, offset: int = 0,
+                                after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                                start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store, tag=tag_name)
+        if not_modified is not None:
+            return not_modified
+        ret = await tag_store.get_tagged_objects(tag_name, limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/tags/top", response_model=List[TagCount], responses=listings.responses, tags=["Tags"])
+    async def get_top_tags(request: Request, response: Response, k: int = Query(50, ge=0)) -> List[TagCount]:
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        return listings.respond(request, response, await tag_store.get_top_tags(k))
+
+    @app.get("/tags/{tag_name}/count", response_model=int, tags=["Tags"])
+    async def count_tagged_objects(tag_name: str, request: Request, response: Response) -> int:
+        not_modified = listings.not_modified(request, response, tag_store, tag=tag_name)
+        if not_modified is not None:
+            return not_modified
+        return await tag_store.count_tagged_objects(tag_name)
+
+    @app.get("/tags/{tag_name}/related", response_model=List[RelatedTag], responses=listings.responses, tags=["Tags"])
+    async def get_related_tags(tag_name: str, request: Request, response: Response, k: int = Query(10, ge=0),
+                               score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        # The related tags change with the objects of other tags too
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        return listings.respond(request, response, await tag_store.get_related_tags(tag_name, k, score))
+
+    @app.post("/tags/objects:batchGet", response_model=Dict[str, List[str]], responses=listings.responses,
+              tags=["Tags"])
+    async def batch_get_tagged_objects(batch: BatchGet, request: Request, response: Response) -> Dict[str, List[str]]:
+        return listings.respond(request, response, await tag_store.get_many_tagged_objects(batch.keys, batch.limit))
 
     @app.delete("/tags/{tag_name}", response_model=Dict, tags=["Tags"])
     async def delete_tag(tag_name: str) -> List[str]:
         await tag_store.remove_tag(tag_name)
         return {}
 
-    @app.get("/objects", response_model=List[str], tags=["Tagged Objects"])
-    async def get_objects(limit: int = 100, offset: int = 0) -> List[str]:
-        ret = await  tag_store.get_objects(limit, offset)
-        return ret
+    @app.get("/objects", response_model=List[str], responses=listings.responses, tags=["Tagged Objects"])
+    async def get_objects(request: Request, response: Response, limit: int = 100, offset: int = 0,
+                          after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                          start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY,
+                          all_tags: List[str] = ALL_TAGS_QUERY,
+                          any_tags: List[str] = ANY_TAGS_QUERY, none_tags: List[str] = NONE_TAGS_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        if all_tags or any_tags or none_tags:
+            ret = await tag_store.query_objects(all_tags, any_tags, none_tags, limit, offset, after, prefix, start, end)
+        else:
+            ret = await tag_store.get_objects(limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/objects/{object_name}/tags", response_model=List[str], responses=listings.responses,
+             tags=["Tagged Objects"])
+    async def get_object_tags(object_name: str, request: Request, response: Response, limit: int = 100, offset: int = 0,
+                              after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                              start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store, tagged_object=object_name)
+        if not_modified is not None:
+            return not_modified
+        ret = await tag_store.get_object_tags(object_name, limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/objects/{object_name}/count", response_model=int, tags=["Tagged Objects"])
+    async def count_object_tags(object_name: str, request: Request, response: Response) -> int:
+        not_modified = listings.not_modified(request, response, tag_store, tagged_object=object_name)
+        if not_modified is not None:
+            return not_modified
+        return await tag_store.count_object_tags(object_name)
 
-    @app.get("/objects/{object_name}/tags", response_model=List[str], tags=["Tagged Objects"])
-    async def get_object_tags(object_name: str, limit: int = 100, offset: int = 0) -> List[str]:
-        ret = await tag_store.get_object_tags(object_name, limit, offset)
-        return ret
+    @app.post("/objects/tags:batchGet", response_model=Dict[str, List[str]], responses=listings.responses,
+              tags=["Tagged Objects"])
+    async def batch_get_object_tags(batch: BatchGet, request: Request, response: Response) -> Dict[str, List[str]]:
+        return listings.respond(request, response, await tag_store.get_many_object_tags(batch.keys, batch.limit))
 
     @app.delete("/objects/{object_name}", response_model=Dict, tags=["Tagged Objects"])
     async def delete_object(object_name: str):
-        await tag_store.get_object_tags(object_name)
+        await tag_store.remove_object(object_name)
         return {}
 
     @app.post("/objects/{object_name}/tags", response_model=Dict, tags=["Tagged Objects"])
@@ -60,40 +168,121 @@ def create_async_app(app: FastAPI, tag_store: AsyncTagStorage):
         await tag_store.untag(object_name, tags_to_remove)
         return {}
 
+    @app.post("/bulk", response_model=List[BulkOperationResult], tags=["Bulk"])
+    async def bulk_apply(operations: List[BulkOperation]) -> List[BulkOperationResult]:
+        return await tag_store.bulk_apply(operations)
+
+    @app.get("/export", response_class=StreamingResponse, tags=["Bulk"])
+    async def export_objects(chunk_size: int = Query(1000, gt=0)):
+        return StreamingResponse(export_lines(tag_store, chunk_size), media_type=NDJSON_MEDIA_TYPE)
+
+    @app.post("/import", response_model=ImportResult, tags=["Bulk"])
+    async def import_objects(request: Request, batch_size: int = Query(1000, gt=0)) -> ImportResult:
+        result = ImportResult()
+        async for batch in import_batches(request, batch_size, result):
+            results = await tag_store.bulk_apply([operation for _, operation in batch])
+            for (line_number, _), operation_result in zip(batch, results):
+                result.add(line_number, operation_result)
+        return result
+
     @app.on_event("shutdown")
     async def shutdown_event():
         await tag_store.close()
 
 
-def create_sync_app(app: FastAPI, tag_store: SyncTagStorage):
-    @app.get("/tags", response_model=List[str], tags=["Tags"])
-    def get_tags(limit: int = 100, offset: int = 0) -> List[str]:
-        ret = tag_store.get_tags(limit, offset)
-        return ret
+def create_sync_app(app: FastAPI, tag_store: SyncTagStorage, listings: ListingResponses):
+    @app.get("/tags", response_model=List[str], responses=listings.responses, tags=["Tags"])
+    def get_tags(request: Request, response: Response, limit: int = 100, offset: int = 0,
+                 after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                 start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        ret = tag_store.get_tags(limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/tags/{tag_name}/objects", response_model=List[str], responses=listings.responses, tags=["Tags"])
+    def get_tagged_obects(tag_name: str, request: Request, response: Response, limit: int = 100, offset: int = 0,
+                          after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                          start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store, tag=tag_name)
+        if not_modified is not None:
+            return not_modified
+        ret = tag_store.get_tagged_objects(tag_name, limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/tags/top", response_model=List[TagCount], responses=listings.responses, tags=["Tags"])
+    def get_top_tags(request: Request, response: Response, k: int = Query(50, ge=0)) -> List[TagCount]:
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        return listings.respond(request, response, tag_store.get_top_tags(k))
+
+    @app.get("/tags/{tag_name}/count", response_model=int, tags=["Tags"])
+    def count_tagged_objects(tag_name: str, request: Request, response: Response) -> int:
+        not_modified = listings.not_modified(request, response, tag_store, tag=tag_name)
+        if not_modified is not None:
+            return not_modified
+        return tag_store.count_tagged_objects(tag_name)
 
-    @app.get("/tags/{tag_name}/objects", response_model=List[str], tags=["Tags"])
-    def get_tagged_obects(tag_name: str, limit: int = 100, offset: int = 0) -> List[str]:
-        ret = tag_store.get_tagged_objects(tag_name, limit, offset)
-        return ret
+    @app.get("/tags/{tag_name}/related", response_model=List[RelatedTag], responses=listings.responses, tags=["Tags"])
+    def get_related_tags(tag_name: str, request: Request, response: Response, k: int = Query(10, ge=0),
+                         score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        # The related tags change with the objects of other tags too
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        return listings.respond(request, response, tag_store.get_related_tags(tag_name, k, score))
+
+    @app.post("/tags/objects:batchGet", response_model=Dict[str, List[str]], responses=listings.responses,
+              tags=["Tags"])
+    def batch_get_tagged_objects(batch: BatchGet, request: Request, response: Response) -> Dict[str, List[str]]:
+        return listings.respond(request, response, tag_store.get_many_tagged_objects(batch.keys, batch.limit))
 
     @app.delete("/tags/{tag_name}", response_model=Dict, tags=["Tags"])
     def delete_tag(tag_name: str) -> List[str]:
         tag_store.remove_tag(tag_name)
         return {}
 
-    @app.get("/objects", response_model=List[str])
-    def get_objects(limit: int = 100, offset: int = 0) -> List[str]:
-        ret = tag_store.get_objects(limit, offset)
-        return ret
+    @app.get("/objects", response_model=List[str], responses=listings.responses)
+    def get_objects(request: Request, response: Response, limit: int = 100, offset: int = 0,
+                    after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                    start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY,
+                    all_tags: List[str] = ALL_TAGS_QUERY, any_tags: List[str] = ANY_TAGS_QUERY,
+                    none_tags: List[str] = NONE_TAGS_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store)
+        if not_modified is not None:
+            return not_modified
+        if all_tags or any_tags or none_tags:
+            ret = tag_store.query_objects(all_tags, any_tags, none_tags, limit, offset, after, prefix, start, end)
+        else:
+            ret = tag_store.get_objects(limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/objects/{object_name}/tags", response_model=List[str], responses=listings.responses)
+    def get_object_tags(object_name: str, request: Request, response: Response, limit: int = 100, offset: int = 0,
+                        after: Optional[str] = AFTER_QUERY, prefix: Optional[str] = PREFIX_QUERY,
+                        start: Optional[str] = START_QUERY, end: Optional[str] = END_QUERY) -> List[str]:
+        not_modified = listings.not_modified(request, response, tag_store, tagged_object=object_name)
+        if not_modified is not None:
+            return not_modified
+        ret = tag_store.get_object_tags(object_name, limit, offset, after, prefix, start, end)
+        return listings.respond(request, response, ret, limit)
+
+    @app.get("/objects/{object_name}/count", response_model=int)
+    def count_object_tags(object_name: str, request: Request, response: Response) -> int:
+        not_modified = listings.not_modified(request, response, tag_store, tagged_object=object_name)
+        if not_modified is not None:
+            return not_modified
+        return tag_store.count_object_tags(object_name)
 
-    @app.get("/objects/{object_name}/tags", response_model=List[str])
-    def get_object_tags(object_name: str, limit: int = 100, offset: int = 0) -> List[str]:
-        ret = tag_store.get_object_tags(object_name, limit, offset)
-        return ret
+    @app.post("/objects/tags:batchGet", response_model=Dict[str, List[str]], responses=listings.responses)
+    def batch_get_object_tags(batch: BatchGet, request: Request, response: Response) -> Dict[str, List[str]]:
+        return listings.respond(request, response, tag_store.get_many_object_tags(batch.keys, batch.limit))
 
     @app.delete("/objects/{object_name}", response_model=Dict)
     def delete_object(object_name: str):
-        tag_store.get_object_tags(object_name)
+        tag_store.remove_object(object_name)
         return {}
 
     @app.post("/objects/{object_name}/tags", response_model=Dict)
@@ -106,6 +295,24 @@ def create_sync_app(app: FastAPI, tag_store: SyncTagStorage):
         tag_store.untag(object_name, tags_to_remove)
         return {}
 
+    @app.post("/bulk", response_model=List[BulkOperationResult], tags=["Bulk"])
+    def bulk_apply(operations: List[BulkOperation]) -> List[BulkOperationResult]:
+        return tag_store.bulk_apply(operations)
+
+    @app.get("/export", response_class=StreamingResponse, tags=["Bulk"])
+    def export_objects(chunk_size: int = Query(1000, gt=0)):
+        return StreamingResponse(sync_export_lines(tag_store, chunk_size), media_type=NDJSON_MEDIA_TYPE)
+
+    @app.post("/import", response_model=ImportResult, tags=["Bulk"])
+    async def import_objects(request: Request, batch_size: int = Query(1000, gt=0)) -> ImportResult:
+        # The body is read in the loop, the storage is called in the thread pool like the other endpoints
+        result = ImportResult()
+        async for batch in import_batches(request, batch_size, result):
+            results = await run_in_threadpool(tag_store.bulk_apply, [operation for _, operation in batch])
+            for (line_number, _), operation_result in zip(batch, results):
+                result.add(line_number, operation_result)
+        return result
+
     @app.on_event("shutdown")
     def shutdown_event():
         tag_store.close()
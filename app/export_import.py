@@ -0,0 +1,104 @@
+"""
+NDJSON export and import of the whole storage, one line per object: {"object": "name", "tags": ["a", "b"]}.
+
+Both directions are streamed: the export reads the storage a page of objects at a time and the import applies
+the lines as bulk operations of batch_size objects, so memory does not grow with the size of the storage.
+Tags that are not on any object are not exported.
+"""
+import dataclasses
+import json
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from starlette.requests import Request
+
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType
+from tag_storage.base_storage.sync_tag_storage import SyncTagStorage
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MAX_REPORTED_ERRORS = 100
+
+
+@dataclasses.dataclass
+class ImportResult:
+    imported: int = 0
+    failed: int = 0
+    errors: List[str] = dataclasses.field(default_factory=list)  # the first MAX_REPORTED_ERRORS
+
+    def add(self, line_number: int, result: BulkOperationResult):
+        if result.ok:
+            self.imported += 1
+            return
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"line {line_number}: {result.error}")
+
+
+def _lines(records: List[Tuple[str, List[str]]]) -> str:
+    return "".join(json.dumps({"object": name, "tags": list(tags)}) + "\n" for name, tags in records)
+
+
+async def export_lines(tag_store: AsyncTagStorage, chunk_size: int) -> AsyncIterator[str]:
+    after = None
+    while True:
+        records = await tag_store.get_objects_with_tags(chunk_size, after)
+        if records:
+            yield _lines(records)
+        if len(records) < chunk_size:
+            return
+        after = records[-1][0]
+
+
+def sync_export_lines(tag_store: SyncTagStorage, chunk_size: int) -> Iterator[str]:
+    after = None
+    while True:
+        records = tag_store.get_objects_with_tags(chunk_size, after)
+        if records:
+            yield _lines(records)
+        if len(records) < chunk_size:
+            return
+        after = records[-1][0]
+
+
+def parse_line(line: bytes) -> BulkOperation:
+    record = json.loads(line)
+    if not isinstance(record, dict) or not isinstance(record.get("object"), str) \
+            or not isinstance(record.get("tags", []), list) \
+            or not all(isinstance(each, str) for each in record.get("tags", [])):
+        raise ValueError('expected {"object": "name", "tags": ["tag", ...]}')
+    return BulkOperation(BulkOperationType.TAG, object_name=record["object"], tags=record.get("tags", []))
+
+
+async def import_batches(request: Request, batch_size: int, result: ImportResult) \
+        -> AsyncIterator[List[Tuple[int, BulkOperation]]]:
+    """Batches of (line number, operation) read from the body, lines that can't be parsed go to result"""
+    batch = []
+    line_number = 0
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            operation = _parse(line, line_number, result)
+            if operation is not None:
+                batch.append((line_number, operation))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    line_number += 1
+    operation = _parse(buffer, line_number, result)
+    if operation is not None:
+        batch.append((line_number, operation))
+    if batch:
+        yield batch
+
+
+def _parse(line: bytes, line_number: int, result: ImportResult) -> Optional[BulkOperation]:
+    if not line.strip():
+        return None
+    try:
+        return parse_line(line)
+    except ValueError as e:
+        result.add(line_number, BulkOperationResult(ok=False, error=str(e)))
+        return None
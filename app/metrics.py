@@ -0,0 +1,138 @@
+"""
+Prometheus metrics of the api and its storage, exposed in the text format in /metrics when enabled.
+"""
+from __future__ import annotations
+
+import bisect
+import collections
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.routing import BaseRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from tag_storage.base_storage import instrumentation
+from tag_storage.base_storage.instrumentation import Instrumentation
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4"  # Starlette adds the charset
+# Seconds, from lock waits of a hundred microseconds to snapshots of a minute
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class MetricsRegistry(Instrumentation):
+    """Keeps what is reported in memory. Sync storages report from the threads of the pool, hence the lock."""
+    enabled = True
+    histograms: Dict[str, Dict[Labels, _Histogram]]
+    values: Dict[str, Dict[Labels, float]]  # gauges and counters
+
+    def __init__(self):
+        self.histograms = collections.defaultdict(dict)
+        self.values = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms[name].get(key)
+            if histogram is None:
+                histogram = self.histograms[name][key] = _Histogram()
+            histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self.lock:
+            for name in sorted(set(self.histograms) | set(self.values)):
+                kind, description = instrumentation.METRICS.get(name, (instrumentation.GAUGE, name))
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(self.values.get(name, {}).items()):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                for labels, histogram in sorted(self.histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + (math.inf,), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} "
+                                     f"{cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """Observes the duration of the requests by route, the path template rather than the path keeps them few"""
+
+    def __init__(self, app: ASGIApp, registry: MetricsRegistry, routes: List[BaseRoute]):
+        self.app = app
+        self.registry = registry
+        self.routes = routes
+        self.paths = {}
+
+    def __path(self, endpoint: Optional[Callable]) -> str:
+        if endpoint is None:
+            return 'unmatched'
+        if endpoint not in self.paths:
+            self.paths = {getattr(route, 'endpoint', None): getattr(route, 'path', 'unmatched')
+                          for route in self.routes}
+        return self.paths.get(endpoint, 'unmatched')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the endpoint of the route it matched in the scope
+            self.registry.observe('tagapi_http_request_duration_seconds', time.perf_counter() - start,
+                                  method=scope['method'], path=self.__path(scope.get('endpoint')), status=str(status))
@@ -0,0 +1,137 @@
+"""
+Responses of the listings without the validation of their response_model, enabled with fast_responses. Validating
+and encoding a page of thousands of names through pydantic takes longer than reading it, these pages are encoded
+at once with orjson, or with MessagePack for the clients that prefer it, when they are installed.
+"""
+from __future__ import annotations
+
+import dataclasses
+import json
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from tag_storage.base_storage.tag_storage import TagStorage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack", "application/vnd.msgpack")
+
+
+def set_next_cursor(response: Response, page: List[str], limit: int):
+    # Percent-encoded, so any name fits in a header and it can be sent back as after= verbatim
+    if limit > 0 and len(page) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = quote(page[-1], safe='')
+
+
+def _default(value: Any) -> Any:
+    # TagCount and the other dataclasses of the storages are encoded as objects
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    raise TypeError(f"{type(value).__name__} can't be encoded")
+
+
+def dump_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)  # it encodes dataclasses itself
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+
+class MsgpackResponse(Response):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=_default)
+
+
+def prefers_msgpack(accept: Optional[str]) -> bool:
+    """Whether accept asks for MessagePack with a higher quality than JSON. Wildcards only count for JSON."""
+    msgpack_quality, json_quality = 0.0, 0.0
+    for media_range in (accept or "").split(","):
+        media_type, *parameters = [each.strip() for each in media_range.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = media_type.lower()
+        if media_type in MSGPACK_MEDIA_TYPES:
+            msgpack_quality = max(msgpack_quality, quality)
+        elif media_type == "application/json":
+            json_quality = max(json_quality, quality)
+    return msgpack_quality > json_quality
+
+
+def _opaque(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Weak comparison, as If-None-Match asks for
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(_opaque(each.strip()) == _opaque(etag) for each in if_none_match.split(","))
+
+
+class ListingResponses:
+    """
+    How the listings answer: with the page, which FastAPI validates against the response_model, or with
+    fast_responses with a response encoded here. The response_model still describes them in the OpenAPI schema.
+    With storages that keep versions, the listings and counts carry an ETag and a request that has it in
+    If-None-Match is answered before reading anything.
+    """
+    fast: bool
+    responses: Optional[Dict[int, Dict]]  # the responses of the listings in the schema, besides the model
+
+    def __init__(self, fast: bool = False):
+        self.fast = fast
+        self.responses = None
+        if fast and msgpack is not None:
+            self.responses = {200: {"content": {MSGPACK_MEDIA_TYPE: {}}}}
+
+    def respond(self, request: Request, response: Response, content: List, limit: Optional[int] = None) -> Any:
+        # limit is that of a page of names, whose last name is the next cursor when it is full
+        if limit is not None:
+            set_next_cursor(response, content, limit)
+        if not self.fast:
+            return content
+        # FastAPI doesn't copy the headers of response to a response returned by the endpoint
+        headers = dict(response.headers, vary="Accept")
+        if msgpack is not None and prefers_msgpack(request.headers.get("accept")):
+            return MsgpackResponse(content, headers=headers)
+        return FastJSONResponse(content, headers=headers)
+
+    @staticmethod
+    def not_modified(request: Request, response: Response, tag_store: TagStorage, tag: Optional[str] = None,
+                     tagged_object: Optional[str] = None) -> Optional[Response]:
+        """Sets the ETag of the listings of tag, of tagged_object or of the storage, a 304 response if it matches"""
+        versions = tag_store.versions
+        if versions is None:
+            return None
+        etag = versions.etag(tag, tagged_object)
+        response.headers["etag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"etag": etag, "vary": "Accept"})
+        return None
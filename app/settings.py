@@ -1,47 +1,57 @@
 from __future__ import annotations
 
-from typing import Union, Optional
+from typing import Optional
 
-from pydantic import BaseSettings, BaseModel
+from pydantic import BaseSettings, validator
 
+from app.backends import TagStorageSettings, get_backend, parse_storage_settings
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.change_feed import ChangeFeed, ChangeFeedConfiguration
 from tag_storage.base_storage.tag_storage import TagStorage
-from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorageConfiguration, PickledSetTagStorage
-from tag_storage.py2neo_storage.py2neo_storage import Py2NeoStorageConfig
+from tag_storage.caching_storage.caching_storage import CachingAsyncTagStorage, CachingSyncTagStorage
+from tag_storage.caching_storage.page_cache import PageCacheConfiguration
 
+# The settings of the storages moved to app.backends, they are imported when asked for from here
+_BACKEND_SETTINGS = {
+    'PickleDbSettings': 'pickle',
+    'Py2NeoSettings': 'py2neo',
+    'Neo4jSettings': 'neo4j',
+    'SqliteSettings': 'sqlite',
+}
 
-class TagStorageSettings(BaseModel):
 
-    def get_storage(self) -> TagStorage:
-        raise NotImplementedError()
-
-
-class PickleDbSettings(TagStorageSettings):
-    pickledb_path: str
-
-    def get_storage(self):
-        config = PickledSetTagStorageConfiguration(path=self.pickledb_path)
-        storage = PickledSetTagStorage(config)
-        return storage
-
-
-class Py2NeoSettings(TagStorageSettings):
-    py2neo_url: str
-    py2neo_username: Optional[str] = None
-    py2neo_password: Optional[str] = None
-
-    def get_storage(self):
-        config = Py2NeoStorageConfig(url=self.py2neo_url, username=self.py2neo_username, password=self.py2neo_password)
-        storage = PickledSetTagStorage(config)
-        return storage
-
-
-class SupportedStorageSettings(TagStorageSettings):
-    __root__: Union[PickleDbSettings, Py2NeoSettings]
-
-    def get_storage(self):
-        return self.__root__.get_storage()
+def __getattr__(name: str):
+    if name in _BACKEND_SETTINGS:
+        return get_backend(_BACKEND_SETTINGS[name]).settings_class()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
 
 
 class Settings(BaseSettings):
     app_name: str = "TagApi"
-    tag_storage_settings: SupportedStorageSettings
+    tag_storage_settings: TagStorageSettings  # of the storage named in its backend, see app.backends
+    cache_max_entries: int = 0  # pages kept by the read cache, it is disabled with 0
+    cache_ttl_seconds: float = 60.0
+    metrics_enabled: bool = False  # Prometheus metrics in /metrics
+    fast_responses: bool = False  # listings skip the validation of their response model, see app.responses
+    change_feed_enabled: bool = False  # the writes in /changes and /changes/ws, see app.change_feed
+    change_feed_buffer_size: int = 10000  # changes kept for the clients that reconnect
+    change_feed_queue_size: int = 1000  # changes a client can fall behind before it is disconnected
+
+    @validator('tag_storage_settings', pre=True)
+    def select_storage_backend(cls, value):
+        return parse_storage_settings(value)
+
+    def get_change_feed(self) -> Optional[ChangeFeed]:
+        if not self.change_feed_enabled:
+            return None
+        return ChangeFeed(ChangeFeedConfiguration(buffer_size=self.change_feed_buffer_size,
+                                                  queue_size=self.change_feed_queue_size))
+
+    def get_storage(self) -> TagStorage:
+        storage = self.tag_storage_settings.get_storage()
+        if self.cache_max_entries <= 0:
+            return storage
+        config = PageCacheConfiguration(max_entries=self.cache_max_entries, ttl=self.cache_ttl_seconds)
+        if isinstance(storage, AsyncTagStorage):
+            return CachingAsyncTagStorage(storage, config)
+        return CachingSyncTagStorage(storage, config)
@@ -0,0 +1,75 @@
+"""
+Reproducible synthetic datasets: objects with a fixed number of tags each, drawn from a Zipfian distribution so a
+few tags are on most objects and most tags are on a few, as in real tagging data.
+
+    python -m benchmarks.dataset --objects 1000 --tags 100 --tags-per-object 5 > dataset.ndjson
+
+prints it in the NDJSON format of /import. The same configuration and seed always give the same dataset.
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import random
+from typing import Iterator, List, Tuple
+
+
+@dataclasses.dataclass
+class DatasetConfig:
+    objects: int = 10000
+    tags: int = 1000
+    tags_per_object: int = 5
+    zipf_exponent: float = 1.1  # the tag of rank r is drawn with a weight of 1 / r ** zipf_exponent
+    seed: int = 42
+
+
+def object_name(position: int) -> str:
+    return f"object:{position:08}"
+
+
+def tag_name(rank: int) -> str:
+    # Zero padded, so the most popular tags are also the first ones listed
+    return f"tag:{rank:06}"
+
+
+class ZipfSampler:
+    """Draws ranks in [0, n) with weight 1 / (rank + 1) ** exponent"""
+
+    def __init__(self, n: int, exponent: float, rng: random.Random):
+        self.ranks = range(n)
+        self.cumulative_weights = list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in self.ranks))
+        self.rng = rng
+
+    def sample(self, k: int = 1) -> List[int]:
+        return self.rng.choices(self.ranks, cum_weights=self.cumulative_weights, k=k)
+
+    def sample_distinct(self, k: int) -> List[int]:
+        k = min(k, len(self.ranks))
+        chosen = set()
+        while len(chosen) < k:
+            chosen.update(self.sample(k - len(chosen)))
+        return sorted(chosen)
+
+
+def generate(config: DatasetConfig) -> Iterator[Tuple[str, List[str]]]:
+    """(object, tags) for every object of the dataset, in name order"""
+    sampler = ZipfSampler(config.tags, config.zipf_exponent, random.Random(config.seed))
+    for position in range(config.objects):
+        yield object_name(position), [tag_name(rank) for rank in sampler.sample_distinct(config.tags_per_object)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=DatasetConfig.objects)
+    parser.add_argument('--tags', type=int, default=DatasetConfig.tags)
+    parser.add_argument('--tags-per-object', type=int, default=DatasetConfig.tags_per_object)
+    parser.add_argument('--zipf-exponent', type=float, default=DatasetConfig.zipf_exponent)
+    parser.add_argument('--seed', type=int, default=DatasetConfig.seed)
+    args = parser.parse_args()
+    config = DatasetConfig(args.objects, args.tags, args.tags_per_object, args.zipf_exponent, args.seed)
+    for name, tags in generate(config):
+        print(json.dumps({"object": name, "tags": tags}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import contextlib
+import statistics
+import time
+from typing import Dict, List
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    # Nearest rank
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+class LatencyRecorder:
+    """Latencies of the calls of one operation, and the wall time they took together"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.elapsed = 0.0
+
+    @contextlib.contextmanager
+    def call(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def run(self):
+        """Around all the calls, when they run concurrently their latencies add up to more than the wall time"""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def summary(self) -> Dict[str, float]:
+        if not self.latencies:
+            return {'calls': 0}
+        values = sorted(self.latencies)
+        elapsed = self.elapsed or sum(values)
+        return {
+            'calls': len(values),
+            'throughput_per_s': len(values) / elapsed if elapsed > 0 else float('inf'),
+            'mean_ms': statistics.mean(values) * 1000,
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p90_ms': percentile(values, 0.90) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
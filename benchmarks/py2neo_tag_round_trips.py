@@ -0,0 +1,159 @@
+"""
+Compares the write path of Py2NeoStorage (one statement per tag/untag) with the implementation it replaced
+(node lookups, one edge lookup per tag, node creation outside the transaction and then a transaction).
+
+It counts the requests sent to the server through py2neo connections and the latency of each call:
+
+    python -m benchmarks.py2neo_tag_round_trips --url bolt://127.0.0.1:7687 --wipe --objects 200 --tags-per-object 10
+
+The whole graph in the server is deleted before each run, so it refuses to run without --wipe: point --url at a
+server whose data can be lost. For an object with k tags the legacy implementation needs
+about k + 4 requests (object lookup, tag lookup, one edge or node request per tag, begin and commit), the
+current one needs 1.
+"""
+import argparse
+import contextlib
+import json
+import statistics
+import time
+from typing import Collection, Dict, List
+
+import py2neo
+from py2neo import Graph, IN, Node, NodeMatcher, Relationship, RelationshipMatcher
+from py2neo.client import Connection
+
+from tag_storage.py2neo_storage.py2neo_storage import Py2NeoStorage, Py2NeoStorageConfig
+
+REQUEST_METHODS = ('auto_run', 'run', 'begin', 'commit', 'rollback', 'pull')
+
+
+class LegacyPy2NeoTagging:
+    """The tag/untag implementation Py2NeoStorage had before they became single statements"""
+
+    def __init__(self, graph: Graph):
+        self.graph = graph
+
+    def tag(self, object_to_tag: str, tags: Collection[str]):
+        nodes = NodeMatcher(self.graph)
+        object_node = nodes.match(Py2NeoStorage.OBJECT, name=object_to_tag).first()
+        if object_node is None:
+            object_node = Node(Py2NeoStorage.OBJECT, name=object_to_tag)
+            self.graph.create(object_node)
+        existing_tags = {n['name']: n for n in nodes.match(Py2NeoStorage.TAG, name=IN(tags)).all()}
+        existing_edges = set()
+        for tag_name, tag_node in existing_tags.items():
+            edge = RelationshipMatcher(self.graph).match(nodes=(object_node, tag_node),
+                                                         r_type=Py2NeoStorage.TAGGED).first()
+            if edge is not None:
+                existing_edges.add(tag_name)
+        for each in tags:
+            if each not in existing_tags:
+                existing_tags[each] = Node(Py2NeoStorage.TAG, name=each)
+                self.graph.create(existing_tags[each])
+        tx = self.graph.begin()
+        for tag_name, tag_node in existing_tags.items():
+            if tag_name not in existing_edges:
+                tx.create(Relationship(object_node, Py2NeoStorage.TAGGED, tag_node))
+        self.graph.commit(tx)
+
+    def untag(self, object_to_untag: str, tags: Collection[str]):
+        nodes = NodeMatcher(self.graph)
+        object_node = nodes.match(Py2NeoStorage.OBJECT, name=object_to_untag).first()
+        if object_node is None:
+            return
+        existing_tags = {n['name']: n for n in nodes.match(Py2NeoStorage.TAG, name=IN(tags)).all()}
+        existing_edges = []
+        for tag_name, tag_node in existing_tags.items():
+            edge = RelationshipMatcher(self.graph).match(nodes=(object_node, tag_node),
+                                                         r_type=Py2NeoStorage.TAGGED).first()
+            if edge is not None:
+                existing_edges.append(edge)
+        tx = self.graph.begin()
+        for each in existing_edges:
+            tx.separate(each)
+        self.graph.commit(tx)
+
+
+class RequestCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    @contextlib.contextmanager
+    def counting(self):
+        patched = []
+        classes = [Connection]
+        while classes:
+            cls = classes.pop()
+            classes.extend(cls.__subclasses__())
+            for name in REQUEST_METHODS:
+                if name in cls.__dict__:
+                    patched.append((cls, name, cls.__dict__[name]))
+                    setattr(cls, name, self.__wrap(cls.__dict__[name]))
+        try:
+            yield self
+        finally:
+            for cls, name, method in patched:
+                setattr(cls, name, method)
+
+    def __wrap(self, method):
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+
+def measure(implementation, objects: int, tags_per_object: int) -> Dict:
+    tags = [f"tag{i}" for i in range(tags_per_object)]
+    latencies: Dict[str, List[float]] = {'tag': [], 'retag': [], 'untag': []}
+    requests: Dict[str, int] = {}
+    for operation in latencies:
+        counter = RequestCounter()
+        with counter.counting():
+            for i in range(objects):
+                start = time.perf_counter()
+                if operation == 'untag':
+                    implementation.untag(f"object{i}", tags)
+                else:
+                    # retag applies the same tags again, existing edges must be detected
+                    implementation.tag(f"object{i}", tags)
+                latencies[operation].append(time.perf_counter() - start)
+        requests[operation] = counter.count
+    return {
+        operation: {
+            'requests_per_call': requests[operation] / objects,
+            'mean_ms': statistics.mean(values) * 1000,
+            'p50_ms': statistics.median(values) * 1000,
+            'p95_ms': statistics.quantiles(values, n=20)[-1] * 1000 if len(values) > 1 else values[0] * 1000,
+        } for operation, values in latencies.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--wipe', action='store_true', help="Allow deleting the whole graph in --url")
+    parser.add_argument('--username', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--objects', type=int, default=200)
+    parser.add_argument('--tags-per-object', type=int, default=10)
+    args = parser.parse_args()
+    if not args.wipe:
+        parser.error(f"Every run deletes the whole graph in {args.url}, pass --wipe to allow it")
+
+    try:
+        graph = Graph(args.url, auth=(args.username, args.password))
+        graph.delete_all()
+    except py2neo.errors.ConnectionUnavailable:
+        parser.exit(1, f"There is no neo4j or ongdb server in {args.url}\n")
+    storage = Py2NeoStorage(Py2NeoStorageConfig(url=args.url, username=args.username, password=args.password))
+    results = {}
+    for name, implementation in (('legacy', LegacyPy2NeoTagging(graph)), ('current', storage)):
+        graph.delete_all()
+        results[name] = measure(implementation, args.objects, args.tags_per_object)
+    graph.delete_all()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
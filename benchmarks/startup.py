@@ -0,0 +1,165 @@
+"""
+Measures the cold start of the api over each storage, as a new worker does it: importing the app, parsing the
+settings, opening the storage, creating the app and answering the first request:
+
+    python -m benchmarks.startup --storages pickle,sqlite --objects 10000 --runs 10 --output startup.json
+
+Every run is a new interpreter, started with tag_storage_settings in its environment like main.py. The storages are
+loaded with --objects objects of benchmarks.dataset first, so opening them reads a file of that size. process_ms is
+the whole run as seen from outside, the interpreter starting and exiting included. Each run also lists how many
+modules it imported and which of the drivers of the storages among them. Storages whose server is not available
+are listed as skipped with the reason.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+DRIVER_MODULES = ['neo4j', 'py2neo', 'sqlite3', 'tag_storage.pickle_storage.pickle_storage']
+PHASES = ['import_ms', 'settings_ms', 'open_ms', 'create_app_ms', 'first_request_ms', 'process_ms']
+STORAGES = ['pickle', 'pickle-mapped', 'sqlite', 'neo4j', 'py2neo']
+
+
+def storage_settings(name: str, temp_dir: str, neo4j_url: str) -> Dict:
+    if name == 'pickle':
+        return {'pickledb_path': os.path.join(temp_dir, 'pickle.db')}
+    if name == 'pickle-mapped':
+        return {'pickledb_path': os.path.join(temp_dir, 'mapped.db'), 'pickledb_mapped': True}
+    if name == 'sqlite':
+        return {'sqlite_path': os.path.join(temp_dir, 'sqlite.db')}
+    if name in ('neo4j', 'py2neo'):
+        return {'backend': name, f'{name}_url': neo4j_url}
+    raise ValueError(f"Unknown storage {name}, expected one of {', '.join(STORAGES)}")
+
+
+async def close(storage):
+    result = storage.close()
+    if inspect.isawaitable(result):
+        await result
+
+
+async def start() -> Dict:
+    # In the new interpreter, nothing of the app is imported yet
+    timings = {}
+    start_time = time.perf_counter()
+    from app.create_app import create_app
+    from app.settings import Settings
+    timings['import_ms'] = (time.perf_counter() - start_time) * 1000
+
+    start_time = time.perf_counter()
+    settings = Settings(_env_file=None)
+    timings['settings_ms'] = (time.perf_counter() - start_time) * 1000
+
+    start_time = time.perf_counter()
+    storage = settings.get_storage()
+    timings['open_ms'] = (time.perf_counter() - start_time) * 1000
+
+    start_time = time.perf_counter()
+    app = create_app(storage, settings.app_name)
+    timings['create_app_ms'] = (time.perf_counter() - start_time) * 1000
+    timings['modules'] = len(sys.modules)
+    timings['driver_modules'] = [module for module in DRIVER_MODULES if module in sys.modules]
+
+    # The client is not part of the app
+    import httpx
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        start_time = time.perf_counter()
+        response = await client.get('/tags', params={'limit': 1})
+        timings['first_request_ms'] = (time.perf_counter() - start_time) * 1000
+        response.raise_for_status()
+    await close(storage)
+    return timings
+
+
+async def load_storage(settings: Dict, objects: int):
+    from app.settings import Settings
+    from benchmarks.dataset import DatasetConfig
+    from benchmarks.storage_suite import load
+    storage = Settings(_env_file=None, tag_storage_settings=settings).get_storage()
+    try:
+        await load(storage, DatasetConfig(objects=objects))
+    finally:
+        await close(storage)
+
+
+def run_once(settings: Dict) -> Dict:
+    environment = dict(os.environ, tag_storage_settings=json.dumps(settings))
+    start_time = time.perf_counter()
+    process = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child'], env=environment,
+                             capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(
+                                 os.path.abspath(__file__))))
+    elapsed = (time.perf_counter() - start_time) * 1000
+    if process.returncode != 0:
+        lines = process.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"exit code {process.returncode}")
+    timings = json.loads(process.stdout.strip().splitlines()[-1])
+    timings['process_ms'] = elapsed
+    return timings
+
+
+def summary(values: List[float]) -> Dict[str, float]:
+    from benchmarks.latency import percentile
+    values = sorted(values)
+    return {'p50_ms': percentile(values, 0.50), 'p90_ms': percentile(values, 0.90), 'min_ms': values[0],
+            'max_ms': values[-1]}
+
+
+def run_storage(name: str, temp_dir: str, objects: int, runs: int, neo4j_url: str) -> Dict:
+    settings = storage_settings(name, temp_dir, neo4j_url)
+    try:
+        if objects:
+            asyncio.run(load_storage(settings, objects))
+        timings = [run_once(settings) for _ in range(runs)]
+    except Exception as e:
+        return {'skipped': f"{type(e).__name__}: {e}"}
+    results = {phase: summary([each[phase] for each in timings]) for phase in PHASES}
+    results['modules'] = timings[-1]['modules']
+    results['driver_modules'] = timings[-1]['driver_modules']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storages', default='pickle,pickle-mapped,sqlite',
+                        help=f"Comma separated, of {', '.join(STORAGES)}")
+    parser.add_argument('--objects', type=int, default=10000, help="Loaded in each storage before the runs")
+    parser.add_argument('--runs', type=int, default=10, help="Cold starts of each storage")
+    parser.add_argument('--neo4j-url', default="bolt://127.0.0.1:7687")
+    parser.add_argument('--output', default=None, help="JSON file for the results, they are printed without it")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(asyncio.run(start())))
+        return
+
+    storages = [each.strip() for each in args.storages.split(',') if each.strip()]
+    for each in storages:
+        if each not in STORAGES:
+            parser.error(f"Unknown storage {each}, expected one of {', '.join(STORAGES)}")
+    from benchmarks.storage_suite import current_commit
+    import platform
+    results = {
+        'environment': {'commit': current_commit(), 'python': platform.python_version(),
+                        'platform': platform.platform()},
+        'config': {'objects': args.objects, 'runs': args.runs},
+        'storages': {},
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in storages:
+            results['storages'][name] = run_storage(name, temp_dir, args.objects, args.runs, args.neo4j_url)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""
+Loads a synthetic dataset (benchmarks.dataset) in each storage and measures the latency percentiles and throughput
+of every storage method, the snapshots and file size of the pickle storages, and requests to create_app over the
+storage:
+
+    python -m benchmarks.storage_suite --storages pickle,pickle-mapped --objects 10000 --output results.json
+
+Every method is called --operations times with arguments drawn from the dataset, tags with their Zipfian
+popularity. The requests go to the ASGI app in the process, through httpx, with --concurrency of them in flight,
+so they measure the app and the storage without a network. Storages whose server is not available, like
+neo4j without a server in --neo4j-url, are listed as skipped with the reason. The graph storages delete everything in
+that server first, so they are skipped unless --neo4j-url and --wipe-neo4j are both given. The pickle storages are
+synced only when measured, their periodic synchronizer runs every hour.
+"""
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import functools
+import inspect
+import json
+import os.path
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from benchmarks.dataset import DatasetConfig, ZipfSampler, generate, object_name, tag_name
+from benchmarks.latency import LatencyRecorder
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+from tag_storage.base_storage.tag_storage import TagStorage
+from tag_storage.caching_storage.caching_storage import CachingAsyncTagStorage
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration
+from tag_storage.pickle_storage.pickle_storage_periodic_synchronizer import \
+    PickledSetTagStoragePeriodicSynchronizer, PickledSetTagStoragePeriodicSynchronizerConfiguration
+from tag_storage.pickle_storage.tag_cooccurrence import TagCooccurrenceConfiguration
+
+PICKLE_STORAGES = {
+    'pickle': {},
+    'pickle-compact': {'compact': True},
+    'pickle-journal': {'journal': PickledSetTagStorageJournalConfiguration()},
+    'pickle-mapped': {'mapped': True},
+    'pickle-cached': {},
+    'pickle-cooccurrence': {'cooccurrence': TagCooccurrenceConfiguration()},
+}
+STORAGES = list(PICKLE_STORAGES) + ['sqlite', 'neo4j', 'py2neo']
+LOAD_BATCH_SIZE = 1000
+
+
+class StorageUnavailable(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class SuiteConfig:
+    dataset: DatasetConfig
+    operations: int = 1000
+    concurrency: int = 10
+    syncs: int = 3
+    http: bool = True
+    neo4j_url: Optional[str] = None
+    neo4j_username: Optional[str] = None
+    neo4j_password: Optional[str] = None
+    wipe_neo4j: bool = False  # the graph storages delete the whole graph in neo4j_url
+
+
+async def call(storage: TagStorage, method: str, *args):
+    # SyncTagStorage methods are called in the loop, as create_app would call them in its thread pool
+    result = getattr(storage, method)(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def pickle_config(name: str, path: str) -> PickledSetTagStorageConfiguration:
+    synchronizer = PickledSetTagStoragePeriodicSynchronizer(
+        PickledSetTagStoragePeriodicSynchronizerConfiguration(interval=datetime.timedelta(hours=1)))
+    return PickledSetTagStorageConfiguration(path=path, synchronizer=synchronizer, **PICKLE_STORAGES[name])
+
+
+def neo4j_url(config: SuiteConfig) -> str:
+    if config.neo4j_url is None or not config.wipe_neo4j:
+        raise StorageUnavailable("It deletes the whole graph first, it needs --neo4j-url and --wipe-neo4j")
+    return config.neo4j_url
+
+
+def open_storage(name: str, config: SuiteConfig, temp_dir: str) -> TagStorage:
+    if name in PICKLE_STORAGES:
+        storage = PickledSetTagStorage(pickle_config(name, os.path.join(temp_dir, name)))
+        return CachingAsyncTagStorage(storage) if name == 'pickle-cached' else storage
+    if name == 'sqlite':
+        from tag_storage.sqlite_storage.sqlite_storage import SqliteStorage, SqliteStorageConfig
+        return SqliteStorage(SqliteStorageConfig(path=os.path.join(temp_dir, 'sqlite.db')))
+    if name == 'neo4j':
+        import neo4j
+        from tag_storage.neo4j_storage.neo4j_storage import Neo4jStorage, Neo4jStorageConfig
+        url = neo4j_url(config)
+        auth = (config.neo4j_username, config.neo4j_password) if config.neo4j_username else None
+        try:
+            with neo4j.GraphDatabase.driver(url, auth=auth) as driver, driver.session() as session:
+                session.run("MATCH (n) DETACH DELETE n").consume()
+        except (neo4j.exceptions.Neo4jError, neo4j.exceptions.DriverError, ValueError) as e:
+            raise StorageUnavailable(f"There is no neo4j server in {url}: {e}")
+        return Neo4jStorage(Neo4jStorageConfig(url=url, username=config.neo4j_username,
+                                               password=config.neo4j_password))
+    if name == 'py2neo':
+        import py2neo
+        from tag_storage.py2neo_storage.py2neo_storage import Py2NeoStorage, Py2NeoStorageConfig
+        url = neo4j_url(config)
+        try:
+            py2neo.Graph(url, auth=(config.neo4j_username, config.neo4j_password)).delete_all()
+        except py2neo.errors.ConnectionUnavailable as e:
+            raise StorageUnavailable(f"There is no neo4j server in {url}: {e}")
+        return Py2NeoStorage(Py2NeoStorageConfig(url=url, username=config.neo4j_username,
+                                                 password=config.neo4j_password))
+    raise ValueError(f"Unknown storage {name}, expected one of {', '.join(STORAGES)}")
+
+
+class Workload:
+    """Arguments for the calls, drawn from the dataset with a seeded generator"""
+
+    def __init__(self, dataset: DatasetConfig):
+        self.dataset = dataset
+        self.rng = random.Random(dataset.seed + 1)
+        self.tags = ZipfSampler(dataset.tags, dataset.zipf_exponent, self.rng)
+
+    def tag(self) -> str:
+        return tag_name(self.tags.sample()[0])
+
+    def some_tags(self, k: int = 2) -> List[str]:
+        return [tag_name(rank) for rank in self.tags.sample_distinct(k)]
+
+    def object(self) -> str:
+        return object_name(self.rng.randrange(self.dataset.objects))
+
+    def new_object(self) -> str:
+        return f"new-{object_name(self.rng.randrange(self.dataset.objects))}"
+
+
+async def load(storage: TagStorage, dataset: DatasetConfig) -> Dict:
+    recorder = LatencyRecorder()
+    batch = []
+    with recorder.run():
+        for name, tags in generate(dataset):
+            batch.append(BulkOperation(BulkOperationType.TAG, object_name=name, tags=tags))
+            if len(batch) == LOAD_BATCH_SIZE:
+                with recorder.call():
+                    await call(storage, 'bulk_apply', batch)
+                batch = []
+        if batch:
+            with recorder.call():
+                await call(storage, 'bulk_apply', batch)
+    summary = recorder.summary()
+    summary['objects_per_s'] = dataset.objects / recorder.elapsed if recorder.elapsed > 0 else float('inf')
+    return summary
+
+
+async def measure_calls(operations: int, function: Callable[..., Awaitable],
+                        make_args: Callable[[], Tuple]) -> Dict:
+    recorder = LatencyRecorder()
+    with recorder.run():
+        for _ in range(operations):
+            # Drawing the arguments is not part of the call
+            args = make_args()
+            with recorder.call():
+                await function(*args)
+    return recorder.summary()
+
+
+async def measure_methods(storage: TagStorage, workload: Workload, operations: int) -> Dict:
+    # The reads first, on the loaded dataset, then the writes that change it
+    reads = {
+        'get_tags': lambda: ('get_tags', 100, 0, workload.tag()),
+        'get_objects': lambda: ('get_objects', 100, 0, workload.object()),
+        'get_objects_prefix': lambda: ('get_objects', 100, 0, None, workload.object()[:-2]),
+        'get_tagged_objects': lambda: ('get_tagged_objects', workload.tag()),
+        'get_object_tags': lambda: ('get_object_tags', workload.object()),
+        'get_many_object_tags': lambda: ('get_many_object_tags', [workload.object() for _ in range(200)]),
+        'query_objects_all': lambda: ('query_objects', workload.some_tags()),
+        'query_objects_any': lambda: ('query_objects', (), workload.some_tags()),
+        'query_objects_none': lambda: ('query_objects', [workload.tag()], (), [workload.tag()]),
+        'get_objects_with_tags': lambda: ('get_objects_with_tags', 100, workload.object()),
+        'count_tagged_objects': lambda: ('count_tagged_objects', workload.tag()),
+        'count_object_tags': lambda: ('count_object_tags', workload.object()),
+        'get_top_tags': lambda: ('get_top_tags', 50),
+        'get_related_tags': lambda: ('get_related_tags', workload.tag()),
+    }
+    writes = {
+        'tag': lambda: ('tag', workload.object(), workload.some_tags()),
+        'tag_new_object': lambda: ('tag', workload.new_object(), workload.some_tags()),
+        'untag': lambda: ('untag', workload.object(), workload.some_tags()),
+        'bulk_apply': lambda: ('bulk_apply', [BulkOperation(BulkOperationType.TAG, object_name=workload.object(),
+                                                            tags=workload.some_tags()) for _ in range(100)]),
+        'remove_object': lambda: ('remove_object', workload.object()),
+    }
+    results = {}
+    storage_call = functools.partial(call, storage)
+    for method, make_args in list(reads.items()) + list(writes.items()):
+        results[method] = await measure_calls(operations, storage_call, make_args)
+    # Popular tags are on most objects, a few removals of them are enough
+    results['remove_tag'] = await measure_calls(min(operations, 10), storage_call,
+                                                lambda: ('remove_tag', workload.tag()))
+    return results
+
+
+async def measure_http(storage: TagStorage, workload: Workload, operations: int, concurrency: int) -> Dict:
+    try:
+        import httpx
+    except ImportError:
+        return {'skipped': "httpx is not installed"}
+    from app.create_app import create_app
+
+    requests = {
+        'GET /tags': lambda: ('GET', '/tags', {'params': {'after': workload.tag()}}),
+        'GET /objects': lambda: ('GET', '/objects', {'params': {'after': workload.object()}}),
+        'GET /objects?all': lambda: ('GET', '/objects', {'params': {'all': workload.some_tags()}}),
+        'GET /tags/{tag}/objects': lambda: ('GET', f'/tags/{workload.tag()}/objects', {}),
+        'GET /objects/{object}/tags': lambda: ('GET', f'/objects/{workload.object()}/tags', {}),
+        'POST /objects/tags:batchGet': lambda: ('POST', '/objects/tags:batchGet',
+                                                {'json': {'keys': [workload.object() for _ in range(200)]}}),
+        'GET /tags/top': lambda: ('GET', '/tags/top', {}),
+        'GET /tags/{tag}/related': lambda: ('GET', f'/tags/{workload.tag()}/related', {}),
+        'POST /objects/{object}/tags': lambda: ('POST', f'/objects/{workload.object()}/tags',
+                                                {'json': workload.some_tags()}),
+    }
+    results = {}
+    async with httpx.AsyncClient(app=create_app(storage), base_url='http://benchmark') as client:
+        for name, make_request in requests.items():
+            recorder = LatencyRecorder()
+            remaining = iter(range(operations))
+
+            async def send_requests():
+                for _ in remaining:
+                    method, url, kwargs = make_request()
+                    with recorder.call():
+                        response = await client.request(method, url, **kwargs)
+                    response.raise_for_status()
+
+            with recorder.run():
+                await asyncio.gather(*[send_requests() for _ in range(concurrency)])
+            results[name] = recorder.summary()
+    return results
+
+
+async def measure_syncs(storage: PickledSetTagStorage, syncs: int) -> Dict:
+    results = {}
+    for method in ('offline_sync', 'online_sync'):
+        async def sync():
+            # Clean stores skip the snapshot, the same data is written again
+            storage.dirty = True
+            await getattr(storage, method)()
+        results[method] = await measure_calls(syncs, sync, tuple)
+    results['file_bytes'] = os.path.getsize(storage.db_path)
+    if storage.journal is not None and os.path.exists(storage.journal.path):
+        results['journal_bytes'] = os.path.getsize(storage.journal.path)
+    return results
+
+
+async def measure_open(name: str, path: str) -> Dict:
+    results = {}
+    # With a journal close() leaves the changes since the last checkpoint in it, and they are replayed when opened
+    for key in ('open_ms', 'open_after_snapshot_ms'):
+        if key == 'open_ms' and os.path.exists(f"{path}.journal"):
+            results['open_journal_bytes'] = os.path.getsize(f"{path}.journal")
+        start = time.perf_counter()
+        storage = PickledSetTagStorage(pickle_config(name, path))
+        results[key] = (time.perf_counter() - start) * 1000
+        storage.dirty = True
+        await storage.offline_sync()
+        await storage.close()
+    return results
+
+
+async def run_storage(name: str, config: SuiteConfig, temp_dir: str) -> Dict:
+    try:
+        storage = open_storage(name, config, temp_dir)
+    except StorageUnavailable as e:
+        return {'skipped': str(e)}
+    workload = Workload(config.dataset)
+    pickle_storage = storage.storage if isinstance(storage, CachingAsyncTagStorage) else storage
+    results = {'load': await load(storage, config.dataset)}
+    try:
+        if isinstance(pickle_storage, PickledSetTagStorage):
+            # Of the loaded dataset, before the writes change its size
+            results['sync'] = await measure_syncs(pickle_storage, config.syncs)
+        results['methods'] = await measure_methods(storage, workload, config.operations)
+        if config.http:
+            results['http'] = await measure_http(storage, workload, config.operations, config.concurrency)
+    finally:
+        await call(storage, 'close')
+    if isinstance(pickle_storage, PickledSetTagStorage):
+        results['sync'].update(await measure_open(name, pickle_storage.db_path))
+    return results
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_suite(storages: List[str], config: SuiteConfig) -> Dict:
+    results = {
+        'environment': {'commit': current_commit(), 'python': platform.python_version(),
+                        'platform': platform.platform()},
+        'config': dataclasses.asdict(config),
+        'storages': {},
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in storages:
+            results['storages'][name] = await run_storage(name, config, temp_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storages',
+                        default='pickle,pickle-compact,pickle-journal,pickle-mapped,pickle-cached,sqlite,neo4j',
+                        help=f"Comma separated, of {', '.join(STORAGES)}")
+    parser.add_argument('--objects', type=int, default=DatasetConfig.objects)
+    parser.add_argument('--tags', type=int, default=DatasetConfig.tags)
+    parser.add_argument('--tags-per-object', type=int, default=DatasetConfig.tags_per_object)
+    parser.add_argument('--zipf-exponent', type=float, default=DatasetConfig.zipf_exponent)
+    parser.add_argument('--seed', type=int, default=DatasetConfig.seed)
+    parser.add_argument('--operations', type=int, default=SuiteConfig.operations, help="Calls of each method")
+    parser.add_argument('--concurrency', type=int, default=SuiteConfig.concurrency, help="Requests in flight")
+    parser.add_argument('--syncs', type=int, default=SuiteConfig.syncs, help="Snapshots of each kind")
+    parser.add_argument('--no-http', action='store_true', help="Skip the requests to the app")
+    parser.add_argument('--neo4j-url', default=None)
+    parser.add_argument('--neo4j-username', default=None)
+    parser.add_argument('--neo4j-password', default=None)
+    parser.add_argument('--wipe-neo4j', action='store_true',
+                        help="Let the graph storages delete the whole graph in --neo4j-url")
+    parser.add_argument('--output', default=None, help="JSON file for the results, they are printed without it")
+    args = parser.parse_args()
+
+    storages = [each.strip() for each in args.storages.split(',') if each.strip()]
+    for each in storages:
+        if each not in STORAGES:
+            parser.error(f"Unknown storage {each}, expected one of {', '.join(STORAGES)}")
+    dataset = DatasetConfig(args.objects, args.tags, args.tags_per_object, args.zipf_exponent, args.seed)
+    config = SuiteConfig(dataset, args.operations, args.concurrency, args.syncs, not args.no_http, args.neo4j_url,
+                         args.neo4j_username, args.neo4j_password, args.wipe_neo4j)
+    results = asyncio.run(run_suite(storages, config))
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import dataclasses
+import enum
+from typing import Collection, List, Optional, Tuple
+
+from tag_storage.base_storage.tag_storage import TagStorageException
+
+
+class InvalidBulkOperation(TagStorageException):
+    pass
+
+
+class BulkOperationType(str, enum.Enum):
+    TAG = 'tag'
+    UNTAG = 'untag'
+    REMOVE_OBJECT = 'remove_object'
+    REMOVE_TAG = 'remove_tag'
+
+
+@dataclasses.dataclass
+class BulkOperation:
+    operation: BulkOperationType
+    object_name: Optional[str] = None  # tag, untag and remove_object
+    tags: List[str] = dataclasses.field(default_factory=list)  # tag and untag
+    tag_name: Optional[str] = None  # remove_tag
+
+    def validate(self):
+        if self.operation == BulkOperationType.REMOVE_TAG:
+            if self.tag_name is None:
+                raise InvalidBulkOperation(f"{self.operation.value} needs a tag_name")
+        elif self.object_name is None:
+            raise InvalidBulkOperation(f"{self.operation.value} needs an object_name")
+
+
+@dataclasses.dataclass
+class BulkOperationResult:
+    ok: bool = True
+    error: Optional[str] = None
+
+
+def validate_bulk_operations(operations: Collection[BulkOperation]) \
+        -> Tuple[List[BulkOperationResult], List[Tuple[BulkOperation, BulkOperationResult]]]:
+    """Results for every operation, and the valid operations with their (still ok) results"""
+    results = []
+    valid = []
+    for operation in operations:
+        result = BulkOperationResult()
+        try:
+            operation.validate()
+        except InvalidBulkOperation as e:
+            result.ok, result.error = False, str(e)
+        else:
+            valid.append((operation, result))
+        results.append(result)
+    return results, valid
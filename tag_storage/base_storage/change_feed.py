@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import dataclasses
+import itertools
+import secrets
+import threading
+from typing import Collection, Deque, List, Optional, Set
+
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+from tag_storage.base_storage.tag_storage import TagStorageException
+
+
+class ChangesLost(TagStorageException):
+    """The changes after the requested one are no longer buffered, or were made by another process or start"""
+
+
+class SubscriberTooSlow(TagStorageException):
+    """The subscriber fell more than queue_size changes behind and was dropped"""
+
+
+@dataclasses.dataclass
+class ChangeFeedConfiguration:
+    buffer_size: int = 10000  # changes kept for the subscribers that resume
+    queue_size: int = 1000  # changes a subscriber can fall behind before it is dropped
+
+
+@dataclasses.dataclass
+class ChangeEvent:
+    epoch: str
+    sequence: int
+    operation: BulkOperationType
+    object_name: Optional[str] = None  # tag, untag and remove_object
+    tags: List[str] = dataclasses.field(default_factory=list)  # tag and untag
+    tag_name: Optional[str] = None  # remove_tag
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class Subscription:
+    """
+    The changes of a ChangeFeed since the subscription, as an async iterator. The changes it can't keep up with are
+    not buffered: after the ones already queued it raises SubscriberTooSlow, and the subscriber can resume from the
+    last one it got while the feed still has the rest.
+    """
+
+    def __init__(self, feed: ChangeFeed, tags: Collection[str], objects: Collection[str]):
+        self.feed = feed
+        self.tags: Set[str] = set(tags)
+        self.objects: Set[str] = set(objects)
+        self.loop = asyncio.get_running_loop()
+        self.queue: Deque[ChangeEvent] = collections.deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+        self.closed = False
+
+    def matches(self, event: ChangeEvent) -> bool:
+        # remove_object events don't carry the tags of the object, nor remove_tag ones its objects, so they reach
+        # every subscriber of the other side
+        if not self.tags and not self.objects:
+            return True
+        if self.objects and (event.object_name in self.objects or event.operation == BulkOperationType.REMOVE_TAG):
+            return True
+        return bool(self.tags) and (event.tag_name in self.tags or not self.tags.isdisjoint(event.tags)
+                                    or event.operation == BulkOperationType.REMOVE_OBJECT)
+
+    def _put(self, events: List[ChangeEvent]):
+        # In the loop of the subscriber
+        if self.overflowed or self.closed:
+            return
+        for event in events:
+            if not self.matches(event):
+                continue
+            if len(self.queue) >= self.feed.config.queue_size:
+                self.overflowed = True
+                self.feed.unsubscribe(self)
+                break
+            self.queue.append(event)
+        self.ready.set()
+
+    def __aiter__(self) -> Subscription:
+        return self
+
+    async def __anext__(self) -> ChangeEvent:
+        while not self.queue:
+            if self.overflowed:
+                raise SubscriberTooSlow(f"More than {self.feed.config.queue_size} changes were waiting")
+            if self.closed:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        return self.queue.popleft()
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.feed.unsubscribe(self)
+        self.ready.set()
+
+
+class ChangeFeed:
+    """
+    The writes made through a storage, numbered in the order they were applied, for the subscribers that mirror
+    it. The last buffer_size are kept so a subscriber that reconnects resumes after the last one it got. Storages
+    publish from the event loop or from the threads of the pool, the subscribers get them in their loop.
+    """
+    config: ChangeFeedConfiguration
+    epoch: str  # sequences start again in every process
+    sequence: int  # of the last change
+    buffer: Deque[ChangeEvent]
+    subscribers: Set[Subscription]
+
+    def __init__(self, config: Optional[ChangeFeedConfiguration] = None):
+        self.config = config or ChangeFeedConfiguration()
+        self.epoch = secrets.token_hex(8)
+        self.sequence = 0
+        self.buffer = collections.deque(maxlen=self.config.buffer_size)
+        self.subscribers = set()
+        self.lock = threading.RLock()  # a subscriber that overflows unsubscribes while it is published to
+
+    def publish(self, operations: Collection[BulkOperation]):
+        """The operations were applied, in this order"""
+        if not operations:
+            return
+        loop = _running_loop()
+        with self.lock:
+            events = []
+            for operation in operations:
+                self.sequence += 1
+                events.append(ChangeEvent(self.epoch, self.sequence, operation.operation, operation.object_name,
+                                          list(operation.tags), operation.tag_name))
+            self.buffer.extend(events)
+            # Under the lock, so the events of concurrent writes reach every subscriber in the same order
+            for subscriber in list(self.subscribers):
+                if subscriber.loop is loop:
+                    subscriber._put(events)
+                    continue
+                try:
+                    subscriber.loop.call_soon_threadsafe(subscriber._put, events)
+                except RuntimeError:  # its loop is closed
+                    self.subscribers.discard(subscriber)
+
+    def subscribe(self, after: Optional[int] = None, epoch: Optional[str] = None, tags: Collection[str] = (),
+                  objects: Collection[str] = ()) -> Subscription:
+        """
+        The changes after sequence `after`, of `epoch` when given, or the ones from now on. Only those of tags or
+        objects when given. Raises ChangesLost when they can't be resumed.
+        """
+        subscription = Subscription(self, tags, objects)
+        with self.lock:
+            if after is not None:
+                oldest = self.buffer[0].sequence if self.buffer else self.sequence + 1
+                if (epoch is not None and epoch != self.epoch) or after > self.sequence or after < oldest - 1:
+                    raise ChangesLost(f"The changes after {after} are not in the feed, it has the ones since "
+                                      f"{oldest} of epoch {self.epoch}")
+                # The buffered sequences are consecutive
+                subscription._put(list(itertools.islice(self.buffer, max(after - oldest + 1, 0), None)))
+            if not subscription.overflowed:
+                self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
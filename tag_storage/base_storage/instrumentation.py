@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import contextlib
+import time
+from typing import ContextManager, Dict, Tuple
+
+# Names, kinds and help of what the storages report, the labels are in parentheses
+HISTOGRAM = 'histogram'
+GAUGE = 'gauge'
+COUNTER = 'counter'
+METRICS: Dict[str, Tuple[str, str]] = {
+    'tagapi_http_request_duration_seconds': (HISTOGRAM, "Requests to the api (method, path, status)"),
+    'tagapi_lock_wait_seconds': (HISTOGRAM, "Time waited for the snapshot lock of a pickle storage "
+                                            "(mode: shared, exclusive)"),
+    'tagapi_lock_hold_seconds': (HISTOGRAM, "Time the snapshot lock of a pickle storage was held "
+                                            "(mode: shared, exclusive)"),
+    'tagapi_sync_duration_seconds': (HISTOGRAM, "Syncs of a pickle storage that wrote a snapshot "
+                                                "(mode: online, offline)"),
+    'tagapi_sync_failures_total': (COUNTER, "Syncs of a pickle storage that failed"),
+    'tagapi_snapshot_bytes': (GAUGE, "Size of the last snapshot of a pickle storage"),
+    'tagapi_journal_bytes': (GAUGE, "Size of the journal of a pickle storage"),
+    'tagapi_dirty_age_seconds': (GAUGE, "Time since the first change of a pickle storage after its last snapshot"),
+    'tagapi_tags': (GAUGE, "Tags in the storage"),
+    'tagapi_objects': (GAUGE, "Tagged objects in the storage"),
+    'tagapi_query_duration_seconds': (HISTOGRAM, "Queries to a graph database (storage, query)"),
+    'tagapi_cache_hits_total': (COUNTER, "Pages served by the read cache"),
+    'tagapi_cache_misses_total': (COUNTER, "Pages the read cache had to read from the storage"),
+    'tagapi_cache_evictions_total': (COUNTER, "Pages evicted from the read cache"),
+}
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class Instrumentation:
+    """
+    Where storages report how long things take and how big they are. This one drops everything: it is what they
+    report to until they are instrumented, and code that would have to measure something checks `enabled` first.
+    """
+    enabled = False
+
+    def observe(self, name: str, value: float, **labels: str):
+        """A value of a histogram"""
+
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        """A counter"""
+
+    def set(self, name: str, value: float, **labels: str):
+        """A gauge, or a counter whose total is kept elsewhere"""
+
+    def timer(self, name: str, **labels: str) -> ContextManager:
+        """Observes the time spent in the block"""
+        if not self.enabled:
+            return _NOT_TIMED
+        return self.__timed(name, labels)
+
+    @contextlib.contextmanager
+    def __timed(self, name: str, labels: Dict[str, str]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+NULL_INSTRUMENTATION = Instrumentation()
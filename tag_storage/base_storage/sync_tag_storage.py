@@ -1,20 +1,78 @@
-from typing import Collection
+from typing import Collection, Dict, Optional, List, Tuple
 
-from tag_storage.base_storage.tag_storage import TagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+from tag_storage.base_storage.tag_storage import TagStorage, TagStorageException
 
 
 class SyncTagStorage(TagStorage):
+    # Listings are sorted by name. `after` is a keyset cursor: only names greater than it are listed, and offset
+    # counts from there. `prefix`, `start` (inclusive) and `end` (exclusive) restrict the listed names.
 
-    def get_tags(self, limit: int = 100, offset: int = 0) -> Collection[str]:
+    def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                 prefix: Optional[str] = None, start: Optional[str] = None,
+                 end: Optional[str] = None) -> Collection[str]:
         raise NotImplementedError
 
-    def get_objects(self, limit: int = 100, offset: int = 0) -> Collection[str]:
+    def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                    prefix: Optional[str] = None, start: Optional[str] = None,
+                    end: Optional[str] = None) -> Collection[str]:
         raise NotImplementedError
 
-    def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0) -> Collection[str]:
+    def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                           prefix: Optional[str] = None, start: Optional[str] = None,
+                           end: Optional[str] = None) -> Collection[str]:
         raise NotImplementedError
 
-    def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0) -> Collection[str]:
+    def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                        after: Optional[str] = None, prefix: Optional[str] = None,
+                        start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        raise NotImplementedError
+
+    def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                      none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                      after: Optional[str] = None, prefix: Optional[str] = None,
+                      start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        """Objects tagged with every tag in all_tags, at least one of any_tags (if any) and none of none_tags"""
+        raise NotImplementedError
+
+    def get_objects_with_tags(self, limit: int = 100,
+                              after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        """A page of objects, as in get_objects, with all their tags"""
+        # Storages override it to read the page at once
+        records = []
+        for name in self.get_objects(limit, 0, after):
+            tags = []
+            while True:
+                page = self.get_object_tags(name, limit, 0, tags[-1] if tags else None)
+                tags.extend(page)
+                if len(page) < limit:
+                    break
+            records.append((name, tags))
+        return records
+
+    def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        """The first limit objects of each tag, as in get_tagged_objects, by tag in the order given"""
+        # One call per tag, storages override it to read them at once
+        return {tag: list(self.get_tagged_objects(tag, limit)) for tag in dict.fromkeys(tags)}
+
+    def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        """The first limit tags of each object, as in get_object_tags, by object in the order given"""
+        return {name: list(self.get_object_tags(name, limit)) for name in dict.fromkeys(tagged_objects)}
+
+    def count_tagged_objects(self, tag: str) -> int:
+        raise NotImplementedError
+
+    def count_object_tags(self, tagged_object: str) -> int:
+        raise NotImplementedError
+
+    def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        """The k tags with most objects, ties sorted by name"""
+        raise NotImplementedError
+
+    def get_related_tags(self, tag: str, k: int = 10,
+                         score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        """The k tags with most objects in common with tag, or with the highest score, ties sorted by name"""
         raise NotImplementedError
 
     def tag(self, object_to_tag: str, tags: Collection[str]):
@@ -29,5 +87,25 @@ class SyncTagStorage(TagStorage):
     def remove_tag(self, tag_to_remove: str):
         raise NotImplementedError
 
+    def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        # One call per operation, storages override it to apply the whole batch at once
+        results = []
+        for operation in operations:
+            try:
+                operation.validate()
+                if operation.operation == BulkOperationType.TAG:
+                    self.tag(operation.object_name, operation.tags)
+                elif operation.operation == BulkOperationType.UNTAG:
+                    self.untag(operation.object_name, operation.tags)
+                elif operation.operation == BulkOperationType.REMOVE_OBJECT:
+                    self.remove_object(operation.object_name)
+                else:
+                    self.remove_tag(operation.tag_name)
+            except TagStorageException as e:
+                results.append(BulkOperationResult(ok=False, error=str(e)))
+            else:
+                results.append(BulkOperationResult())
+        return results
+
     def close(self):
         raise NotImplementedError
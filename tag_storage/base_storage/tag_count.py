@@ -0,0 +1,20 @@
+import dataclasses
+import enum
+
+
+@dataclasses.dataclass
+class TagCount:
+    tag: str
+    count: int  # objects tagged with it
+
+
+class RelatedScore(str, enum.Enum):
+    COUNT = 'count'  # objects tagged with both
+    JACCARD = 'jaccard'  # objects tagged with both over objects tagged with either
+
+
+@dataclasses.dataclass
+class RelatedTag:
+    tag: str
+    count: int  # objects tagged with it and with the tag it is related to
+    score: float
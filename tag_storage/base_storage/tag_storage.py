@@ -1,6 +1,14 @@
 from __future__ import annotations
 
 from abc import ABC
+from typing import TYPE_CHECKING, Collection, Optional
+
+from tag_storage.base_storage.instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from tag_storage.base_storage.versions import Versions
+
+if TYPE_CHECKING:
+    from tag_storage.base_storage.bulk_operation import BulkOperation
+    from tag_storage.base_storage.change_feed import ChangeFeed
 
 
 class TagStorageException(Exception):
@@ -8,4 +16,24 @@ class TagStorageException(Exception):
 
 
 class TagStorage(ABC):
-    pass
+    instrumentation: Instrumentation = NULL_INSTRUMENTATION
+    # Kept by the storages that see every change of their data, the others can't tell what changed
+    versions: Optional[Versions] = None
+    changes: Optional[ChangeFeed] = None
+
+    def watch_changes(self, feed: ChangeFeed):
+        """Publish the writes made through this storage to feed from now on, wrappers pass it to the storage they
+        wrap"""
+        self.changes = feed
+
+    def _publish(self, operations: Collection[BulkOperation]):
+        # The storages call it once the operations are applied
+        if self.changes is not None:
+            self.changes.publish(operations)
+
+    def instrument(self, instrumentation: Instrumentation):
+        """Report to instrumentation from now on, wrappers pass it to the storage they wrap"""
+        self.instrumentation = instrumentation
+
+    def collect_metrics(self):
+        """Sets the gauges that are read rather than reported, like the number of tags, before they are exposed"""
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import collections
+import secrets
+from typing import Collection, Optional
+
+
+class Versions:
+    """
+    Versions of each tag, of each object and of the whole storage, which grow with every change: that of a tag
+    when its objects change and that of an object when its tags do. Only the last max_names names changed on each
+    side are remembered, the others report the newest version forgotten, so no version ever goes back. The epoch
+    tells apart the versions of different processes, and of each start of one.
+    """
+    epoch: str
+    version: int  # of the whole storage
+    forgotten: int
+
+    def __init__(self, max_names: int = 100000):
+        self.epoch = secrets.token_hex(8)
+        self.version = 0
+        self.forgotten = 0
+        self.max_names = max_names
+        self.tags = collections.OrderedDict()
+        self.objects = collections.OrderedDict()
+
+    def changed(self, tags: Collection[str] = (), objects: Collection[str] = ()):
+        self.version += 1
+        for names, changed in ((self.tags, tags), (self.objects, objects)):
+            if len(changed) > self.max_names:
+                names.clear()
+                self.forgotten = self.version
+                continue
+            for each in changed:
+                names[each] = self.version
+                names.move_to_end(each)
+            while len(names) > self.max_names:
+                _, version = names.popitem(last=False)
+                self.forgotten = max(self.forgotten, version)
+
+    def reset(self):
+        """Everything changed, as when the data is loaded again"""
+        self.version += 1
+        self.tags.clear()
+        self.objects.clear()
+        self.forgotten = self.version
+
+    def of_tag(self, tag: str) -> int:
+        return self.tags.get(tag, self.forgotten)
+
+    def of_object(self, tagged_object: str) -> int:
+        return self.objects.get(tagged_object, self.forgotten)
+
+    def etag(self, tag: Optional[str] = None, tagged_object: Optional[str] = None) -> str:
+        """A weak ETag of the listings of tag, of tagged_object or, without them, of the whole storage"""
+        if tag is not None:
+            version = self.of_tag(tag)
+        elif tagged_object is not None:
+            version = self.of_object(tagged_object)
+        else:
+            version = self.version
+        return f'W/"{self.epoch}-{version}"'
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+from typing import Awaitable, Callable, Collection, Dict, List, Optional, Tuple
+
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType
+from tag_storage.base_storage.sync_tag_storage import SyncTagStorage
+from tag_storage.base_storage.instrumentation import Instrumentation
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+from tag_storage.base_storage.tag_storage import TagStorage
+from tag_storage.base_storage.change_feed import ChangeFeed
+from tag_storage.base_storage.versions import Versions
+from tag_storage.caching_storage import page_cache
+from tag_storage.caching_storage.page_cache import PageCache, PageCacheConfiguration, PageCacheStats, Listing
+
+
+def query_listing(all_tags: Collection[str], any_tags: Collection[str], none_tags: Collection[str]) -> Listing:
+    return page_cache.QUERY, (tuple(sorted(set(all_tags))), tuple(sorted(set(any_tags))),
+                              tuple(sorted(set(none_tags))))
+
+
+class _CachedListings:
+    """What each write changes, shared by the async and the sync wrappers"""
+    cache: PageCache
+    storage: TagStorage
+    instrumentation: Instrumentation
+
+    def instrument(self, instrumentation: Instrumentation):
+        self.instrumentation = instrumentation
+        self.storage.instrument(instrumentation)
+
+    def collect_metrics(self):
+        self.instrumentation.set('tagapi_cache_hits_total', self.cache.stats.hits)
+        self.instrumentation.set('tagapi_cache_misses_total', self.cache.stats.misses)
+        self.instrumentation.set('tagapi_cache_evictions_total', self.cache.stats.evictions)
+        self.storage.collect_metrics()
+
+    @property
+    def versions(self) -> Optional[Versions]:
+        return self.storage.versions
+
+    def watch_changes(self, feed: ChangeFeed):
+        self.storage.watch_changes(feed)
+
+    @property
+    def changes(self) -> Optional[ChangeFeed]:
+        return self.storage.changes
+
+    @property
+    def stats(self) -> PageCacheStats:
+        return self.cache.stats
+
+    def _cached_pages(self, method: str, names: Collection[str], limit: int) -> Tuple[Dict[str, List[str]], List[str]]:
+        # The first pages of the single listings, and the names that have none
+        found, missing = {}, []
+        for name in dict.fromkeys(names):
+            page = self.cache.get((method, name, limit, 0, None, None, None, None))
+            if page is None:
+                missing.append(name)
+            else:
+                found[name] = list(page)
+        return found, missing
+
+    def _put_pages(self, method: str, pages: Dict[str, List[str]], limit: int, generation: int):
+        for name, page in pages.items():
+            self.cache.put((method, name, limit, 0, None, None, None, None), (method, name), page, limit, None,
+                           generation)
+
+    def _invalidate_tag(self, tagged_object: str, tags: Collection[str]):
+        self.cache.invalidate((page_cache.OBJECTS, None), [tagged_object])
+        self.cache.invalidate((page_cache.TAGS, None), tags)
+        self._invalidate_edges(tagged_object, tags)
+
+    def _invalidate_edges(self, tagged_object: str, tags: Collection[str]):
+        self.cache.invalidate((page_cache.OBJECT_TAGS, tagged_object), tags)
+        for each in tags:
+            self.cache.invalidate((page_cache.TAGGED_OBJECTS, each), [tagged_object])
+        self.cache.invalidate_method(page_cache.QUERY, tagged_object)
+
+    def _invalidate_remove_object(self, object_to_remove: str):
+        # The tags of the object are not known, so every tag listing where it would sort is dropped
+        self.cache.invalidate((page_cache.OBJECT_TAGS, object_to_remove))
+        self.cache.invalidate((page_cache.OBJECTS, None), [object_to_remove])
+        self.cache.invalidate_method(page_cache.TAGGED_OBJECTS, object_to_remove)
+        self.cache.invalidate_method(page_cache.QUERY, object_to_remove)
+
+    def _invalidate_remove_tag(self, tag_to_remove: str):
+        self.cache.invalidate((page_cache.TAGGED_OBJECTS, tag_to_remove))
+        self.cache.invalidate((page_cache.TAGS, None), [tag_to_remove])
+        self.cache.invalidate_method(page_cache.OBJECT_TAGS, tag_to_remove)
+        self.cache.invalidate_method(page_cache.QUERY)
+
+    def _invalidate_bulk(self, operations: Collection[BulkOperation]):
+        for operation in operations:
+            if operation.operation == BulkOperationType.TAG and operation.object_name is not None:
+                self._invalidate_tag(operation.object_name, operation.tags)
+            elif operation.operation == BulkOperationType.UNTAG and operation.object_name is not None:
+                self._invalidate_edges(operation.object_name, operation.tags)
+            elif operation.operation == BulkOperationType.REMOVE_OBJECT and operation.object_name is not None:
+                self._invalidate_remove_object(operation.object_name)
+            elif operation.operation == BulkOperationType.REMOVE_TAG and operation.tag_name is not None:
+                self._invalidate_remove_tag(operation.tag_name)
+
+
+class CachingAsyncTagStorage(_CachedListings, AsyncTagStorage):
+    """
+    Read-through cache of the pages listed by another storage. Writes must go through it, the pages changed
+    by writes made elsewhere are served until their ttl expires.
+    """
+    storage: AsyncTagStorage
+
+    def __init__(self, storage: AsyncTagStorage, config: Optional[PageCacheConfiguration] = None):
+        self.storage = storage
+        self.cache = PageCache(config or PageCacheConfiguration())
+
+    async def __read(self, listing: Listing, limit: int, offset: int, after: Optional[str], prefix: Optional[str],
+                     start: Optional[str], end: Optional[str],
+                     read: Callable[[], Awaitable[Collection[str]]]) -> Collection[str]:
+        key = listing + (limit, offset, after, prefix, start, end)
+        names = self.cache.get(key)
+        if names is not None:
+            return list(names)
+        generation = self.cache.generation
+        names = await read()
+        self.cache.put(key, listing, names, limit, after, generation, prefix, start, end)
+        return names
+
+    async def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                       prefix: Optional[str] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Collection[str]:
+        return await self.__read((page_cache.TAGS, None), limit, offset, after, prefix, start, end,
+                                 lambda: self.storage.get_tags(limit, offset, after, prefix, start, end))
+
+    async def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                          prefix: Optional[str] = None, start: Optional[str] = None,
+                          end: Optional[str] = None) -> Collection[str]:
+        return await self.__read((page_cache.OBJECTS, None), limit, offset, after, prefix, start, end,
+                                 lambda: self.storage.get_objects(limit, offset, after, prefix, start, end))
+
+    async def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                                 prefix: Optional[str] = None, start: Optional[str] = None,
+                                 end: Optional[str] = None) -> Collection[str]:
+        return await self.__read((page_cache.TAGGED_OBJECTS, tag), limit, offset, after, prefix, start, end,
+                                 lambda: self.storage.get_tagged_objects(tag, limit, offset, after, prefix, start,
+                                                                         end))
+
+    async def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                              after: Optional[str] = None, prefix: Optional[str] = None,
+                              start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self.__read((page_cache.OBJECT_TAGS, tagged_object), limit, offset, after, prefix, start, end,
+                                 lambda: self.storage.get_object_tags(tagged_object, limit, offset, after, prefix,
+                                                                      start, end))
+
+    async def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                            none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                            after: Optional[str] = None, prefix: Optional[str] = None,
+                            start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self.__read(query_listing(all_tags, any_tags, none_tags), limit, offset, after, prefix, start,
+                                 end,
+                                 lambda: self.storage.query_objects(all_tags, any_tags, none_tags, limit, offset,
+                                                                    after, prefix, start, end))
+
+    async def get_objects_with_tags(self, limit: int = 100,
+                                    after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        # Exports walk the whole storage, their pages would only evict the hot ones
+        return await self.storage.get_objects_with_tags(limit, after)
+
+    async def __read_many(self, method: str, names: Collection[str], limit: int,
+                          read: Callable[[List[str], int], Awaitable[Dict[str, List[str]]]]) -> Dict[str, List[str]]:
+        # The pages that are not cached are read in one batch
+        pages, missing = self._cached_pages(method, names, limit)
+        if missing:
+            generation = self.cache.generation
+            read_pages = await read(missing, limit)
+            self._put_pages(method, read_pages, limit, generation)
+            pages.update(read_pages)
+        return {name: pages[name] for name in dict.fromkeys(names)}
+
+    async def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return await self.__read_many(page_cache.TAGGED_OBJECTS, tags, limit, self.storage.get_many_tagged_objects)
+
+    async def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return await self.__read_many(page_cache.OBJECT_TAGS, tagged_objects, limit,
+                                      self.storage.get_many_object_tags)
+
+    async def count_tagged_objects(self, tag: str) -> int:
+        return await self.storage.count_tagged_objects(tag)
+
+    async def count_object_tags(self, tagged_object: str) -> int:
+        return await self.storage.count_object_tags(tagged_object)
+
+    async def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return await self.storage.get_top_tags(k)
+
+    async def get_related_tags(self, tag: str, k: int = 10,
+                               score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        return await self.storage.get_related_tags(tag, k, score)
+
+    # Pages are invalidated once the write is done, a read racing with it is not cached (see PageCache)
+    async def tag(self, object_to_tag: str, tags: Collection[str]):
+        try:
+            await self.storage.tag(object_to_tag, tags)
+        finally:
+            self._invalidate_tag(object_to_tag, tags)
+
+    async def untag(self, object_to_untag: str, tags: Collection[str]):
+        try:
+            await self.storage.untag(object_to_untag, tags)
+        finally:
+            self._invalidate_edges(object_to_untag, tags)
+
+    async def remove_object(self, object_to_remove: str):
+        try:
+            await self.storage.remove_object(object_to_remove)
+        finally:
+            self._invalidate_remove_object(object_to_remove)
+
+    async def remove_tag(self, tag_to_remove: str):
+        try:
+            await self.storage.remove_tag(tag_to_remove)
+        finally:
+            self._invalidate_remove_tag(tag_to_remove)
+
+    async def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        try:
+            return await self.storage.bulk_apply(operations)
+        finally:
+            self._invalidate_bulk(operations)
+
+    async def close(self):
+        self.cache.clear()
+        await self.storage.close()
+
+
+class CachingSyncTagStorage(_CachedListings, SyncTagStorage):
+    """Same as CachingAsyncTagStorage, for the storages with a blocking api"""
+    storage: SyncTagStorage
+
+    def __init__(self, storage: SyncTagStorage, config: Optional[PageCacheConfiguration] = None):
+        self.storage = storage
+        self.cache = PageCache(config or PageCacheConfiguration())
+
+    def __read(self, listing: Listing, limit: int, offset: int, after: Optional[str], prefix: Optional[str],
+               start: Optional[str], end: Optional[str], read: Callable[[], Collection[str]]) -> Collection[str]:
+        key = listing + (limit, offset, after, prefix, start, end)
+        names = self.cache.get(key)
+        if names is not None:
+            return list(names)
+        generation = self.cache.generation
+        names = read()
+        self.cache.put(key, listing, names, limit, after, generation, prefix, start, end)
+        return names
+
+    def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                 prefix: Optional[str] = None, start: Optional[str] = None,
+                 end: Optional[str] = None) -> Collection[str]:
+        return self.__read((page_cache.TAGS, None), limit, offset, after, prefix, start, end,
+                           lambda: self.storage.get_tags(limit, offset, after, prefix, start, end))
+
+    def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                    prefix: Optional[str] = None, start: Optional[str] = None,
+                    end: Optional[str] = None) -> Collection[str]:
+        return self.__read((page_cache.OBJECTS, None), limit, offset, after, prefix, start, end,
+                           lambda: self.storage.get_objects(limit, offset, after, prefix, start, end))
+
+    def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                           prefix: Optional[str] = None, start: Optional[str] = None,
+                           end: Optional[str] = None) -> Collection[str]:
+        return self.__read((page_cache.TAGGED_OBJECTS, tag), limit, offset, after, prefix, start, end,
+                           lambda: self.storage.get_tagged_objects(tag, limit, offset, after, prefix, start,
+                                                                   end))
+
+    def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                        after: Optional[str] = None, prefix: Optional[str] = None,
+                        start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return self.__read((page_cache.OBJECT_TAGS, tagged_object), limit, offset, after, prefix, start, end,
+                           lambda: self.storage.get_object_tags(tagged_object, limit, offset, after, prefix,
+                                                                start, end))
+
+    def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                      none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                      after: Optional[str] = None, prefix: Optional[str] = None,
+                      start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return self.__read(query_listing(all_tags, any_tags, none_tags), limit, offset, after, prefix, start, end,
+                           lambda: self.storage.query_objects(all_tags, any_tags, none_tags, limit, offset,
+                                                              after, prefix, start, end))
+
+    def get_objects_with_tags(self, limit: int = 100, after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        return self.storage.get_objects_with_tags(limit, after)
+
+    def __read_many(self, method: str, names: Collection[str], limit: int,
+                    read: Callable[[List[str], int], Dict[str, List[str]]]) -> Dict[str, List[str]]:
+        pages, missing = self._cached_pages(method, names, limit)
+        if missing:
+            generation = self.cache.generation
+            read_pages = read(missing, limit)
+            self._put_pages(method, read_pages, limit, generation)
+            pages.update(read_pages)
+        return {name: pages[name] for name in dict.fromkeys(names)}
+
+    def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return self.__read_many(page_cache.TAGGED_OBJECTS, tags, limit, self.storage.get_many_tagged_objects)
+
+    def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return self.__read_many(page_cache.OBJECT_TAGS, tagged_objects, limit, self.storage.get_many_object_tags)
+
+    def count_tagged_objects(self, tag: str) -> int:
+        return self.storage.count_tagged_objects(tag)
+
+    def count_object_tags(self, tagged_object: str) -> int:
+        return self.storage.count_object_tags(tagged_object)
+
+    def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return self.storage.get_top_tags(k)
+
+    def get_related_tags(self, tag: str, k: int = 10, score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        return self.storage.get_related_tags(tag, k, score)
+
+    def tag(self, object_to_tag: str, tags: Collection[str]):
+        try:
+            self.storage.tag(object_to_tag, tags)
+        finally:
+            self._invalidate_tag(object_to_tag, tags)
+
+    def untag(self, object_to_untag: str, tags: Collection[str]):
+        try:
+            self.storage.untag(object_to_untag, tags)
+        finally:
+            self._invalidate_edges(object_to_untag, tags)
+
+    def remove_object(self, object_to_remove: str):
+        try:
+            self.storage.remove_object(object_to_remove)
+        finally:
+            self._invalidate_remove_object(object_to_remove)
+
+    def remove_tag(self, tag_to_remove: str):
+        try:
+            self.storage.remove_tag(tag_to_remove)
+        finally:
+            self._invalidate_remove_tag(tag_to_remove)
+
+    def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        try:
+            return self.storage.bulk_apply(operations)
+        finally:
+            self._invalidate_bulk(operations)
+
+    def close(self):
+        self.cache.clear()
+        self.storage.close()
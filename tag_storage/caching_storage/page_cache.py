@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Collection, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Listings a page can belong to. Pages of TAGGED_OBJECTS and OBJECT_TAGS are indexed by the name they list,
+# the others by None.
+TAGS = 'get_tags'
+OBJECTS = 'get_objects'
+TAGGED_OBJECTS = 'get_tagged_objects'
+OBJECT_TAGS = 'get_object_tags'
+QUERY = 'query_objects'
+
+Listing = Tuple[str, Optional[Hashable]]
+CacheKey = Tuple
+
+
+@dataclasses.dataclass
+class PageCacheConfiguration:
+    max_entries: int = 10000
+    ttl: float = 60.0  # seconds
+
+
+@dataclasses.dataclass
+class PageCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+@dataclasses.dataclass
+class _Page:
+    listing: Listing
+    names: List[str]
+    limit: int
+    after: Optional[str]
+    expires_at: float
+    prefix: Optional[str] = None
+    start: Optional[str] = None
+    end: Optional[str] = None
+
+    def contains_position_of(self, name: str) -> bool:
+        # Adding or removing `name` in the listing only changes this page if it is in the listed range, sorts
+        # after the cursor and not after the last name of a full page
+        if (self.after is not None and name <= self.after) or (self.start is not None and name < self.start) \
+                or (self.end is not None and name >= self.end) \
+                or (self.prefix is not None and not name.startswith(self.prefix)):
+            return False
+        return len(self.names) < self.limit or name <= self.names[-1]
+
+
+class PageCache:
+    """
+    Bounded LRU of listing pages with a time to live. Writes invalidate the pages of the listings they change,
+    and within a listing only the pages where the written name sorts.
+
+    A page read while a write is running is not cached: every invalidation bumps a generation and a page is
+    only stored if the generation did not change since its read started. It is thread safe, the sync storages
+    are called from a thread pool.
+    """
+    config: PageCacheConfiguration
+    stats: PageCacheStats
+    pages: OrderedDict[CacheKey, _Page]
+    listings: Dict[Listing, Set[CacheKey]]
+    generation: int
+
+    def __init__(self, config: PageCacheConfiguration, clock: Callable[[], float] = time.monotonic):
+        self.config = config
+        self.clock = clock
+        self.stats = PageCacheStats()
+        self.pages = OrderedDict()
+        self.listings = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: CacheKey) -> Optional[List[str]]:
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None and page.expires_at <= self.clock():
+                self.__drop(key)
+                page = None
+            if page is None:
+                self.stats.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.stats.hits += 1
+            return page.names
+
+    def put(self, key: CacheKey, listing: Listing, names: Collection[str], limit: int, after: Optional[str],
+            generation: int, prefix: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None):
+        if self.config.max_entries <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.pages:
+                self.__drop(key)
+            self.pages[key] = _Page(listing, list(names), limit, after, self.clock() + self.config.ttl, prefix,
+                                    start, end)
+            self.listings.setdefault(listing, set()).add(key)
+            while len(self.pages) > self.config.max_entries:
+                self.__drop(next(iter(self.pages)))
+                self.stats.evictions += 1
+
+    def invalidate(self, listing: Listing, names: Optional[Iterable[str]] = None):
+        """Drops the pages of a listing where any of the names sorts, or all of them when names is None"""
+        names = None if names is None else list(names)
+        with self.lock:
+            self.generation += 1
+            for key in list(self.listings.get(listing, ())):
+                page = self.pages[key]
+                if names is None or any(page.contains_position_of(name) for name in names):
+                    self.__drop(key)
+                    self.stats.invalidations += 1
+
+    def invalidate_method(self, method: str, name: Optional[str] = None):
+        """Like invalidate, for every listing of a method"""
+        with self.lock:
+            listings = [listing for listing in self.listings if listing[0] == method]
+        for listing in listings:
+            self.invalidate(listing, None if name is None else [name])
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.pages.clear()
+            self.listings.clear()
+
+    def __drop(self, key: CacheKey):
+        page = self.pages.pop(key)
+        keys = self.listings[page.listing]
+        keys.discard(key)
+        if not keys:
+            del self.listings[page.listing]
@@ -0,0 +1,182 @@
+"""
+Cypher statements shared by the graph storages. Tags and objects are nodes with a name and the graph is
+bipartite: (:object)-[:Tagged]->(:tag).
+
+Every function returns the statement and its parameters, listings return the names in their first column.
+"""
+import itertools
+from typing import Any, Collection, Dict, List, Optional, Tuple
+
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+
+TAG = 'tag'
+OBJECT = 'object'
+TAGGED = 'Tagged'
+
+Statement = Tuple[str, Dict[str, Any]]
+
+# Names are looked up on every call and compared against pagination cursors
+CREATE_INDEXES = ["CREATE INDEX IF NOT EXISTS FOR (n:%s) ON (n.name)" % label for label in (TAG, OBJECT)]
+# Neo4j 3.5 / ONgDB 1.0 syntax, creating an index that exists is a no-op there
+LEGACY_CREATE_INDEXES = ["CREATE INDEX ON :%s(name)" % label for label in (TAG, OBJECT)]
+
+# Each statement applies a list of rows, $rows, of the same kind of operation
+TAG_ROWS = "UNWIND $rows AS row MERGE (o:%s {name: row.object_name}) WITH o, row " \
+           "UNWIND row.tags AS tag_name MERGE (t:%s {name: tag_name}) MERGE (o)-[:%s]->(t)" % (OBJECT, TAG, TAGGED)
+UNTAG_ROWS = "UNWIND $rows AS row MATCH (o:%s {name: row.object_name})-[r:%s]->(t:%s) " \
+             "WHERE t.name IN row.tags DELETE r" % (OBJECT, TAGGED, TAG)
+REMOVE_OBJECT_ROWS = "UNWIND $rows AS row MATCH (o:%s {name: row.object_name}) DETACH DELETE o" % OBJECT
+REMOVE_TAG_ROWS = "UNWIND $rows AS row MATCH (t:%s {name: row.tag_name}) DETACH DELETE t" % TAG
+
+
+def _name_filter(after: Optional[str], prefix: Optional[str] = None, start: Optional[str] = None,
+                 end: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+    # Conditions on a.name and their parameters. They are all answered by the name index, STARTS WITH included
+    conditions = [condition for condition, value in (("a.name > $after", after), ("a.name STARTS WITH $prefix", prefix),
+                                                     ("a.name >= $start", start), ("a.name < $end", end))
+                  if value is not None]
+    return " AND ".join(conditions), {'after': after, 'prefix': prefix, 'start': start, 'end': end}
+
+
+def _where(conditions: str) -> str:
+    return "WHERE " + conditions if conditions else ""
+
+
+def get_tags(limit: int, offset: int, after: Optional[str], prefix: Optional[str] = None,
+             start: Optional[str] = None, end: Optional[str] = None) -> Statement:
+    conditions, parameters = _name_filter(after, prefix, start, end)
+    return "MATCH (a:%s) %s RETURN a.name order by a.name skip %d limit %d" % (
+        TAG, _where(conditions), offset, limit), parameters
+
+
+def get_objects(limit: int, offset: int, after: Optional[str], prefix: Optional[str] = None,
+                start: Optional[str] = None, end: Optional[str] = None) -> Statement:
+    conditions, parameters = _name_filter(after, prefix, start, end)
+    return "MATCH (a:%s) %s RETURN a.name order by a.name skip %d limit %d" % (
+        OBJECT, _where(conditions), offset, limit), parameters
+
+
+def get_tagged_objects(tag: str, limit: int, offset: int, after: Optional[str], prefix: Optional[str] = None,
+                       start: Optional[str] = None, end: Optional[str] = None) -> Statement:
+    conditions, parameters = _name_filter(after, prefix, start, end)
+    return "MATCH p=(a)-[:%s]->(:%s {name:$name }) %s RETURN a.name order by a.name skip %d limit %d" % (
+        TAGGED, TAG, _where(conditions), offset, limit), dict(parameters, name=tag)
+
+
+def get_object_tags(tagged_object: str, limit: int, offset: int, after: Optional[str], prefix: Optional[str] = None,
+                    start: Optional[str] = None, end: Optional[str] = None) -> Statement:
+    conditions, parameters = _name_filter(after, prefix, start, end)
+    return "MATCH p=(:%s {name:$name })-[:%s]->(a) %s RETURN a.name order by a.name skip %d limit %d" % (
+        OBJECT, TAGGED, _where(conditions), offset, limit), dict(parameters, name=tagged_object)
+
+
+def query_objects(all_tags: Collection[str], any_tags: Collection[str], none_tags: Collection[str],
+                  limit: int, offset: int, after: Optional[str], prefix: Optional[str] = None,
+                  start: Optional[str] = None, end: Optional[str] = None) -> Statement:
+    all_tags, any_tags, none_tags = list(set(all_tags)), list(set(any_tags)), list(set(none_tags))
+    # Start from the edges of one of the tags when possible instead of scanning every object
+    if all_tags:
+        match = "MATCH (:%s {name: $anchor})<-[:%s]-(a:%s)" % (TAG, TAGGED, OBJECT)
+    elif any_tags:
+        match = "MATCH (t:%s)<-[:%s]-(a:%s) WHERE t.name IN $any_tags WITH DISTINCT a" % (TAG, TAGGED, OBJECT)
+    else:
+        match = "MATCH (a:%s)" % OBJECT
+    conditions, parameters = _name_filter(after, prefix, start, end)
+    has_tag = "(a)-[:%s]->(:%s {name: t})" % (TAGGED, TAG)
+    return "%s WHERE %s all(t IN $all_tags WHERE %s) " \
+           "AND (size($any_tags) = 0 OR any(t IN $any_tags WHERE %s)) AND none(t IN $none_tags WHERE %s) " \
+           "RETURN a.name order by a.name skip %d limit %d" % (
+               match, conditions + " AND" if conditions else "", has_tag, has_tag, has_tag, offset, limit), \
+           dict(parameters, anchor=all_tags[0] if all_tags else None, all_tags=all_tags, any_tags=any_tags,
+                none_tags=none_tags)
+
+
+def get_objects_with_tags(limit: int, after: Optional[str]) -> Statement:
+    # Rows of the object name and the sorted list of its tags
+    conditions, parameters = _name_filter(after)
+    return "MATCH (a:%s) %s WITH a order by a.name limit %d OPTIONAL MATCH (a)-[:%s]->(t:%s) " \
+           "WITH a, t order by t.name RETURN a.name, collect(t.name) order by a.name" % (
+               OBJECT, _where(conditions), limit, TAGGED, TAG), parameters
+
+
+# Rows of each name and the sorted list of the first $limit names linked to it, in one round trip. The pages are cut
+# from the whole list, subqueries that could stop at the limit are not in Neo4j 3.5
+def get_many_tagged_objects(tags: Collection[str], limit: int) -> Statement:
+    return "UNWIND $names AS name OPTIONAL MATCH (:%s {name: name})<-[:%s]-(a:%s) WITH name, a order by a.name " \
+           "RETURN name, collect(a.name)[..$limit]" % (TAG, TAGGED, OBJECT), \
+           {'names': list(dict.fromkeys(tags)), 'limit': limit}
+
+
+def get_many_object_tags(tagged_objects: Collection[str], limit: int) -> Statement:
+    return "UNWIND $names AS name OPTIONAL MATCH (:%s {name: name})-[:%s]->(a:%s) WITH name, a order by a.name " \
+           "RETURN name, collect(a.name)[..$limit]" % (OBJECT, TAGGED, TAG), \
+           {'names': list(dict.fromkeys(tagged_objects)), 'limit': limit}
+
+
+def pages_by_name(names: Collection[str], rows: List[Tuple]) -> Dict[str, List[str]]:
+    # The rows of the statements above, by name in the order given
+    pages = dict(rows)
+    return {name: pages.get(name, []) for name in dict.fromkeys(names)}
+
+
+# Counting the relationships of a single node is answered from its degree, without visiting them
+def count_tagged_objects(tag: str) -> Statement:
+    return "OPTIONAL MATCH (:%s {name: $name})<-[r:%s]-() RETURN count(r)" % (TAG, TAGGED), {'name': tag}
+
+
+def count_object_tags(tagged_object: str) -> Statement:
+    return "OPTIONAL MATCH (:%s {name: $name})-[r:%s]->() RETURN count(r)" % (OBJECT, TAGGED), \
+           {'name': tagged_object}
+
+
+def get_top_tags(k: int) -> Statement:
+    # Rows of the tag name and its count
+    return "MATCH (a:%s) OPTIONAL MATCH (a)<-[r:%s]-() WITH a, count(r) AS objects " \
+           "RETURN a.name, objects order by objects desc, a.name limit %d" % (TAG, TAGGED, k), {}
+
+
+def get_related_tags(tag_name: str, k: int, jaccard: bool = False) -> Statement:
+    # Rows of the tag name, its objects in common with $name and the score. The counts come from the objects of $name,
+    # there is no index of them
+    match = "MATCH (:%s {name: $name})<-[:%s]-(:%s)-[:%s]->(t:%s) WITH t, count(*) AS together" % (
+        TAG, TAGGED, OBJECT, TAGGED, TAG)
+    if not jaccard:
+        return "%s RETURN t.name, together, toFloat(together) AS score order by score desc, t.name limit %d" % (
+            match, k), {'name': tag_name}
+    return "MATCH (x:%s {name: $name}) OPTIONAL MATCH (x)<-[r:%s]-() WITH count(r) AS objects %s, objects " \
+           "OPTIONAL MATCH (t)<-[s:%s]-() WITH t, together, objects, count(s) AS t_objects " \
+           "RETURN t.name, together, toFloat(together) / (objects + t_objects - together) AS score " \
+           "order by score desc, t.name limit %d" % (TAG, TAGGED, match, TAGGED, k), {'name': tag_name}
+
+
+def tag(object_to_tag: str, tags: Collection[str]) -> Statement:
+    return TAG_ROWS, {'rows': [{'object_name': object_to_tag, 'tags': list(tags)}]}
+
+
+def untag(object_to_untag: str, tags: Collection[str]) -> Statement:
+    return UNTAG_ROWS, {'rows': [{'object_name': object_to_untag, 'tags': list(tags)}]}
+
+
+def remove_object(object_to_remove: str) -> Statement:
+    return REMOVE_OBJECT_ROWS, {'rows': [{'object_name': object_to_remove}]}
+
+
+def remove_tag(tag_to_remove: str) -> Statement:
+    return REMOVE_TAG_ROWS, {'rows': [{'tag_name': tag_to_remove}]}
+
+
+def bulk_statements(operations: Collection[BulkOperation]) -> List[Statement]:
+    # Consecutive operations of the same kind share a statement, so the order of the batch is kept
+    statements = []
+    for operation_type, group in itertools.groupby(operations, key=lambda x: x.operation):
+        group = list(group)
+        if operation_type == BulkOperationType.TAG:
+            statement, rows = TAG_ROWS, [{'object_name': x.object_name, 'tags': list(x.tags)} for x in group]
+        elif operation_type == BulkOperationType.UNTAG:
+            statement, rows = UNTAG_ROWS, [{'object_name': x.object_name, 'tags': list(x.tags)} for x in group]
+        elif operation_type == BulkOperationType.REMOVE_OBJECT:
+            statement, rows = REMOVE_OBJECT_ROWS, [{'object_name': x.object_name} for x in group]
+        else:
+            statement, rows = REMOVE_TAG_ROWS, [{'tag_name': x.tag_name} for x in group]
+        statements.append((statement, {'rows': rows}))
+    return statements
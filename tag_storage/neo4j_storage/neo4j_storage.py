@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+from typing import Collection, Dict, List, Optional, Tuple
+
+from neo4j import AsyncGraphDatabase, AsyncDriver, AsyncManagedTransaction
+from neo4j.exceptions import Neo4jError
+
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType, \
+    validate_bulk_operations
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+from tag_storage.neo4j_storage import graph_queries
+
+
+@dataclasses.dataclass
+class Neo4jStorageConfig:
+    url: str
+    username: Optional[str] = None
+    password: Optional[str] = None
+    database: Optional[str] = None  # the server default when None
+    max_connection_pool_size: int = 100
+    connection_acquisition_timeout: float = 60.0  # seconds
+    max_connection_lifetime: float = 3600.0  # seconds
+    create_indexes: bool = True
+
+
+class Neo4jStorage(AsyncTagStorage):
+    """
+    Graph storage on the asyncio Bolt driver, it stores the same graph as Py2NeoStorage. Calls do not hold a
+    thread while they wait for the server, the number of concurrent queries is bounded by the connection pool.
+    """
+    config: Neo4jStorageConfig
+    driver: AsyncDriver
+    indexes_lock: asyncio.Lock
+    indexes_created: bool
+
+    def __init__(self, config: Neo4jStorageConfig):
+        self.config = config
+        auth = (config.username, config.password) if config.username is not None else None
+        self.driver = AsyncGraphDatabase.driver(config.url, auth=auth,
+                                                max_connection_pool_size=config.max_connection_pool_size,
+                                                connection_acquisition_timeout=config.connection_acquisition_timeout,
+                                                max_connection_lifetime=config.max_connection_lifetime)
+        self.indexes_lock = asyncio.Lock()
+        self.indexes_created = not config.create_indexes
+
+    async def __create_indexes(self):
+        # The constructor can't talk to the server, the indexes are created before the first query
+        async with self.indexes_lock:
+            if self.indexes_created:
+                return
+            async with self.driver.session(database=self.config.database) as session:
+                # The 5.x driver only talks to Neo4j 4.4 and later, which all have this syntax
+                for statement in graph_queries.CREATE_INDEXES:
+                    await (await session.run(statement)).consume()
+            self.indexes_created = True
+
+    @staticmethod
+    async def __fetch_column(tx: AsyncManagedTransaction, statement: graph_queries.Statement) -> List[str]:
+        result = await tx.run(*statement)
+        return [record[0] async for record in result]
+
+    @staticmethod
+    async def __fetch_rows(tx: AsyncManagedTransaction, statement: graph_queries.Statement) -> List[Tuple]:
+        result = await tx.run(*statement)
+        return [tuple(record.values()) async for record in result]
+
+    @staticmethod
+    async def __execute(tx: AsyncManagedTransaction, statements: List[graph_queries.Statement]):
+        for statement in statements:
+            await (await tx.run(*statement)).consume()
+
+    async def _read(self, query: str, statement: graph_queries.Statement, rows: bool = False) -> List:
+        # query names the statement in the metrics
+        if not self.indexes_created:
+            await self.__create_indexes()
+        with self.instrumentation.timer('tagapi_query_duration_seconds', storage='neo4j', query=query):
+            async with self.driver.session(database=self.config.database) as session:
+                return await session.execute_read(self.__fetch_rows if rows else self.__fetch_column, statement)
+
+    async def _write(self, query: str, *statements: graph_queries.Statement):
+        if not self.indexes_created:
+            await self.__create_indexes()
+        with self.instrumentation.timer('tagapi_query_duration_seconds', storage='neo4j', query=query):
+            async with self.driver.session(database=self.config.database) as session:
+                await session.execute_write(self.__execute, list(statements))
+
+    async def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                       prefix: Optional[str] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_tags', graph_queries.get_tags(limit, offset, after, prefix, start, end))
+
+    async def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                          prefix: Optional[str] = None, start: Optional[str] = None,
+                          end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_objects', graph_queries.get_objects(limit, offset, after, prefix, start, end))
+
+    async def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                                 prefix: Optional[str] = None, start: Optional[str] = None,
+                                 end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_tagged_objects', graph_queries.get_tagged_objects(tag, limit, offset, after,
+                                                                                        prefix, start, end))
+
+    async def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                              after: Optional[str] = None, prefix: Optional[str] = None,
+                              start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_object_tags', graph_queries.get_object_tags(tagged_object, limit, offset, after,
+                                                                                  prefix, start, end))
+
+    async def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                            none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                            after: Optional[str] = None, prefix: Optional[str] = None,
+                            start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self._read('query_objects', graph_queries.query_objects(all_tags, any_tags, none_tags, limit,
+                                                                              offset, after, prefix, start, end))
+
+    async def get_objects_with_tags(self, limit: int = 100,
+                                    after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        return await self._read('get_objects_with_tags', graph_queries.get_objects_with_tags(limit, after),
+                                rows=True)
+
+    async def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        rows = await self._read('get_many_tagged_objects', graph_queries.get_many_tagged_objects(tags, limit),
+                                rows=True)
+        return graph_queries.pages_by_name(tags, rows)
+
+    async def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        rows = await self._read('get_many_object_tags', graph_queries.get_many_object_tags(tagged_objects, limit),
+                                rows=True)
+        return graph_queries.pages_by_name(tagged_objects, rows)
+
+    async def count_tagged_objects(self, tag: str) -> int:
+        return (await self._read('count_tagged_objects', graph_queries.count_tagged_objects(tag)))[0]
+
+    async def count_object_tags(self, tagged_object: str) -> int:
+        return (await self._read('count_object_tags', graph_queries.count_object_tags(tagged_object)))[0]
+
+    async def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return [TagCount(*row) for row in await self._read('get_top_tags', graph_queries.get_top_tags(k), rows=True)]
+
+    async def get_related_tags(self, tag: str, k: int = 10,
+                               score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        query = graph_queries.get_related_tags(tag, k, jaccard=score == RelatedScore.JACCARD)
+        return [RelatedTag(*row) for row in await self._read('get_related_tags', query, rows=True)]
+
+    async def tag(self, object_to_tag: str, tags: Collection[str]):
+        await self._write('tag', graph_queries.tag(object_to_tag, tags))
+        self._publish([BulkOperation(BulkOperationType.TAG, object_name=object_to_tag, tags=list(tags))])
+
+    async def untag(self, object_to_untag: str, tags: Collection[str]):
+        await self._write('untag', graph_queries.untag(object_to_untag, tags))
+        self._publish([BulkOperation(BulkOperationType.UNTAG, object_name=object_to_untag, tags=list(tags))])
+
+    async def remove_object(self, object_to_remove: str):
+        await self._write('remove_object', graph_queries.remove_object(object_to_remove))
+        self._publish([BulkOperation(BulkOperationType.REMOVE_OBJECT, object_name=object_to_remove)])
+
+    async def remove_tag(self, tag_to_remove: str):
+        await self._write('remove_tag', graph_queries.remove_tag(tag_to_remove))
+        self._publish([BulkOperation(BulkOperationType.REMOVE_TAG, tag_name=tag_to_remove)])
+
+    async def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        results, valid = validate_bulk_operations(operations)
+        try:
+            await self._write('bulk_apply', *graph_queries.bulk_statements([operation for operation, _ in valid]))
+        except Neo4jError as e:
+            for _, result in valid:
+                result.ok, result.error = False, str(e)
+        else:
+            self._publish([operation for operation, _ in valid])
+        return results
+
+    async def close(self):
+        await self.driver.close()
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple, Sequence
+
+from sortedcontainers import SortedDict, SortedSet
+
+from tag_storage.pickle_storage.pickle_db_data import PickleDbData
+
+ID_TYPECODE = 'I'  # 4 bytes per edge and side
+REBUILD_THRESHOLD = 16  # past this many names update/difference_update rebuild the array instead of editing it
+
+
+def _bisect_left(ids: Sequence[int], names: List[Optional[str]], name: str) -> int:
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if names[ids[mid]] < name:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _bisect_right(ids: Sequence[int], names: List[Optional[str]], name: str) -> int:
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if name < names[ids[mid]]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class InternedSet:
+    """
+    Sorted set of the names of one key of an InternedNameMap. It is a view, changes go straight to the map.
+    Implements the part of the SortedSet interface used by PickledSetTagStorage.
+    """
+    __slots__ = ('owner', 'key_id')
+
+    def __init__(self, owner: InternedNameMap, key_id: int):
+        self.owner = owner
+        self.key_id = key_id
+
+    @property
+    def _ids(self) -> array:
+        return self.owner.members[self.key_id]
+
+    @property
+    def _names(self) -> List[Optional[str]]:
+        return self.owner.other.names
+
+    def _ids_to_change(self) -> array:
+        # The array may be shared with a copy being written, it is copied before being changed in place
+        owner, ids = self.owner, self.owner.members[self.key_id]
+        if owner.shared is not None and self.key_id < len(owner.shared) and owner.shared[self.key_id] is ids:
+            ids = owner.members[self.key_id] = array(ID_TYPECODE, ids)
+        return ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[str]:
+        names = self._names
+        return (names[each] for each in self._ids)
+
+    def __reversed__(self) -> Iterator[str]:
+        names = self._names
+        return (names[each] for each in reversed(self._ids))
+
+    def __contains__(self, name: str) -> bool:
+        ids, names = self._ids, self._names
+        position = _bisect_left(ids, names, name)
+        return position < len(ids) and names[ids[position]] == name
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)!r})"
+
+    def islice(self, start: Optional[int] = None, stop: Optional[int] = None, reverse: bool = False) -> Iterator[str]:
+        names = self._names
+        ids = self._ids[start:stop]
+        return (names[each] for each in (reversed(ids) if reverse else ids))
+
+    def irange(self, minimum: Optional[str] = None, maximum: Optional[str] = None,
+               inclusive: Tuple[bool, bool] = (True, True), reverse: bool = False) -> Iterator[str]:
+        ids, names = self._ids, self._names
+        start, stop = 0, len(ids)
+        if minimum is not None:
+            start = _bisect_left(ids, names, minimum) if inclusive[0] else _bisect_right(ids, names, minimum)
+        if maximum is not None:
+            stop = _bisect_right(ids, names, maximum) if inclusive[1] else _bisect_left(ids, names, maximum)
+        return self.islice(start, stop, reverse)
+
+    def add(self, name: str):
+        ids, names = self._ids, self._names
+        position = _bisect_left(ids, names, name)
+        if position < len(ids) and names[ids[position]] == name:
+            return
+        self._ids_to_change().insert(position, self.owner.other.id_of(name))
+
+    def update(self, iterable: Iterable[str]):
+        new_names = [each for each in set(iterable) if each not in self]
+        if len(new_names) < REBUILD_THRESHOLD:
+            for each in new_names:
+                self.add(each)
+            return
+        other = self.owner.other
+        merged = list(self._ids)
+        merged.extend(other.id_of(each) for each in new_names)
+        merged.sort(key=other.names.__getitem__)
+        self.owner.members[self.key_id] = array(ID_TYPECODE, merged)
+
+    def discard(self, name: str):
+        ids, names = self._ids, self._names
+        position = _bisect_left(ids, names, name)
+        if position < len(ids) and names[ids[position]] == name:
+            del self._ids_to_change()[position]
+
+    def remove(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self.discard(name)
+
+    def difference_update(self, iterable: Iterable[str]):
+        to_remove = set(iterable)
+        if len(to_remove) < REBUILD_THRESHOLD:
+            for each in to_remove:
+                self.discard(each)
+            return
+        names = self._names
+        self.owner.members[self.key_id] = array(ID_TYPECODE, (each for each in self._ids
+                                                              if names[each] not in to_remove))
+
+
+class InternedNameMap:
+    """
+    Maps names to sorted sets of names of the other side of the graph (tags to objects or objects to tags).
+    Each key is interned to an integer id, and sets are arrays of the ids the other side gave to their names,
+    kept in name order. Implements the part of the SortedDict[str, SortedSet[str]] interface used by
+    PickledSetTagStorage.
+
+    Ids are reused, so an edge must be removed from the other side before popping any of its ends.
+    """
+    ids: SortedDict  # name -> id, sorted by name
+    names: List[Optional[str]]  # id -> name
+    members: List[Optional[array]]  # id -> ids in the other map
+    free_ids: List[int]
+    other: Optional[InternedNameMap]
+    shared = None  # Optional[List[Optional[array]]], the members of a shared_copy being written
+
+    def __init__(self):
+        self.ids = SortedDict()
+        self.names = []
+        self.members = []
+        self.free_ids = []
+        self.other = None
+
+    def id_of(self, name: str) -> int:
+        return self.ids[name]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def __getitem__(self, name: str) -> InternedSet:
+        return InternedSet(self, self.ids[name])
+
+    def __setitem__(self, name: str, values: Iterable[str]):
+        key_id = self.ids.get(name)
+        if key_id is None:
+            if self.free_ids:
+                key_id = self.free_ids.pop()
+                self.names[key_id] = name
+            else:
+                key_id = len(self.names)
+                self.names.append(name)
+                self.members.append(None)
+            self.ids[name] = key_id
+        self.members[key_id] = array(ID_TYPECODE)
+        InternedSet(self, key_id).update(values)
+
+    def get(self, name: str, default=None):
+        key_id = self.ids.get(name)
+        if key_id is None:
+            return default
+        return InternedSet(self, key_id)
+
+    def pop(self, name: str, *default):
+        if name not in self.ids and default:
+            return default[0]
+        key_id = self.ids.pop(name)
+        values = SortedSet(InternedSet(self, key_id))
+        self.names[key_id] = None
+        self.members[key_id] = None
+        self.free_ids.append(key_id)
+        return values
+
+    def keys(self):
+        return self.ids.keys()
+
+    def values(self) -> Iterator[InternedSet]:
+        return (InternedSet(self, key_id) for key_id in self.ids.values())
+
+    def items(self) -> Iterator[Tuple[str, InternedSet]]:
+        return ((name, InternedSet(self, key_id)) for name, key_id in self.ids.items())
+
+    def islice(self, start: Optional[int] = None, stop: Optional[int] = None, reverse: bool = False) -> Iterator[str]:
+        return self.ids.islice(start, stop, reverse)
+
+    def irange(self, minimum: Optional[str] = None, maximum: Optional[str] = None,
+               inclusive: Tuple[bool, bool] = (True, True), reverse: bool = False) -> Iterator[str]:
+        return self.ids.irange(minimum, maximum, inclusive, reverse)
+
+
+class InternedPickleDbData:
+    """
+    Compact alternative to PickleDbData: names are stored once and edges take 4 bytes on each side instead of a
+    reference in a list plus a hash table slot in each SortedSet.
+    """
+    tags: InternedNameMap  # tag_name -> object_names
+    objects: InternedNameMap  # object_name -> tag_names
+
+    def __init__(self):
+        self.tags = InternedNameMap()
+        self.objects = InternedNameMap()
+        self.tags.other = self.objects
+        self.objects.other = self.tags
+
+    @classmethod
+    def from_pickle_db_data(cls, data: PickleDbData) -> InternedPickleDbData:
+        interned = cls()
+        for side, source in ((interned.tags, data.tags), (interned.objects, data.objects)):
+            side.names = list(source)
+            side.ids = SortedDict(zip(side.names, range(len(side.names))))
+        for side, source in ((interned.tags, data.tags), (interned.objects, data.objects)):
+            # Ids were given in name order, so mapping a sorted set keeps it sorted
+            other_ids = side.other.ids
+            side.members = [array(ID_TYPECODE, (other_ids[each] for each in values)) for values in source.values()]
+        return interned
+
+    def shared_copy(self) -> InternedPickleDbData:
+        """
+        A copy to write while this one keeps changing, made without copying the sets: it shares their arrays, which
+        are copied before being changed in place until release_shared_copy.
+        """
+        copied = InternedPickleDbData()
+        for side, source in ((copied.tags, self.tags), (copied.objects, self.objects)):
+            side.ids = SortedDict(source.ids)
+            side.names = list(source.names)
+            side.members = list(source.members)
+            side.free_ids = list(source.free_ids)
+            source.shared = side.members
+        return copied
+
+    def release_shared_copy(self):
+        self.tags.shared = None
+        self.objects.shared = None
+
+    def to_pickle_db_data(self) -> PickleDbData:
+        return PickleDbData(
+            tags=SortedDict((name, SortedSet(values)) for name, values in self.tags.items()),
+            objects=SortedDict((name, SortedSet(values)) for name, values in self.objects.items()))
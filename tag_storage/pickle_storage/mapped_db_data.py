@@ -0,0 +1,468 @@
+"""
+On-disk layout read in place through mmap, so opening a storage takes the same time whatever its size and doesn't
+unpickle anything.
+
+The file holds both sides of the graph as sorted name tables with their edges in compressed sparse rows:
+
+    header        magic, number of tags, of objects, of tag edges and of object edges
+    offsets       name offsets of the tags and of the objects (n + 1 uint64 each, into their name blobs)
+                  edge offsets of the tags and of the objects (n + 1 uint64 each, into their edge arrays)
+    edges         object ids of each tag, tag ids of each object (uint32, sorted)
+    names         UTF-8 names of the tags and of the objects, padded to 8 bytes
+
+The id of a name is its position in the sorted table of its side. Integers are in the byte order of the writer,
+which is part of the magic.
+
+Run `python -m tag_storage.pickle_storage.mapped_db_data <pickle file> <mapped file>` to convert a pickle file.
+"""
+from __future__ import annotations
+
+import argparse
+import bisect
+import copy
+import heapq
+import itertools
+import mmap
+import os
+import pickle
+import struct
+import sys
+from array import array
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple
+
+from sortedcontainers import SortedDict, SortedSet
+
+from tag_storage.pickle_storage.pickle_db_data import PickleDbData
+
+MAGIC = b"TAGMAP1" + (b"L" if sys.byteorder == "little" else b"B")
+HEADER = struct.Struct("=8sQQQQ")
+OFFSET_TYPECODE = 'Q'
+ID_TYPECODE = 'I'
+# UTF-8 bytes sort like the code points of the str, surrogates included
+ENCODING = 'utf-8'
+ERRORS = 'surrogatepass'
+WRITE_BUFFER_IDS = 64 * 1024
+
+
+def is_mapped_file(f: BinaryIO) -> bool:
+    position = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(position)
+    return magic[:-1] == MAGIC[:-1]
+
+
+class _MappedSide:
+    """The sorted names of one side of the file and their edges, as ids of the other side"""
+
+    def __init__(self, buffer: mmap.mmap, name_offsets: memoryview, names_start: int, edge_offsets: memoryview,
+                 edges: memoryview):
+        self.buffer = buffer
+        self.name_offsets = name_offsets
+        self.names_start = names_start
+        self.edge_offsets = edge_offsets
+        self.edges = edges
+
+    def __len__(self) -> int:
+        return len(self.name_offsets) - 1
+
+    def key(self, position: int) -> bytes:
+        return self.buffer[self.names_start + self.name_offsets[position]:
+                           self.names_start + self.name_offsets[position + 1]]
+
+    def name(self, position: int) -> str:
+        return self.key(position).decode(ENCODING, ERRORS)
+
+    def bisect_left(self, name: str) -> int:
+        key = name.encode(ENCODING, ERRORS)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, name: str) -> int:
+        key = name.encode(ENCODING, ERRORS)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < self.key(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def position(self, name: str) -> Optional[int]:
+        position = self.bisect_left(name)
+        if position < len(self) and self.name(position) == name:
+            return position
+        return None
+
+    def ids(self, position: int) -> Sequence[int]:
+        return self.edges[self.edge_offsets[position]:self.edge_offsets[position + 1]]
+
+
+class MappedSet:
+    """
+    Sorted set of the names of one key of a MappedNameMap: its edges in the file, minus the names removed and plus
+    the names added since. It is a view, changes go straight to the map. Implements the part of the SortedSet
+    interface used by PickledSetTagStorage.
+    """
+    __slots__ = ('owner', 'name', 'position')
+
+    def __init__(self, owner: MappedNameMap, name: str, position: Optional[int]):
+        self.owner = owner
+        self.name = name
+        self.position = position  # in the file, None if the key is not there or was replaced
+
+    def _ids(self) -> Sequence[int]:
+        return () if self.position is None else self.owner.base.ids(self.position)
+
+    def _base_names(self, ids: Sequence[int], reverse: bool = False) -> Iterator[str]:
+        other = self.owner.other.base
+        names = (other.name(each) for each in (reversed(ids) if reverse else ids))
+        removed = self.owner.removed.get(self.name)
+        if removed:
+            return (each for each in names if each not in removed)
+        return names
+
+    def _in_base(self, name: str) -> bool:
+        # Searched among the names of the set, usually much fewer than the names of the other side
+        ids, other = self._ids(), self.owner.other.base
+        key = name.encode(ENCODING, ERRORS)
+        lo, hi = 0, len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if other.key(ids[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(ids) and other.key(ids[lo]) == key
+
+    def _changed(self) -> bool:
+        return self.name in self.owner.added or self.name in self.owner.removed
+
+    def __len__(self) -> int:
+        owner = self.owner
+        return len(self._ids()) - len(owner.removed.get(self.name, ())) + len(owner.added.get(self.name, ()))
+
+    def __iter__(self) -> Iterator[str]:
+        return self.irange()
+
+    def __reversed__(self) -> Iterator[str]:
+        return self.irange(reverse=True)
+
+    def __contains__(self, name: str) -> bool:
+        if name in self.owner.added.get(self.name, ()):
+            return True
+        if name in self.owner.removed.get(self.name, ()):
+            return False
+        return self._in_base(name)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)!r})"
+
+    def islice(self, start: Optional[int] = None, stop: Optional[int] = None, reverse: bool = False) -> Iterator[str]:
+        if not self._changed():
+            return self._base_names(self._ids()[start:stop], reverse)
+        names = itertools.islice(self.irange(), start, stop)
+        return reversed(list(names)) if reverse else names
+
+    def irange(self, minimum: Optional[str] = None, maximum: Optional[str] = None,
+               inclusive: Tuple[bool, bool] = (True, True), reverse: bool = False) -> Iterator[str]:
+        ids, other = self._ids(), self.owner.other.base
+        # Ids are positions in the sorted names of the other side, so the bounds are located there
+        start, stop = 0, len(ids)
+        if len(ids) and minimum is not None:
+            rank = other.bisect_left(minimum) if inclusive[0] else other.bisect_right(minimum)
+            start = bisect.bisect_left(ids, rank)
+        if len(ids) and maximum is not None:
+            rank = other.bisect_right(maximum) if inclusive[1] else other.bisect_left(maximum)
+            stop = bisect.bisect_left(ids, rank)
+        names = self._base_names(ids[start:stop], reverse)
+        added = self.owner.added.get(self.name)
+        if not added:
+            return names
+        return heapq.merge(names, added.irange(minimum, maximum, inclusive, reverse), reverse=reverse)
+
+    def add(self, name: str):
+        removed = self.owner.removed.get(self.name)
+        if removed and name in removed:
+            removed.discard(name)
+            if not removed:
+                del self.owner.removed[self.name]
+        elif not self._in_base(name):
+            self.owner.added.setdefault(self.name, SortedSet()).add(name)
+
+    def update(self, iterable: Iterable[str]):
+        for each in iterable:
+            self.add(each)
+
+    def discard(self, name: str):
+        added = self.owner.added.get(self.name)
+        if added and name in added:
+            added.discard(name)
+            if not added:
+                del self.owner.added[self.name]
+        elif self._in_base(name):
+            self.owner.removed.setdefault(self.name, set()).add(name)
+
+    def remove(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self.discard(name)
+
+    def difference_update(self, iterable: Iterable[str]):
+        for each in iterable:
+            self.discard(each)
+
+
+class MappedNameMap:
+    """
+    Maps names to sorted sets of names of the other side, like InternedNameMap. Keys and sets are read from the
+    file and the changes made since it was written are kept apart, in memory. Implements the part of the
+    SortedDict[str, SortedSet[str]] interface used by PickledSetTagStorage.
+
+    The edges in the file refer to the names of the other side by their position in the file, so an edge must be
+    removed from the other side before popping any of its ends.
+    """
+    base: _MappedSide
+    other: Optional[MappedNameMap]
+    added_keys: SortedSet  # keys not in the file, or replaced since
+    removed_keys: Set[str]  # keys of the file removed or replaced since
+    added: Dict[str, SortedSet]  # key -> names added to its set
+    removed: Dict[str, Set[str]]  # key -> names of the file removed from its set
+
+    def __init__(self, base: _MappedSide):
+        self.base = base
+        self.other = None
+        self.added_keys = SortedSet()
+        self.removed_keys = set()
+        self.added = {}
+        self.removed = {}
+
+    def _position(self, name: str) -> Optional[int]:
+        if name in self.removed_keys:
+            return None
+        return self.base.position(name)
+
+    def __len__(self) -> int:
+        return len(self.base) - len(self.removed_keys) + len(self.added_keys)
+
+    def __iter__(self) -> Iterator[str]:
+        return self.irange()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.added_keys or self._position(name) is not None
+
+    def __getitem__(self, name: str) -> MappedSet:
+        mapped = self.get(name)
+        if mapped is None:
+            raise KeyError(name)
+        return mapped
+
+    def __setitem__(self, name: str, values: Iterable[str]):
+        if self._position(name) is not None:
+            # The set in the file is hidden from now on
+            self.removed_keys.add(name)
+        self.added_keys.add(name)
+        self.removed.pop(name, None)
+        self.added.pop(name, None)
+        MappedSet(self, name, None).update(values)
+
+    def get(self, name: str, default=None):
+        if name in self.added_keys:
+            return MappedSet(self, name, None)
+        position = self._position(name)
+        if position is None:
+            return default
+        return MappedSet(self, name, position)
+
+    def pop(self, name: str, *default):
+        values = self.get(name)
+        if values is None:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        popped = SortedSet(values)
+        if name in self.added_keys:
+            self.added_keys.remove(name)
+        else:
+            self.removed_keys.add(name)
+        self.added.pop(name, None)
+        self.removed.pop(name, None)
+        return popped
+
+    def keys(self) -> Iterator[str]:
+        return iter(self)
+
+    def values(self) -> Iterator[MappedSet]:
+        return (values for _, values in self.items())
+
+    def items(self) -> Iterator[Tuple[str, MappedSet]]:
+        base = ((self.base.name(position), position) for position in range(len(self.base)))
+        in_base = ((name, MappedSet(self, name, position)) for name, position in base
+                   if name not in self.removed_keys)
+        added = ((name, MappedSet(self, name, None)) for name in self.added_keys)
+        return heapq.merge(in_base, added, key=lambda item: item[0])
+
+    def islice(self, start: Optional[int] = None, stop: Optional[int] = None, reverse: bool = False) -> Iterator[str]:
+        if not self.added_keys and not self.removed_keys:
+            positions = range(len(self.base))[start:stop]
+            return (self.base.name(each) for each in (reversed(positions) if reverse else positions))
+        names = itertools.islice(self.irange(), start, stop)
+        return reversed(list(names)) if reverse else names
+
+    def irange(self, minimum: Optional[str] = None, maximum: Optional[str] = None,
+               inclusive: Tuple[bool, bool] = (True, True), reverse: bool = False) -> Iterator[str]:
+        start, stop = 0, len(self.base)
+        if minimum is not None:
+            start = self.base.bisect_left(minimum) if inclusive[0] else self.base.bisect_right(minimum)
+        if maximum is not None:
+            stop = self.base.bisect_right(maximum) if inclusive[1] else self.base.bisect_left(maximum)
+        positions = range(start, max(start, stop))
+        names = (self.base.name(each) for each in (reversed(positions) if reverse else positions))
+        if self.removed_keys:
+            names = (each for each in names if each not in self.removed_keys)
+        if not self.added_keys:
+            return names
+        return heapq.merge(names, self.added_keys.irange(minimum, maximum, inclusive, reverse), reverse=reverse)
+
+
+class MappedDbData:
+    """
+    Alternative to PickleDbData read in place from a file written by write_mapped_db_data. The changes made since
+    it was opened are kept in memory, until the storage writes a new file and opens that one.
+    """
+    tags: MappedNameMap  # tag_name -> object_names
+    objects: MappedNameMap  # object_name -> tag_names
+
+    def __init__(self, tags: _MappedSide, objects: _MappedSide):
+        self.tags = MappedNameMap(tags)
+        self.objects = MappedNameMap(objects)
+        self.tags.other = self.objects
+        self.objects.other = self.tags
+
+    @classmethod
+    def from_file(cls, f: BinaryIO) -> MappedDbData:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < HEADER.size:
+            raise ValueError("the file is truncated")
+        magic, tag_count, object_count, tag_edge_count, object_edge_count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("the file was written with another byte order" if magic[:-1] == MAGIC[:-1]
+                             else "the file is not in the mapped format")
+        view = memoryview(buffer)
+        position = HEADER.size
+        sections = []
+        for count, typecode in ((tag_count + 1, OFFSET_TYPECODE), (object_count + 1, OFFSET_TYPECODE),
+                                (tag_count + 1, OFFSET_TYPECODE), (object_count + 1, OFFSET_TYPECODE),
+                                (tag_edge_count, ID_TYPECODE), (object_edge_count, ID_TYPECODE)):
+            size = count * array(typecode).itemsize
+            if position + size > len(buffer):
+                raise ValueError("the file is truncated")
+            sections.append(view[position:position + size].cast(typecode))
+            position += size
+        tag_names, object_names, tag_edge_offsets, object_edge_offsets, tag_edges, object_edges = sections
+        tag_names_start = position + (-position % 8)
+        object_names_start = tag_names_start + tag_names[-1]
+        if object_names_start + object_names[-1] > len(buffer):
+            raise ValueError("the file is truncated")
+        return cls(_MappedSide(buffer, tag_names, tag_names_start, tag_edge_offsets, tag_edges),
+                   _MappedSide(buffer, object_names, object_names_start, object_edge_offsets, object_edges))
+
+    @classmethod
+    def open(cls, path: str) -> MappedDbData:
+        # The mapping stays valid after the file is closed, and after it is replaced by the next snapshot
+        with open(path, 'rb') as f:
+            return cls.from_file(f)
+
+    def __deepcopy__(self, memo) -> MappedDbData:
+        # The file can't change, only the changes on top of it are copied
+        copied = MappedDbData(self.tags.base, self.objects.base)
+        for side, source in ((copied.tags, self.tags), (copied.objects, self.objects)):
+            side.added_keys = SortedSet(source.added_keys)
+            side.removed_keys = set(source.removed_keys)
+            side.added = copy.deepcopy(source.added, memo)
+            side.removed = copy.deepcopy(source.removed, memo)
+        return copied
+
+    def to_pickle_db_data(self) -> PickleDbData:
+        return PickleDbData(
+            tags=SortedDict((name, SortedSet(values)) for name, values in self.tags.items()),
+            objects=SortedDict((name, SortedSet(values)) for name, values in self.objects.items()))
+
+
+def _name_offsets(names: Iterable[str]) -> array:
+    offsets = array(OFFSET_TYPECODE, [0])
+    total = 0
+    for each in names:
+        total += len(each.encode(ENCODING, ERRORS))
+        offsets.append(total)
+    return offsets
+
+
+def _edge_offsets(names_map) -> array:
+    offsets = array(OFFSET_TYPECODE, [0])
+    total = 0
+    for _, values in names_map.items():
+        total += len(values)
+        offsets.append(total)
+    return offsets
+
+
+def _write_edges(f: BinaryIO, names_map, other_ids: Dict[str, int]):
+    buffer = array(ID_TYPECODE)
+    for _, values in names_map.items():
+        buffer.extend(other_ids[each] for each in values)
+        if len(buffer) >= WRITE_BUFFER_IDS:
+            f.write(buffer.tobytes())
+            buffer = array(ID_TYPECODE)
+    f.write(buffer.tobytes())
+
+
+def _write_names(f: BinaryIO, names: Iterable[str]):
+    names = iter(names)
+    while True:
+        chunk = list(itertools.islice(names, WRITE_BUFFER_IDS))
+        if not chunk:
+            return
+        f.write(b"".join(each.encode(ENCODING, ERRORS) for each in chunk))
+
+
+def write_mapped_db_data(db_data, f: BinaryIO):
+    """Writes any layout of the pickle storage (PickleDbData, InternedPickleDbData or MappedDbData) to f"""
+    tag_names = list(db_data.tags)
+    object_names = list(db_data.objects)
+    tag_ids = {name: position for position, name in enumerate(tag_names)}
+    object_ids = {name: position for position, name in enumerate(object_names)}
+    tag_edge_offsets = _edge_offsets(db_data.tags)
+    object_edge_offsets = _edge_offsets(db_data.objects)
+    f.write(HEADER.pack(MAGIC, len(tag_names), len(object_names), tag_edge_offsets[-1], object_edge_offsets[-1]))
+    for offsets in (_name_offsets(tag_names), _name_offsets(object_names), tag_edge_offsets, object_edge_offsets):
+        f.write(offsets.tobytes())
+    _write_edges(f, db_data.tags, object_ids)
+    _write_edges(f, db_data.objects, tag_ids)
+    f.write(b"\0" * (-f.tell() % 8))
+    _write_names(f, tag_names)
+    _write_names(f, object_names)
+
+
+def convert_pickle_file(source: str, destination: str):
+    # This is insecure, like loading the pickle file in the storage
+    with open(source, 'rb') as f:
+        db_data = pickle.load(f)
+    tmp_path = f"{destination}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write_mapped_db_data(db_data, f)
+    os.replace(tmp_path, destination)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts a pickle storage file to the mapped format")
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    arguments = parser.parse_args()
+    convert_pickle_file(arguments.source, arguments.destination)
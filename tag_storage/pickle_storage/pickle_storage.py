@@ -1,21 +1,50 @@
 from __future__ import annotations
 
+import asyncio
+import collections
+import contextlib
 import copy
 import dataclasses
+import enum
+import gc
+import heapq
+import itertools
 import os.path
 import pickle
-from typing import Collection
+import time
+from typing import AsyncContextManager, Collection, Dict, Optional, Union, Iterator, List, Tuple
 
-import aiofiles
 import aiorwlock
-from sortedcontainers import SortedSet
+from sortedcontainers import SortedDict, SortedSet
 
 from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType, \
+    validate_bulk_operations
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
 from tag_storage.base_storage.tag_storage import TagStorageException
+from tag_storage.base_storage.versions import Versions
+from tag_storage.pickle_storage import pickle_storage_journal
+from tag_storage.pickle_storage.interned_db_data import InternedPickleDbData
+from tag_storage.pickle_storage.mapped_db_data import MappedDbData, is_mapped_file, write_mapped_db_data
 from tag_storage.pickle_storage.pickle_db_data import PickleDbData
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournal, \
+    PickledSetTagStorageJournalConfiguration, JournalRecord
 from tag_storage.pickle_storage.pickle_storage_periodic_synchronizer import PickledSetTagStoragePeriodicSynchronizer, \
     PickledSetTagStoragePeriodicSynchronizerConfiguration
 from tag_storage.pickle_storage.pickle_storage_synchronizer import PickledSetTagStorageSynchronizer
+from tag_storage.pickle_storage.tag_cooccurrence import TagCooccurrence, TagCooccurrenceConfiguration, rank_related
+from tag_storage.pickle_storage.tag_popularity import TagPopularity
+
+
+DbData = Union[PickleDbData, InternedPickleDbData, MappedDbData]
+
+
+class SnapshotMode(str, enum.Enum):
+    # The snapshot is written by a forked child, which sees a copy-on-write image of the data
+    FORK = 'fork'
+    # The maps of the data are copied while writers are blocked and written from the copy, their sets are shared with
+    # it and copied by the writes that change them meanwhile
+    COPY = 'copy'
 
 
 @dataclasses.dataclass
@@ -25,129 +54,642 @@ class PickledSetTagStorageConfiguration:
     synchronizer: PickledSetTagStorageSynchronizer = dataclasses.field(
         default_factory=lambda: PickledSetTagStoragePeriodicSynchronizer(
             PickledSetTagStoragePeriodicSynchronizerConfiguration()))
+    journal: Optional[PickledSetTagStorageJournalConfiguration] = None
+    # FORK is opt-in: forking a process with other threads can leave the child with a lock it will never get
+    snapshot_mode: SnapshotMode = SnapshotMode.COPY
+    # Keep the data as InternedPickleDbData, existing files are converted when loaded
+    compact: bool = False
+    # Keep the data in a file in the mapped format (MappedDbData) instead of a pickle, existing files are converted
+    # when loaded. The journal is always enabled with it.
+    mapped: bool = False
+    remove_chunk_size: int = 1000  # edges removed by remove_tag before yielding to other tasks
+    # Count the tags used together, for get_related_tags, as the tags of the objects change
+    cooccurrence: Optional[TagCooccurrenceConfiguration] = None
 
 
 class InvalidPickleDatabaseFile(TagStorageException):
     pass
 
 
+class SnapshotFailed(TagStorageException):
+    pass
+
+
 class PickledSetTagStorage(AsyncTagStorage):
+    """
+    Reads run without awaiting, so they always see whole writes (except between the chunks of a remove_tag). Writes
+    share `snapshot_lock`, which snapshots take exclusively; they don't await while they change the data, so they
+    never interleave.
+    """
     db_path: str
-    lock: aiorwlock.RWLock
-    db_data: PickleDbData
+    snapshot_lock: aiorwlock.RWLock  # shared by the writes, exclusive for snapshots
+    sync_lock: asyncio.Lock
+    db_data: DbData
     synchronizer: PickledSetTagStorageSynchronizer
     config: PickledSetTagStorageConfiguration
+    journal: Optional[PickledSetTagStorageJournal]
+    tag_popularity: TagPopularity  # not persisted, rebuilt when the data is loaded
+    tag_cooccurrence: Optional[TagCooccurrence]  # the same, when config.cooccurrence is set
+    removing_tags: collections.Counter  # remove_tag calls in progress
     dirty: bool
+    dirty_since: float  # time.monotonic() of the first change after dirty was cleared
+    versions: Versions  # not persisted, a new epoch starts when the data is loaded
+    snapshot: Optional[DbData]  # the copy an online sync is writing, it shares the sets of db_data
 
     def __init__(self, config: PickledSetTagStorageConfiguration):
+        self.versions = Versions()
         self.dirty = False
+        self.dirty_since = time.monotonic()
+        self.snapshot = None
         self.config = config
-        self.lock = aiorwlock.RWLock()
+        self.snapshot_lock = aiorwlock.RWLock()
+        self.sync_lock = asyncio.Lock()
+        self.removing_tags = collections.Counter()
         self.db_path = config.path
+        self.journal = None
+        journal_config = config.journal
+        if journal_config is None and (config.mapped or config.synchronizer.needs_journal):
+            # Changes to a mapped file are kept in memory, the ones after a snapshot are taken from the journal
+            journal_config = PickledSetTagStorageJournalConfiguration()
+        if journal_config is not None:
+            self.journal = PickledSetTagStorageJournal(journal_config.path or f"{self.db_path}.journal",
+                                                       journal_config.checkpoint_bytes)
         if config.overwrite or not os.path.exists(self.db_path):
-            self.db_data = PickleDbData()
+            self.db_data = InternedPickleDbData() if config.compact else PickleDbData()
             with open(self.db_path, 'wb') as f:
-                pickle.dump(self.db_data, f)
+                self._dump(self.db_data, f)
+            if config.mapped:
+                self.db_data = MappedDbData.open(self.db_path)
+            self.tag_popularity = TagPopularity()
+            self.tag_cooccurrence = self._new_tag_cooccurrence(self.db_data)
+            if self.journal is not None:
+                self.journal.reset()
         else:
             self.__load_data()
         self.synchronizer = config.synchronizer
         self.synchronizer.sync_store(self)
 
     def __load_data(self):
-        # This is insecure
         with open(self.db_path, 'rb') as f:
+            db_data, converted = self._load_snapshot(f, self.db_path, self.config)
+        if converted and self.config.mapped:
+            # Writes it in the mapped format right away, the conversion is what makes the next starts fast
+            self.__dump_file(db_data, f"{self.db_path}.tmp")
+            os.replace(f"{self.db_path}.tmp", self.db_path)
+            db_data = MappedDbData.open(self.db_path)
+        elif converted:
+            self.dirty = True
+        self.db_data = db_data
+        self.tag_popularity = self._new_tag_popularity(db_data)
+        self.tag_cooccurrence = self._new_tag_cooccurrence(db_data)
+        if self.journal is not None:
+            for record in self.journal.replay():
+                self._apply_record(record)
+                self.dirty = True
+
+    @staticmethod
+    def _load_snapshot(f, path: str, config: PickledSetTagStorageConfiguration) -> Tuple[DbData, bool]:
+        """
+        The data in f and whether it is not in the layout of the configuration. It is converted, except to the
+        mapped layout, which needs the file to be written first.
+        """
+        if is_mapped_file(f):
             try:
-                db_data = pickle.load(f)
-            except (pickle.UnpicklingError, TypeError) as e:
-                raise InvalidPickleDatabaseFile(f"{self.db_path} is not a valid pickle db: {e}")
+                db_data = MappedDbData.from_file(f)
+            except ValueError as e:
+                raise InvalidPickleDatabaseFile(f"{path} is not a valid mapped db: {e}")
+            if config.mapped:
+                return db_data, False
+            db_data = db_data.to_pickle_db_data()
+            return (InternedPickleDbData.from_pickle_db_data(db_data) if config.compact else db_data), True
+
+        # This is insecure
+        try:
+            db_data = pickle.load(f)
+        except (pickle.UnpicklingError, TypeError) as e:
+            raise InvalidPickleDatabaseFile(f"{path} is not a valid pickle db: {e}")
 
         # TODO: validate the data
-        self.db_data = db_data
+        if config.mapped:
+            return db_data, True
+        if config.compact and isinstance(db_data, PickleDbData):
+            return InternedPickleDbData.from_pickle_db_data(db_data), True
+        if not config.compact and isinstance(db_data, InternedPickleDbData):
+            return db_data.to_pickle_db_data(), True
+        return db_data, False
+
+    @staticmethod
+    def _new_tag_popularity(db_data: DbData) -> TagPopularity:
+        if isinstance(db_data, MappedDbData):
+            # Counting every tag would read the whole file, which opening it in constant time is meant to avoid
+            return TagPopularity.deferred(db_data.tags)
+        return TagPopularity(db_data.tags.items())
+
+    def _new_tag_cooccurrence(self, db_data: DbData) -> Optional[TagCooccurrence]:
+        if self.config.cooccurrence is None:
+            return None
+        if isinstance(db_data, MappedDbData):
+            return TagCooccurrence.deferred(self.config.cooccurrence, db_data.objects)
+        return TagCooccurrence(self.config.cooccurrence, db_data.objects.values())
+
+    async def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                       prefix: Optional[str] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Collection[str]:
+        return self._page(self.db_data.tags, limit, offset, after, prefix, start, end)
+
+    async def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                          prefix: Optional[str] = None, start: Optional[str] = None,
+                          end: Optional[str] = None) -> Collection[str]:
+        return self._page(self.db_data.objects, limit, offset, after, prefix, start, end)
 
-    async def get_tags(self, limit: int = 100, offset: int = 0) -> Collection[str]:
-        async with self.lock.reader_lock:
-            return list(self.db_data.tags.islice(offset, offset + limit))
+    async def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                                 prefix: Optional[str] = None, start: Optional[str] = None,
+                                 end: Optional[str] = None) -> Collection[str]:
+        return self._page(self.db_data.tags.get(tag, SortedSet()), limit, offset, after, prefix, start, end)
 
-    async def get_objects(self, limit: int = 100, offset: int = 0) -> Collection[str]:
-        async with self.lock.reader_lock:
-            return list(self.db_data.objects.islice(offset, offset + limit))
+    async def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                              after: Optional[str] = None, prefix: Optional[str] = None,
+                              start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return self._page(self.db_data.objects.get(tagged_object, SortedSet()), limit, offset, after, prefix,
+                          start, end)
 
-    async def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0) -> Collection[str]:
-        async with self.lock.reader_lock:
-            return list(self.db_data.tags.get(tag, SortedSet()).islice(offset, offset + limit))
+    async def get_objects_with_tags(self, limit: int = 100,
+                                    after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        objects = self.db_data.objects
+        return [(name, list(objects[name])) for name in self._page(objects, limit, 0, after)]
 
-    async def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0) -> Collection[str]:
-        async with self.lock.reader_lock:
-            return list(self.db_data.objects.get(tagged_object, SortedSet()).islice(offset, offset + limit))
+    async def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        # Nothing is awaited, so every page is read from the same data, writes can't come in between
+        all_tags = self.db_data.tags
+        return {tag: self._page(all_tags.get(tag, SortedSet()), limit, 0, None) for tag in dict.fromkeys(tags)}
+
+    async def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        objects = self.db_data.objects
+        return {name: self._page(objects.get(name, SortedSet()), limit, 0, None)
+                for name in dict.fromkeys(tagged_objects)}
+
+    async def count_tagged_objects(self, tag: str) -> int:
+        return len(self.db_data.tags.get(tag, ()))
+
+    async def count_object_tags(self, tagged_object: str) -> int:
+        return len(self.db_data.objects.get(tagged_object, ()))
+
+    async def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return self.tag_popularity.top(k)
+
+    async def get_related_tags(self, tag: str, k: int = 10,
+                               score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        tags = self.db_data.tags
+        count_objects = lambda name: len(tags.get(name, ()))
+        if self.tag_cooccurrence is not None:
+            return self.tag_cooccurrence.top(tag, k, count_objects, score)
+        # Without the index every object of the tag is visited
+        together = collections.Counter()
+        for each in tags.get(tag, ()):
+            together.update(self.db_data.objects.get(each, ()))
+        together.pop(tag, None)
+        return rank_related(together, k, count_objects, score, count_objects(tag))
+
+    @staticmethod
+    def _names_after(names, after: Optional[str], prefix: Optional[str] = None, start: Optional[str] = None,
+                     end: Optional[str] = None) -> Iterator[str]:
+        # names is a SortedDict or a SortedSet (or the equivalent views of the interned layout). The range is
+        # located by bisection, so listing k names of a prefix is O(log n + k)
+        if after is None and prefix is None and start is None and end is None:
+            return iter(names)
+        minimum, include_minimum = None, True
+        for bound, inclusive in ((start, True), (prefix, True), (after, False)):
+            if bound is not None and (minimum is None or bound > minimum or (bound == minimum and not inclusive)):
+                minimum, include_minimum = bound, inclusive
+        found = names.irange(minimum=minimum, maximum=end, inclusive=(include_minimum, False))
+        if prefix is None:
+            return found
+        return itertools.takewhile(lambda name: name.startswith(prefix), found)
+
+    @classmethod
+    def _page(cls, names, limit: int, offset: int, after: Optional[str], prefix: Optional[str] = None,
+              start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        if after is None and prefix is None and start is None and end is None:
+            return list(names.islice(offset, offset + limit))
+        return list(itertools.islice(cls._names_after(names, after, prefix, start, end), offset, offset + limit))
+
+    async def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                            none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                            after: Optional[str] = None, prefix: Optional[str] = None,
+                            start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return list(itertools.islice(self._query_objects(all_tags, any_tags, none_tags, after, prefix, start,
+                                                         end), offset, offset + limit))
+
+    def _query_objects(self, all_tags: Collection[str], any_tags: Collection[str],
+                       none_tags: Collection[str], after: Optional[str] = None, prefix: Optional[str] = None,
+                       start: Optional[str] = None, end: Optional[str] = None) -> Iterator[str]:
+        tags = self.db_data.tags
+        all_sets = [tags.get(each) for each in set(all_tags)]
+        any_sets = [tags[each] for each in set(any_tags) if each in tags]
+        none_sets = [tags[each] for each in set(none_tags) if each in tags]
+        if any(each is None for each in all_sets) or (any_tags and not any_sets):
+            return
+        if all_sets:
+            # Walk the smallest set in order and probe the others
+            all_sets.sort(key=len)
+            candidates = self._names_after(all_sets.pop(0), after, prefix, start, end)
+        elif any_sets:
+            merged = heapq.merge(*(self._names_after(each, after, prefix, start, end) for each in any_sets))
+            candidates = (name for name, _ in itertools.groupby(merged))
+            any_sets = []
+        else:
+            candidates = self._names_after(self.db_data.objects, after, prefix, start, end)
+        for candidate in candidates:
+            if all(candidate in each for each in all_sets) \
+                    and (not any_sets or any(candidate in each for each in any_sets)) \
+                    and not any(candidate in each for each in none_sets):
+                yield candidate
 
     async def tag(self, object_to_tag: str, tags: Collection[str]):
-        async with self.lock.writer_lock:
-            tags_set = self.db_data.objects.get(object_to_tag)
-            if tags_set is None:
-                tags_set = SortedSet()
-                self.db_data.objects[object_to_tag] = tags_set
-            tags_set.update(tags)
-            for each in tags:
-                tagged_objects = self.db_data.tags.get(each)
-                if tagged_objects is None:
-                    tagged_objects = SortedSet()
-                    self.db_data.tags[each] = tagged_objects
-                tagged_objects.add(object_to_tag)
-            self.dirty = True
+        await self._apply((pickle_storage_journal.TAG, object_to_tag, list(tags)))
 
     async def remove_tag(self, tag_to_remove: str):
-        async with self.lock.writer_lock:
-            tagged_objects = self.db_data.tags.pop(tag_to_remove, None)
-            if tagged_objects is not None:
-                for each in tagged_objects:
-                    tags_set = self.db_data.objects.get(each)
-                    if tags_set is None:
-                        continue
-                    tags_set.remove(tag_to_remove)
-            self.dirty = True
+        await self._apply((pickle_storage_journal.REMOVE_TAG, tag_to_remove))
 
     async def remove_object(self, object_to_remove: str):
-        async with self.lock.writer_lock:
-            tags = self.db_data.objects.pop(object_to_remove, None)
-            if tags is not None:
-                for each in tags:
-                    objects_set = self.db_data.tags.get(each)
-                    if objects_set is None:
-                        continue
-                    objects_set.remove(object_to_remove)
-            self.dirty = True
+        await self._apply((pickle_storage_journal.REMOVE_OBJECT, object_to_remove))
 
     async def untag(self, object_to_untag: str, tags: Collection[str]):
-        async with self.lock.writer_lock:
-            tags_set = self.db_data.objects.get(object_to_untag)
-            if tags_set is None:
-                return
-            tags_set.difference_update(tags)
+        await self._apply((pickle_storage_journal.UNTAG, object_to_untag, list(tags)))
+
+    async def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        results, valid = validate_bulk_operations(operations)
+        applied = [operation for operation, _ in valid]
+        if not applied:
+            return results
+        # The whole batch under one acquisition, a snapshot has all of it or none. A remove_tag in it is applied at
+        # once instead of in chunks.
+        async with self._exclusive_locked():
+            for operation in applied:
+                record = self._bulk_operation_record(operation)
+                self._apply_record(record)
+                self._record(record)
+        # Once for all of them, they can share a flush
+        await self.synchronizer.changed()
+        self._publish(applied)
+        return results
+
+    async def _apply(self, record: JournalRecord):
+        await self._change(record)
+        await self.synchronizer.changed()
+        if self.changes is not None:
+            self._publish([self._record_operation(record)])
+
+    async def _change(self, record: JournalRecord):
+        operation, *args = record
+        if operation == pickle_storage_journal.REMOVE_TAG:
+            await self.__remove_tag_in_chunks(*args)
+            return
+        async with self._shared_locked():
+            self._apply_record(record)
+            self._record(record)
+
+    async def __remove_tag_in_chunks(self, tag_to_remove: str):
+        # The tag is unlinked from remove_chunk_size objects at a time, other tasks run between the chunks. Its
+        # record is written first too, so a crash in the middle finishes the removal when the journal is replayed.
+        record = (pickle_storage_journal.REMOVE_TAG, tag_to_remove)
+        async with self._shared_locked():
+            self._record(record)
+            self.removing_tags[tag_to_remove] += 1
+        try:
+            removed = False
+            while not removed:
+                async with self._shared_locked():
+                    chunk = list(self.db_data.tags.get(tag_to_remove, SortedSet()).islice(
+                        0, self.config.remove_chunk_size))
+                    self._unlink_tag(tag_to_remove, chunk)
+                    if not self.db_data.tags.get(tag_to_remove, ()):
+                        self._remove_tag(tag_to_remove)
+                        self._record(record)
+                        removed = True
+                if not removed:
+                    await asyncio.sleep(0)
+        finally:
+            self.removing_tags[tag_to_remove] -= 1
+            if not self.removing_tags[tag_to_remove]:
+                del self.removing_tags[tag_to_remove]
+
+    def __record_removals_in_progress(self):
+        # A snapshot taken between the chunks of a remove_tag has only part of it, its record must outlive the
+        # journal truncation
+        for each in self.removing_tags:
+            self.journal.append((pickle_storage_journal.REMOVE_TAG, each))
+
+    @staticmethod
+    def _bulk_operation_record(operation: BulkOperation) -> JournalRecord:
+        if operation.operation == BulkOperationType.TAG:
+            return pickle_storage_journal.TAG, operation.object_name, list(operation.tags)
+        if operation.operation == BulkOperationType.UNTAG:
+            return pickle_storage_journal.UNTAG, operation.object_name, list(operation.tags)
+        if operation.operation == BulkOperationType.REMOVE_OBJECT:
+            return pickle_storage_journal.REMOVE_OBJECT, operation.object_name
+        return pickle_storage_journal.REMOVE_TAG, operation.tag_name
+
+    @staticmethod
+    def _record_operation(record: JournalRecord) -> BulkOperation:
+        operation, *args = record
+        if operation == pickle_storage_journal.TAG:
+            return BulkOperation(BulkOperationType.TAG, object_name=args[0], tags=list(args[1]))
+        if operation == pickle_storage_journal.UNTAG:
+            return BulkOperation(BulkOperationType.UNTAG, object_name=args[0], tags=list(args[1]))
+        if operation == pickle_storage_journal.REMOVE_OBJECT:
+            return BulkOperation(BulkOperationType.REMOVE_OBJECT, object_name=args[0])
+        return BulkOperation(BulkOperationType.REMOVE_TAG, tag_name=args[0])
+
+    # Both sides of an edge are created before linking them, and unlinked before removing either of them
+    def _tag(self, object_to_tag: str, tags: Collection[str]):
+        tags_set = self._set_to_change(self.db_data.objects, object_to_tag)
+        if tags_set is None:
+            self.db_data.objects[object_to_tag] = SortedSet()
+            tags_set = self.db_data.objects[object_to_tag]
+        cooccurrence = self.tag_cooccurrence
+        added = [each for each in dict.fromkeys(tags) if each not in tags_set] if cooccurrence is not None else ()
+        for each in tags:
+            tagged_objects = self._set_to_change(self.db_data.tags, each)
+            if tagged_objects is None:
+                self.db_data.tags[each] = SortedSet()
+                tagged_objects = self.db_data.tags[each]
+                self.tag_popularity.added(each)
+            before = len(tagged_objects)
+            tagged_objects.add(object_to_tag)
+            self.tag_popularity.changed(each, before, len(tagged_objects))
+        tags_set.update(tags)
+        if cooccurrence is not None:
+            cooccurrence.tagged(added, tags_set)
+        self.versions.changed(tags, [object_to_tag])
+
+    def _remove_tag(self, tag_to_remove: str):
+        tagged_objects = self.db_data.tags.get(tag_to_remove)
+        if tagged_objects is not None:
+            for each in tagged_objects:
+                tags_set = self._set_to_change(self.db_data.objects, each)
+                if tags_set is None:
+                    continue
+                if self.tag_cooccurrence is not None and tag_to_remove in tags_set:
+                    self.tag_cooccurrence.untagged([tag_to_remove], tags_set)
+                tags_set.discard(tag_to_remove)
+            self.tag_popularity.removed(tag_to_remove, len(tagged_objects))
+            if self.tag_cooccurrence is not None:
+                self.tag_cooccurrence.removed(tag_to_remove)
+            self.versions.changed([tag_to_remove], tagged_objects)
+            self.db_data.tags.pop(tag_to_remove)
+
+    def _unlink_tag(self, tag: str, objects: Collection[str]):
+        tagged_objects = self._set_to_change(self.db_data.tags, tag)
+        if tagged_objects is None:
+            return
+        before = len(tagged_objects)
+        for each in objects:
+            tags_set = self._set_to_change(self.db_data.objects, each)
+            if tags_set is not None:
+                if self.tag_cooccurrence is not None and tag in tags_set:
+                    self.tag_cooccurrence.untagged([tag], tags_set)
+                tags_set.discard(tag)
+        tagged_objects.difference_update(objects)
+        self.tag_popularity.changed(tag, before, len(tagged_objects))
+        self.versions.changed([tag], objects)
+
+    def _remove_object(self, object_to_remove: str):
+        tags = self.db_data.objects.get(object_to_remove)
+        if tags is not None:
+            if self.tag_cooccurrence is not None:
+                self.tag_cooccurrence.untagged(list(tags), tags)
             for each in tags:
-                tagged_objects = self.db_data.tags.get(each)
-                if tagged_objects is None:
+                objects_set = self._set_to_change(self.db_data.tags, each)
+                if objects_set is None:
                     continue
-                tagged_objects.remove(object_to_untag)
-            self.dirty = True
+                before = len(objects_set)
+                objects_set.discard(object_to_remove)
+                self.tag_popularity.changed(each, before, len(objects_set))
+            self.versions.changed(tags, [object_to_remove])
+            self.db_data.objects.pop(object_to_remove)
+
+    def _untag(self, object_to_untag: str, tags: Collection[str]):
+        tags_set = self._set_to_change(self.db_data.objects, object_to_untag)
+        if tags_set is None:
+            return
+        if self.tag_cooccurrence is not None:
+            self.tag_cooccurrence.untagged([each for each in dict.fromkeys(tags) if each in tags_set], tags_set)
+        tags_set.difference_update(tags)
+        for each in tags:
+            tagged_objects = self._set_to_change(self.db_data.tags, each)
+            if tagged_objects is None:
+                continue
+            before = len(tagged_objects)
+            tagged_objects.discard(object_to_untag)
+            self.tag_popularity.changed(each, before, len(tagged_objects))
+        self.versions.changed(tags, [object_to_untag])
+
+    def _set_to_change(self, names, name: str):
+        # The set of name in names, db_data.tags or db_data.objects, copied first if the snapshot being written
+        # shares it. The views of the other layouts take care of it themselves.
+        values = names.get(name)
+        if self.snapshot is None or not isinstance(values, SortedSet):
+            return values
+        shared = self.snapshot.tags if names is self.db_data.tags else self.snapshot.objects
+        if shared.get(name) is values:
+            values = names[name] = SortedSet(values)
+        return values
+
+    def _record(self, record: JournalRecord):
+        if not self.dirty:
+            self.dirty_since = time.monotonic()
+        self.dirty = True
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def _apply_record(self, record: JournalRecord):
+        operation, *args = record
+        if operation == pickle_storage_journal.TAG:
+            self._tag(*args)
+        elif operation == pickle_storage_journal.UNTAG:
+            self._untag(*args)
+        elif operation == pickle_storage_journal.REMOVE_TAG:
+            self._remove_tag(*args)
+        elif operation == pickle_storage_journal.REMOVE_OBJECT:
+            self._remove_object(*args)
+        else:
+            raise InvalidPickleDatabaseFile(f"{self.journal.path} contains an unknown operation {operation!r}")
 
     async def offline_sync(self):
-        async with self.lock.reader_lock:
-            if self.dirty:
-                async with aiofiles.open(self.db_path, 'wb') as f:
-                    s = pickle.dumps(self.db_data)
-                    await f.write(s)
-                self.dirty = False
+        # After an online snapshot being written from a copy, both write the same temporary file
+        async with self.sync_lock:
+            async with self._exclusive_locked():
+                if self.dirty:
+                    start = time.perf_counter()
+                    if self.journal is not None:
+                        await self.journal.flush()
+                        self.journal.mark()
+                    try:
+                        await self.__write_snapshot(self.db_data)
+                    except BaseException:
+                        if self.journal is not None:
+                            self.journal.unmark()
+                        raise
+                    self.dirty = False
+                    if self.journal is not None:
+                        self.__record_removals_in_progress()
+                        await self.journal.truncate()
+                        if self.config.mapped:
+                            self.__map_snapshot()
+                        else:
+                            self.journal.unmark()
+                    self.instrumentation.observe('tagapi_sync_duration_seconds', time.perf_counter() - start,
+                                                 mode='offline')
 
     async def online_sync(self):
-        async with self.lock.reader_lock:
-            if self.dirty:
-                snapshot = copy.deepcopy(self.db_data)
-                self.dirty = False
-            else:
+        # A sync that finds the store clean must not return while a previous snapshot is still being written
+        async with self.sync_lock:
+            await self.__online_sync()
+
+    async def __online_sync(self):
+        if self.journal is not None:
+            await self.journal.flush()
+            if not self.journal.needs_checkpoint():
+                return
+        async with self._exclusive_locked():
+            if not self.dirty:
                 return
-        async with aiofiles.open(self.db_path, 'wb') as f:
-            s = pickle.dumps(snapshot)
-            await f.write(s)
+            start = time.perf_counter()
+            if self.journal is not None:
+                # The log must hold every record of the snapshot until it replaces the file: replaying only part
+                # of them over the new snapshot could undo the others
+                await self.journal.flush()
+                self.journal.mark()
+            if self.config.snapshot_mode == SnapshotMode.FORK:
+                pid = self.__fork_snapshot()
+            else:
+                snapshot = self.snapshot = self.__copy_for_snapshot()
+            self.dirty = False
+            if self.journal is not None:
+                self.__record_removals_in_progress()
+        try:
+            if self.config.snapshot_mode == SnapshotMode.FORK:
+                await self.__wait_snapshot(pid)
+            else:
+                await self.__write_snapshot(snapshot)
+        except BaseException:
+            if self.journal is not None:
+                self.journal.unmark()
+            raise
+        finally:
+            self.__release_snapshot()
+        if self.journal is not None:
+            await self.journal.truncate()
+            if self.config.mapped:
+                async with self._exclusive_locked():
+                    self.__map_snapshot()
+            else:
+                self.journal.unmark()
+        self.instrumentation.observe('tagapi_sync_duration_seconds', time.perf_counter() - start, mode='online')
+
+    def __map_snapshot(self):
+        # The changes kept in memory on top of the previous file are in the new one, except the ones made while it
+        # was written, which the journal has since its mark
+        self.db_data = MappedDbData.open(self.db_path)
+        self.tag_popularity = self._new_tag_popularity(self.db_data)
+        self.tag_cooccurrence = self._new_tag_cooccurrence(self.db_data)
+        for record in self.journal.unmark() + self.journal.pending:
+            self._apply_record(record)
+
+    def _shared_locked(self) -> AsyncContextManager:
+        # Every write takes it, it is the lock itself when nothing is measured. The reader side of the lock is the
+        # shared one, writes don't exclude each other because they never await while they change the data.
+        if not self.instrumentation.enabled:
+            return self.snapshot_lock.reader_lock
+        return self.__timed_lock(self.snapshot_lock.reader_lock, 'shared')
+
+    def _exclusive_locked(self) -> AsyncContextManager:
+        # Snapshots, and the batches that no snapshot may split
+        if not self.instrumentation.enabled:
+            return self.snapshot_lock.writer_lock
+        return self.__timed_lock(self.snapshot_lock.writer_lock, 'exclusive')
+
+    @contextlib.asynccontextmanager
+    async def __timed_lock(self, lock: AsyncContextManager, mode: str):
+        start = time.perf_counter()
+        async with lock:
+            acquired = time.perf_counter()
+            self.instrumentation.observe('tagapi_lock_wait_seconds', acquired - start, mode=mode)
+            try:
+                yield
+            finally:
+                self.instrumentation.observe('tagapi_lock_hold_seconds', time.perf_counter() - acquired, mode=mode)
+
+    def collect_metrics(self):
+        self.instrumentation.set('tagapi_tags', len(self.db_data.tags))
+        self.instrumentation.set('tagapi_objects', len(self.db_data.objects))
+        self.instrumentation.set('tagapi_dirty_age_seconds', time.monotonic() - self.dirty_since if self.dirty else 0)
+        if os.path.exists(self.db_path):
+            self.instrumentation.set('tagapi_snapshot_bytes', os.path.getsize(self.db_path))
+        if self.journal is not None and os.path.exists(self.journal.path):
+            self.instrumentation.set('tagapi_journal_bytes', os.path.getsize(self.journal.path))
+
+    def __copy_for_snapshot(self) -> DbData:
+        # Only the maps are copied, a write copies a set they share before changing it (see _set_to_change)
+        db_data = self.db_data
+        if isinstance(db_data, PickleDbData):
+            return PickleDbData(tags=SortedDict(db_data.tags), objects=SortedDict(db_data.objects))
+        if isinstance(db_data, InternedPickleDbData):
+            return db_data.shared_copy()
+        # The file can't change, only the changes on top of it are copied
+        return copy.deepcopy(db_data)
+
+    def __release_snapshot(self):
+        self.snapshot = None
+        if isinstance(self.db_data, InternedPickleDbData):
+            self.db_data.release_shared_copy()
+
+    def __fork_snapshot(self) -> int:
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        # Child: nothing else runs here, so the data can't change while it is pickled. The collector is
+        # disabled to avoid touching (and copying) pages that only hold gc bookkeeping.
+        gc.disable()
+        tmp_path = f"{self.db_path}.{os.getpid()}.tmp"
+        status = 1
+        try:
+            self.__dump_file(self.db_data, tmp_path)
+            os.replace(tmp_path, self.db_path)
+            status = 0
+        finally:
+            if status != 0 and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os._exit(status)
+
+    async def __wait_snapshot(self, pid: int):
+        loop = asyncio.get_event_loop()
+        _, status = await loop.run_in_executor(None, os.waitpid, pid, 0)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            self.dirty = True
+            raise SnapshotFailed(f"The process writing the snapshot of {self.db_path} failed with status {status}")
+
+    async def __write_snapshot(self, db_data: DbData):
+        # Write aside and rename, a crash while writing must not destroy the previous snapshot. db_data must not
+        # change meanwhile, it is written from another thread.
+        tmp_path = f"{self.db_path}.tmp"
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.__dump_file, db_data, tmp_path)
+        os.replace(tmp_path, self.db_path)
+
+    def __dump_file(self, db_data: DbData, path: str):
+        with open(path, 'wb') as f:
+            self._dump(db_data, f)
+            # On disk before it replaces the previous snapshot, the journal is truncated after that
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _dump(self, db_data: DbData, f):
+        if self.config.mapped:
+            write_mapped_db_data(db_data, f)
+        else:
+            pickle.dump(db_data, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     async def close(self):
         await self.synchronizer.close()
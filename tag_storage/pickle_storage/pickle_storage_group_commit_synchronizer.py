@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import datetime
+import enum
+import logging
+from dataclasses import field
+from typing import List, Optional
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage
+from tag_storage.pickle_storage.pickle_storage_synchronizer import PickledSetTagStorageSynchronizer, \
+    PickledSetTagStorageSynchronizerConfiguration
+
+
+class Durability(str, enum.Enum):
+    # The journal, if any, is flushed every interval by PickledSetTagStoragePeriodicSynchronizer
+    ASYNC = 'async'
+    # Writes return once they are on disk, the ones waiting together share a flush
+    GROUP_COMMIT = 'group_commit'
+    # Writes return at once, the journal is flushed after max_changes writes or max_delay
+    ADAPTIVE = 'adaptive'
+
+
+@dataclasses.dataclass
+class PickledSetTagStorageGroupCommitSynchronizerConfiguration(PickledSetTagStorageSynchronizerConfiguration):
+    # Writes return once their records are flushed (and synced with fsync). Without it they return at once and
+    # are flushed in the background, as with the periodic synchronizer but after max_changes or max_delay.
+    wait: bool = True
+    max_changes: int = 1000  # the journal is flushed when this many writes are waiting...
+    # ...or when the first of them waited this long. Writes that arrive while a flush runs share the next one
+    # even with no delay.
+    max_delay: datetime.timedelta = field(default_factory=lambda: datetime.timedelta(0))
+    fsync: bool = True
+
+
+class PickledSetTagStorageGroupCommitSynchronizer(PickledSetTagStorageSynchronizer):
+    """
+    Flushes the journal of the store after its writes instead of every interval, so a write can wait until it
+    is durable and concurrent writes share one flush and one fsync. A snapshot is written in the background when
+    the journal needs a checkpoint.
+    """
+    needs_journal = True
+    config: PickledSetTagStorageGroupCommitSynchronizerConfiguration
+    store: Optional[PickledSetTagStorage]
+    changes: int  # writes since the last flush
+    waiters: List[asyncio.Future]
+    checkpoint: Optional[asyncio.Task]
+
+    def __init__(self, config: PickledSetTagStorageGroupCommitSynchronizerConfiguration):
+        self.config = config
+        self.store = None
+        self.changes = 0
+        self.waiters = []
+        self.checkpoint = None
+        self.changed_event = asyncio.Event()
+        self.full_event = asyncio.Event()
+        self.task = asyncio.get_event_loop().create_task(self.__flush_loop())
+
+    def sync_store(self, store: PickledSetTagStorage):
+        self.store = store
+
+    async def changed(self):
+        self.changes += 1
+        self.changed_event.set()
+        if self.changes >= self.config.max_changes:
+            self.full_event.set()
+        if self.config.wait:
+            future = asyncio.get_event_loop().create_future()
+            self.waiters.append(future)
+            await future
+
+    async def __flush_loop(self):
+        while True:
+            await self.changed_event.wait()
+            delay = self.config.max_delay.total_seconds()
+            if delay > 0 and not self.full_event.is_set():
+                try:
+                    await asyncio.wait_for(self.full_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            # Shielded: close() cancels the loop, the writes of a flush in progress must get their result
+            await asyncio.shield(self.__flush())
+
+    async def __flush(self):
+        self.changed_event.clear()
+        self.full_event.clear()
+        self.changes = 0
+        waiters, self.waiters = self.waiters, []
+        try:
+            if self.store is not None:
+                await self.store.journal.flush(fsync=self.config.fsync)
+        except Exception as e:
+            # The data has these writes and the next snapshot saves them, but they are not durable yet
+            logging.getLogger(__name__).exception(e)
+            self.store.instrumentation.increment('tagapi_sync_failures_total')
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if self.store is not None and self.store.journal.needs_checkpoint() \
+                and (self.checkpoint is None or self.checkpoint.done()):
+            self.checkpoint = asyncio.get_event_loop().create_task(self.__checkpoint())
+
+    async def __checkpoint(self):
+        try:
+            await self.store.online_sync()
+        except Exception as e:
+            # The journal keeps growing until a checkpoint succeeds, the next flush tries again
+            logging.getLogger(__name__).exception(e)
+            self.store.instrumentation.increment('tagapi_sync_failures_total')
+
+    async def close(self):
+        self.task.cancel()
+        await self.__flush()
+        if self.checkpoint is not None:
+            await self.checkpoint
+        if self.store is not None:
+            await self.store.online_sync()
+        # Nothing is left pending when the event loop is closed
+        await asyncio.wait([self.task])
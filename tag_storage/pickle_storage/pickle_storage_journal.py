@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import os.path
+import pickle
+from typing import List, Optional, Tuple, Iterator
+
+TAG = 't'
+UNTAG = 'u'
+REMOVE_TAG = 'rt'
+REMOVE_OBJECT = 'ro'
+
+JournalRecord = Tuple
+
+
+@dataclasses.dataclass
+class PickledSetTagStorageJournalConfiguration:
+    path: Optional[str] = None  # defaults to <db path>.journal
+    checkpoint_bytes: int = 64 * 1024 * 1024
+
+
+class PickledSetTagStorageJournal:
+    """
+    Append-only log of the mutations applied to a PickledSetTagStorage since its last snapshot.
+
+    Mutations are buffered in memory with append() and written to the end of the log with flush(), so the
+    cost of persisting a change is proportional to the change instead of to the whole database. Once the
+    log grows past checkpoint_bytes the store writes a new snapshot and truncates the log.
+    Every record is idempotent, so replaying a log over a snapshot that already contains some of its
+    records yields the same data.
+
+    Other processes can follow the log with tail(). truncate() replaces the file instead of emptying it, so
+    they can tell by its inode that it was restarted after a new snapshot.
+
+    Records are pickled and written in a thread, one flush at a time so they reach the file in order. A snapshot
+    calls mark() when it takes the data: the records flushed after that are not in it, and truncate() carries them
+    over to the new log.
+    """
+    path: str
+    checkpoint_bytes: int
+    pending: List[JournalRecord]
+    since_mark: Optional[List[JournalRecord]]  # flushed after mark(), None when there is no mark
+    size: int
+    flush_lock: asyncio.Lock
+
+    def __init__(self, path: str, checkpoint_bytes: int):
+        self.path = path
+        self.checkpoint_bytes = checkpoint_bytes
+        self.pending = []
+        self.since_mark = None
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.flush_lock = asyncio.Lock()
+
+    def reset(self):
+        open(self.path, 'wb').close()
+        self.size = 0
+
+    def append(self, record: JournalRecord):
+        self.pending.append(record)
+
+    def replay(self) -> Iterator[JournalRecord]:
+        if not os.path.exists(self.path):
+            return
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError, AttributeError, IndexError):
+                    # A torn write at the end of the log, the records before it are still valid
+                    break
+                valid_size = f.tell()
+                yield record
+        if valid_size != self.size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_size)
+            self.size = valid_size
+
+    def tail(self, offset: int, inode: Optional[int] = None) -> Tuple[List[JournalRecord], int, Optional[int]]:
+        """
+        The whole records written from offset on, the offset after the last of them and the inode of the log. If
+        the log is not the file with the given inode anymore it was restarted, and it is read from the beginning.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return [], 0, None
+        records = []
+        with f:
+            file_inode = os.fstat(f.fileno()).st_ino
+            if file_inode != inode:
+                offset = 0
+            f.seek(offset)
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError, IndexError):
+                    # The end of the log or a record still being written, the next tail reads it again
+                    break
+                offset = f.tell()
+        return records, offset, file_inode
+
+    def take_pending(self) -> List[JournalRecord]:
+        records, self.pending = self.pending, []
+        return records
+
+    async def flush(self, fsync: bool = False):
+        """Writes the pending records, and with fsync returns once they are on disk"""
+        async with self.flush_lock:
+            records = self.take_pending()
+            if not records and not fsync:
+                return
+            if self.since_mark is not None:
+                self.since_mark.extend(records)
+            loop = asyncio.get_event_loop()
+            self.size += await loop.run_in_executor(None, self.__write, self.path, 'ab', records, fsync)
+
+    @staticmethod
+    def __write(path: str, mode: str, records: List[JournalRecord], fsync: bool) -> int:
+        data = b''.join(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL) for record in records)
+        with open(path, mode) as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return len(data)
+
+    def needs_checkpoint(self) -> bool:
+        return self.size >= self.checkpoint_bytes
+
+    def mark(self):
+        self.since_mark = []
+
+    def unmark(self) -> List[JournalRecord]:
+        """The records flushed since mark()"""
+        records, self.since_mark = self.since_mark or [], None
+        return records
+
+    async def truncate(self):
+        """Restarts the log after a snapshot, with the records flushed since the snapshot called mark()"""
+        async with self.flush_lock:
+            tmp_path = f"{self.path}.tmp"
+            loop = asyncio.get_event_loop()
+            # Synced before it replaces the log, some of the records may have been reported durable already
+            size = await loop.run_in_executor(None, self.__write, tmp_path, 'wb', list(self.since_mark or []), True)
+            os.replace(tmp_path, self.path)
+            self.size = size
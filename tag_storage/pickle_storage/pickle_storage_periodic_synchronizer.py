@@ -3,6 +3,7 @@ from __future__ import annotations
 import asyncio
 import dataclasses
 import datetime
+import logging
 from dataclasses import field
 from typing import Optional
 from typing import TYPE_CHECKING
@@ -34,7 +35,14 @@ class PickledSetTagStoragePeriodicSynchronizer(PickledSetTagStorageSynchronizer)
 
     async def __sync_loop(self):
         while True:
-            await self.__sync()
+            try:
+                # Shielded: close() cancels the loop, a snapshot being written must finish before close() syncs
+                await asyncio.shield(self.__sync())
+            except Exception as e:
+                # Keep syncing, the store stays dirty and the next tick retries
+                logging.getLogger(__name__).exception(e)
+                if self.store:
+                    self.store.instrumentation.increment('tagapi_sync_failures_total')
             await asyncio.sleep(self.interval.total_seconds())
 
     async def __sync(self):
@@ -47,3 +55,5 @@ class PickledSetTagStoragePeriodicSynchronizer(PickledSetTagStorageSynchronizer)
     async def close(self):
         self.task.cancel()
         await self.__sync()
+        # Nothing is left pending when the event loop is closed
+        await asyncio.wait([self.task])
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import os.path
+from typing import Collection, Optional, Tuple, List
+
+from tag_storage.base_storage.tag_storage import TagStorageException
+from tag_storage.base_storage.versions import Versions
+from tag_storage.pickle_storage.interned_db_data import InternedPickleDbData
+from tag_storage.pickle_storage.pickle_db_data import PickleDbData
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration, \
+    DbData
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournal, \
+    PickledSetTagStorageJournalConfiguration, JournalRecord
+from tag_storage.pickle_storage.tag_cooccurrence import TagCooccurrence
+from tag_storage.pickle_storage.tag_popularity import TagPopularity
+
+SnapshotId = Tuple[int, int, int]  # inode, size and modification time of a snapshot file
+
+
+class ReadOnlyReplica(TagStorageException):
+    pass
+
+
+def _snapshot_id(stat: os.stat_result) -> SnapshotId:
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class PickledSetTagStorageReplica(PickledSetTagStorage):
+    """
+    Read-only copy of a PickledSetTagStorage written by another process. refresh() loads the snapshot again when
+    it was replaced, and otherwise applies the records appended to the journal since the previous refresh.
+    """
+    snapshot_id: Optional[SnapshotId]
+    journal_offset: int
+    journal_inode: Optional[int]
+
+    def __init__(self, config: PickledSetTagStorageConfiguration):
+        self.config = config
+        self.db_path = config.path
+        self.dirty = False
+        self.removing_tags = collections.Counter()
+        self.versions = Versions()
+        self.snapshot = None  # it never writes one
+        journal_config = config.journal or PickledSetTagStorageJournalConfiguration()
+        self.journal = PickledSetTagStorageJournal(journal_config.path or f"{self.db_path}.journal",
+                                                   journal_config.checkpoint_bytes)
+        self.__install(*self.__read())
+
+    async def refresh(self):
+        if self.snapshot_id == self.__current_snapshot_id():
+            records, offset, inode = self.journal.tail(self.journal_offset, self.journal_inode)
+            # A restarted journal follows a newer snapshot than the loaded one when the snapshot changed meanwhile
+            if self.snapshot_id == self.__current_snapshot_id():
+                self.apply_records(records)
+                self.journal_offset, self.journal_inode = offset, inode
+                return
+        # Loading a big snapshot takes a while, the current data is still served until it is done
+        loop = asyncio.get_event_loop()
+        self.__install(*await loop.run_in_executor(None, self.__read))
+
+    def apply_records(self, records: Collection[JournalRecord]):
+        for record in records:
+            self._apply_record(record)
+
+    def __current_snapshot_id(self) -> Optional[SnapshotId]:
+        try:
+            return _snapshot_id(os.stat(self.db_path))
+        except FileNotFoundError:
+            return None
+
+    def __read(self) -> Tuple[Optional[SnapshotId], DbData, TagPopularity, Optional[TagCooccurrence],
+                              List[JournalRecord], int, Optional[int]]:
+        # Nothing here touches the served data, it runs in a thread
+        while True:
+            try:
+                with open(self.db_path, 'rb') as f:
+                    snapshot_id = _snapshot_id(os.fstat(f.fileno()))
+                    db_data, _ = self._load_snapshot(f, self.db_path, self.config)
+            except FileNotFoundError:
+                # The owner didn't write it yet
+                snapshot_id = None
+                db_data = InternedPickleDbData() if self.config.compact else PickleDbData()
+            records, offset, inode = self.journal.tail(0)
+            if snapshot_id == self.__current_snapshot_id():
+                return snapshot_id, db_data, self._new_tag_popularity(db_data), self._new_tag_cooccurrence(db_data), \
+                       records, offset, inode
+
+    def __install(self, snapshot_id: Optional[SnapshotId], db_data: DbData, tag_popularity: TagPopularity,
+                  tag_cooccurrence: Optional[TagCooccurrence],
+                  records: List[JournalRecord], offset: int, inode: Optional[int]):
+        self.db_data = db_data
+        self.tag_popularity = tag_popularity
+        self.tag_cooccurrence = tag_cooccurrence
+        # What the new snapshot changed is not known
+        self.versions.reset()
+        self.apply_records(records)
+        self.snapshot_id = snapshot_id
+        self.journal_offset, self.journal_inode = offset, inode
+
+    async def _change(self, record: JournalRecord):
+        raise ReadOnlyReplica(f"{self.db_path} is written by another process")
+
+    async def offline_sync(self):
+        pass
+
+    async def online_sync(self):
+        pass
+
+    async def close(self):
+        pass
@@ -22,6 +22,7 @@ class PickledSetTagStorageSynchronizer(ABC):
     #    store (PickledSetTagStorage): The store to sync
 
     """
+    needs_journal = False  # the store keeps a journal even if its configuration has none
 
     @abc.abstractmethod
     def __init__(self, config: PickledSetTagStorageSynchronizerConfiguration):
@@ -31,6 +32,9 @@ class PickledSetTagStorageSynchronizer(ABC):
     async def sync_store(self, store: PickledSetTagStorage):
         raise NotImplementedError
 
+    async def changed(self):
+        """Called by the store after each write, which returns when this does"""
+
     @abc.abstractmethod
     async def close(self):
         raise NotImplementedError
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import datetime
+import logging
+from dataclasses import field
+from typing import Collection, Dict, List, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, validate_bulk_operations
+from tag_storage.base_storage.instrumentation import Instrumentation
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+from tag_storage.base_storage.tag_storage import TagStorageException
+from tag_storage.base_storage.change_feed import ChangeFeed
+from tag_storage.base_storage.versions import Versions
+from tag_storage.pickle_storage import pickle_storage_journal
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration, JournalRecord
+from tag_storage.pickle_storage.pickle_storage_replica import PickledSetTagStorageReplica
+from tag_storage.pickle_storage.pickle_storage_write_channel import WriteChannelClient, WriteChannelServer
+
+
+@dataclasses.dataclass
+class PickledSetTagStorageWorkersConfiguration:
+    socket_path: Optional[str] = None  # defaults to <db path>.sock
+    lock_path: Optional[str] = None  # defaults to <db path>.owner
+    refresh_interval: datetime.timedelta = field(default_factory=lambda: datetime.timedelta(seconds=1))
+    owner_timeout: float = 5.0  # seconds a write waits for an owner, while another worker takes over
+
+
+class OwnerUnavailable(TagStorageException):
+    pass
+
+
+class SharedPickledSetTagStorage(AsyncTagStorage):
+    """
+    A PickledSetTagStorage shared by the worker processes of a server. The first worker to lock lock_path owns it:
+    it is the only one writing the files, and it applies the writes the other workers forward through socket_path.
+
+    The other workers read from a PickledSetTagStorageReplica refreshed every refresh_interval, so they see the
+    writes of the rest up to the synchronizer interval of the owner (which flushes the journal) plus refresh_interval
+    late. Their own writes are visible to them as soon as the owner accepts them. If the owner goes away, the first
+    worker to notice it, when refreshing or forwarding a write, takes the lock and becomes the owner.
+    """
+    config: PickledSetTagStorageConfiguration
+    workers_config: PickledSetTagStorageWorkersConfiguration
+    storage: Union[PickledSetTagStorage, PickledSetTagStorageReplica]
+    server: Optional[WriteChannelServer]
+
+    def __init__(self, config: PickledSetTagStorageConfiguration,
+                 workers_config: PickledSetTagStorageWorkersConfiguration):
+        if fcntl is None:
+            raise TagStorageException("Sharing a pickle storage among workers needs fcntl")
+        if config.journal is None:
+            # The replicas follow the journal
+            config = dataclasses.replace(config, journal=PickledSetTagStorageJournalConfiguration())
+        self.config = config
+        self.workers_config = workers_config
+        self.socket_path = workers_config.socket_path or f"{config.path}.sock"
+        self.lock_file = open(workers_config.lock_path or f"{config.path}.owner", 'ab')
+        self.election_lock = asyncio.Lock()
+        self.client = WriteChannelClient(self.socket_path)
+        self.server = None
+        self.refresh_task = None
+        if self.__lock_ownership():
+            self.__become_owner()
+        else:
+            self.storage = PickledSetTagStorageReplica(config)
+            self.refresh_task = asyncio.get_event_loop().create_task(self.__refresh_loop())
+
+    @property
+    def is_owner(self) -> bool:
+        return self.server is not None
+
+    def __lock_ownership(self) -> bool:
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def __become_owner(self):
+        self.storage = PickledSetTagStorage(self.config)
+        self.storage.instrument(self.instrumentation)
+        self.server = WriteChannelServer(self.socket_path, self.storage._apply)
+        self.server_task = asyncio.get_event_loop().create_task(self.server.serve())
+
+    async def __take_over(self) -> bool:
+        async with self.election_lock:
+            if self.is_owner:
+                return True
+            if not self.__lock_ownership():
+                return False
+            logging.getLogger(__name__).warning("The owner of %s went away, this worker owns it now",
+                                                self.config.path)
+            self.__become_owner()
+            return True
+
+    async def __refresh_loop(self):
+        while not self.is_owner:
+            await asyncio.sleep(self.workers_config.refresh_interval.total_seconds())
+            try:
+                if not await self.__take_over():
+                    await self.refresh()
+            except Exception as e:
+                # The replica keeps serving the data of the last refresh
+                logging.getLogger(__name__).exception(e)
+
+    def instrument(self, instrumentation: Instrumentation):
+        self.instrumentation = instrumentation
+        self.storage.instrument(instrumentation)
+
+    def collect_metrics(self):
+        self.storage.collect_metrics()
+
+    @property
+    def versions(self) -> Optional[Versions]:
+        # Those of the replica until this worker takes over, and then those of the storage it opens
+        return self.storage.versions
+
+    def watch_changes(self, feed: ChangeFeed):
+        # Each worker would only see the writes made through it
+        raise TagStorageException("The change feed needs a single worker, it can't follow the writes of the others")
+
+    async def refresh(self):
+        if not self.is_owner:
+            await self.storage.refresh()
+
+    async def _write(self, records: List[JournalRecord]):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.workers_config.owner_timeout
+        while not self.is_owner:
+            try:
+                await self.client.send(records)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                # Records are idempotent, sending them again is safe even if the owner applied them
+                if await self.__take_over():
+                    break
+                if loop.time() >= deadline:
+                    raise OwnerUnavailable(f"No worker owns {self.config.path}: {e}")
+                await asyncio.sleep(0.1)
+            else:
+                if not self.is_owner:
+                    self.storage.apply_records(records)
+                    return
+                # This worker took over meanwhile, the previous owner might not have journaled them
+        for record in records:
+            await self.storage._apply(record)
+
+    async def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                       prefix: Optional[str] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Collection[str]:
+        return await self.storage.get_tags(limit, offset, after, prefix, start, end)
+
+    async def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                          prefix: Optional[str] = None, start: Optional[str] = None,
+                          end: Optional[str] = None) -> Collection[str]:
+        return await self.storage.get_objects(limit, offset, after, prefix, start, end)
+
+    async def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                                 prefix: Optional[str] = None, start: Optional[str] = None,
+                                 end: Optional[str] = None) -> Collection[str]:
+        return await self.storage.get_tagged_objects(tag, limit, offset, after, prefix, start, end)
+
+    async def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                              after: Optional[str] = None, prefix: Optional[str] = None,
+                              start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self.storage.get_object_tags(tagged_object, limit, offset, after, prefix, start, end)
+
+    async def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                            none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                            after: Optional[str] = None, prefix: Optional[str] = None,
+                            start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self.storage.query_objects(all_tags, any_tags, none_tags, limit, offset, after, prefix, start,
+                                                end)
+
+    async def get_objects_with_tags(self, limit: int = 100,
+                                    after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        return await self.storage.get_objects_with_tags(limit, after)
+
+    async def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return await self.storage.get_many_tagged_objects(tags, limit)
+
+    async def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return await self.storage.get_many_object_tags(tagged_objects, limit)
+
+    async def count_tagged_objects(self, tag: str) -> int:
+        return await self.storage.count_tagged_objects(tag)
+
+    async def count_object_tags(self, tagged_object: str) -> int:
+        return await self.storage.count_object_tags(tagged_object)
+
+    async def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return await self.storage.get_top_tags(k)
+
+    async def get_related_tags(self, tag: str, k: int = 10,
+                               score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        return await self.storage.get_related_tags(tag, k, score)
+
+    async def tag(self, object_to_tag: str, tags: Collection[str]):
+        await self._write([(pickle_storage_journal.TAG, object_to_tag, list(tags))])
+
+    async def untag(self, object_to_untag: str, tags: Collection[str]):
+        await self._write([(pickle_storage_journal.UNTAG, object_to_untag, list(tags))])
+
+    async def remove_object(self, object_to_remove: str):
+        await self._write([(pickle_storage_journal.REMOVE_OBJECT, object_to_remove)])
+
+    async def remove_tag(self, tag_to_remove: str):
+        await self._write([(pickle_storage_journal.REMOVE_TAG, tag_to_remove)])
+
+    async def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        # The valid operations are forwarded in one request
+        results, valid = validate_bulk_operations(operations)
+        records = [PickledSetTagStorage._bulk_operation_record(operation) for operation, _ in valid]
+        if records:
+            await self._write(records)
+        return results
+
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        await self.client.close()
+        if self.is_owner:
+            await self.server.close()
+            await self.storage.close()
+        else:
+            # Idle until this worker became the owner
+            await self.config.synchronizer.close()
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
@@ -0,0 +1,137 @@
+"""
+Unix socket the workers of a shared PickledSetTagStorage forward their writes through to the worker that owns it.
+
+Every message is a 4 bytes big-endian length followed by a JSON body. A request is a list of journal records, which
+the owner applies in order, and its response is {"error": null} or {"error": "..."}.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import socket
+import struct
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from tag_storage.base_storage.tag_storage import TagStorageException
+from tag_storage.pickle_storage import pickle_storage_journal
+from tag_storage.pickle_storage.pickle_storage_journal import JournalRecord
+
+HEADER = struct.Struct(">I")
+
+
+class ForwardedWriteFailed(TagStorageException):
+    pass
+
+
+async def read_message(reader: asyncio.StreamReader) -> Any:
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads(await reader.readexactly(size))
+
+
+async def write_message(writer: asyncio.StreamWriter, message: Any):
+    body = json.dumps(message).encode()
+    writer.write(HEADER.pack(len(body)) + body)
+    await writer.drain()
+
+
+def parse_record(value: Any) -> JournalRecord:
+    if isinstance(value, list) and len(value) == 3 and value[0] in (pickle_storage_journal.TAG,
+                                                                     pickle_storage_journal.UNTAG) \
+            and isinstance(value[1], str) and isinstance(value[2], list) \
+            and all(isinstance(each, str) for each in value[2]):
+        return tuple(value)
+    if isinstance(value, list) and len(value) == 2 and value[0] in (pickle_storage_journal.REMOVE_TAG,
+                                                                     pickle_storage_journal.REMOVE_OBJECT) \
+            and isinstance(value[1], str):
+        return tuple(value)
+    raise ValueError(f"{value!r} is not a journal record")
+
+
+class WriteChannelServer:
+    """
+    Applies the records received on path with apply. The socket is bound when it is created, so workers can
+    connect before serve() runs.
+    """
+    path: str
+    apply: Callable[[JournalRecord], Awaitable[None]]
+    connections: Dict[asyncio.Task, asyncio.StreamWriter]
+
+    def __init__(self, path: str, apply: Callable[[JournalRecord], Awaitable[None]]):
+        self.path = path
+        self.apply = apply
+        self.connections = {}
+        self.server = None
+        # Only the owner gets here, a socket left by a previous owner is stale
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen()
+
+    async def serve(self):
+        self.server = await asyncio.start_unix_server(self.__handle, sock=self.socket)
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                try:
+                    request = await read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                error = None
+                try:
+                    if not isinstance(request, list):
+                        raise ValueError("expected a list of journal records")
+                    for record in [parse_record(each) for each in request]:
+                        await self.apply(record)
+                except (ValueError, TagStorageException) as e:
+                    error = str(e)
+                await write_message(writer, {"error": error})
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        else:
+            self.socket.close()
+        # Closing the connections ends their handlers, which must not be left to be cancelled
+        handlers = list(self.connections)
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class WriteChannelClient:
+    """Sends records to a WriteChannelServer, keeping the connections of finished requests for the next ones"""
+    path: str
+    idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.idle = []
+
+    async def send(self, records: List[JournalRecord]):
+        """Raises OSError or asyncio.IncompleteReadError when there is no server or it went away"""
+        reader, writer = self.idle.pop() if self.idle else await asyncio.open_unix_connection(self.path)
+        try:
+            await write_message(writer, [list(each) for each in records])
+            response = await read_message(reader)
+        except BaseException:
+            writer.close()
+            raise
+        self.idle.append((reader, writer))
+        if response.get("error") is not None:
+            raise ForwardedWriteFailed(response["error"])
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
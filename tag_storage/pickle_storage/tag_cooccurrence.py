@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import dataclasses
+import heapq
+from typing import Callable, Collection, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from sortedcontainers import SortedList
+
+from tag_storage.base_storage.tag_count import RelatedTag, RelatedScore
+
+
+@dataclasses.dataclass
+class TagCooccurrenceConfiguration:
+    max_exact: int = 10000  # tags counted exactly with each tag, a tag related to more keeps a sketch instead
+    sketch_size: int = 1000  # tags kept by a sketch, those most used together with its tag
+
+
+def rank_related(counts: Dict[str, int], k: int, count_objects: Callable[[str], int], score: RelatedScore,
+                 objects: int) -> List[RelatedTag]:
+    """The k best of the tags used together with one with objects objects, counts has how many objects have both"""
+    if score == RelatedScore.COUNT:
+        best = heapq.nsmallest(k, counts.items(), key=lambda item: (-item[1], item[0]))
+        return [RelatedTag(name, count, float(count)) for name, count in best]
+    scored = []
+    for name, count in counts.items():
+        union = objects + count_objects(name) - count
+        scored.append(RelatedTag(name, count, count / union if union > 0 else 0.0))
+    return heapq.nsmallest(k, scored, key=lambda related: (-related.score, related.tag))
+
+
+class _Sketch:
+    """
+    Space-Saving summary of the tags used together with one tag: the sketch_size most frequent ones with an upper
+    bound of their count. A tag that is not kept replaces the least counted one and inherits its count. Decrements
+    of the tags that are not kept are lost.
+    """
+
+    def __init__(self, capacity: int, counts: Dict[str, int]):
+        self.capacity = capacity
+        self.counts = dict(heapq.nlargest(capacity, counts.items(), key=lambda item: item[1]))
+        self.order = SortedList((-count, name) for name, count in self.counts.items())
+
+    def add(self, name: str, delta: int):
+        count = self.counts.get(name)
+        if count is None:
+            if delta <= 0:
+                return
+            if len(self.counts) >= self.capacity:
+                count, evicted = self.order.pop()
+                count = -count
+                del self.counts[evicted]
+            else:
+                count = 0
+        else:
+            self.order.remove((-count, name))
+        count += delta
+        if count > 0:
+            self.counts[name] = count
+            self.order.add((-count, name))
+        else:
+            del self.counts[name]
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def top(self, k: int) -> Iterator[Tuple[str, int]]:
+        return ((name, -count) for count, name in self.order.islice(0, k))
+
+
+class TagCooccurrence:
+    """
+    For each tag, the number of objects tagged with it and with each other tag, updated by the storage with every
+    change of the tags of an object instead of visiting the objects of a tag on every read. A tag related to more
+    than max_exact tags keeps a sketch of the sketch_size most related ones instead, so the memory of each tag is
+    bounded and its counts become approximate.
+    """
+    related: Optional[Dict[str, Union[Dict[str, int], _Sketch]]]  # None until the first top() of a deferred one
+
+    def __init__(self, config: TagCooccurrenceConfiguration, objects: Iterable[Collection[str]] = ()):
+        self.config = config
+        self.related = {}
+        self.objects_map = None
+        for tags in objects:
+            self.tagged(list(tags), tags)
+
+    @classmethod
+    def deferred(cls, config: TagCooccurrenceConfiguration, objects_map) -> TagCooccurrence:
+        """Counted from objects_map on the first top(), it ignores the changes reported until then"""
+        cooccurrence = cls(config)
+        cooccurrence.related = None
+        cooccurrence.objects_map = objects_map
+        return cooccurrence
+
+    def __add(self, tag: str, other: str, delta: int):
+        counts = self.related.get(tag)
+        if counts is None:
+            if delta <= 0:
+                return
+            counts = self.related[tag] = {}
+        if isinstance(counts, _Sketch):
+            counts.add(other, delta)
+            return
+        count = counts.get(other, 0) + delta
+        if count > 0:
+            counts[other] = count
+            if len(counts) > self.config.max_exact:
+                self.related[tag] = _Sketch(self.config.sketch_size, counts)
+        else:
+            counts.pop(other, None)
+            if not counts:
+                del self.related[tag]
+
+    def __pairs(self, changed: Collection[str], tags: Collection[str], delta: int):
+        # Each pair of a changed tag and another tag of the object once, changed ones among themselves included
+        changed_set = set(changed)
+        for tag in changed_set:
+            for other in tags:
+                if other != tag and (other not in changed_set or other > tag):
+                    self.__add(tag, other, delta)
+                    self.__add(other, tag, delta)
+
+    def tagged(self, added: Collection[str], tags: Collection[str]):
+        """An object got the tags in added, tags are all of its tags after the change"""
+        if self.related is not None:
+            self.__pairs(added, tags, 1)
+
+    def untagged(self, removed: Collection[str], tags: Collection[str]):
+        """An object lost the tags in removed, tags are all of its tags before the change"""
+        if self.related is not None:
+            self.__pairs(removed, tags, -1)
+
+    def removed(self, tag: str):
+        # What is left of it is in a sketch, whose decrements were lost
+        if self.related is not None:
+            self.related.pop(tag, None)
+
+    def top(self, tag: str, k: int, count_objects: Callable[[str], int],
+            score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        """The k tags most used together with tag, count_objects(tag) is the number of objects of a tag"""
+        if self.related is None:
+            self.related = {}
+            for tags in self.objects_map.values():
+                self.__pairs(list(tags), tags, 1)
+            self.objects_map = None
+        counts = self.related.get(tag, {})
+        if isinstance(counts, _Sketch):
+            # A count can be over the objects of either tag, or of a tag removed since, when it was evicted before
+            objects = count_objects(tag)
+            capped = ((name, min(count, objects, count_objects(name))) for name, count in counts.top(len(counts)))
+            counts = {name: count for name, count in capped if count > 0}
+        return rank_related(counts, k, count_objects, score, count_objects(tag))
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+from typing import Iterable, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+from tag_storage.base_storage.tag_count import TagCount
+
+
+class TagPopularity:
+    """
+    Every tag sorted by the number of objects tagged with it, most used first and then by name. The storage
+    reports each change of a count, so the top k tags are read in O(k) instead of counting every tag.
+    """
+    counts: Optional[SortedList]  # None until the first top() of a deferred one
+
+    def __init__(self, tags: Iterable[Tuple[str, Iterable[str]]] = ()):
+        self.counts = SortedList((-len(objects), tag) for tag, objects in tags)
+        self.tags_map = None
+
+    @classmethod
+    def deferred(cls, tags_map) -> TagPopularity:
+        """Counted from tags_map on the first top(), it ignores the changes reported until then"""
+        popularity = cls()
+        popularity.counts = None
+        popularity.tags_map = tags_map
+        return popularity
+
+    def changed(self, tag: str, before: int, after: int):
+        if before != after and self.counts is not None:
+            self.counts.discard((-before, tag))
+            self.counts.add((-after, tag))
+
+    def added(self, tag: str):
+        if self.counts is not None:
+            self.counts.add((0, tag))
+
+    def removed(self, tag: str, count: int):
+        if self.counts is not None:
+            self.counts.discard((-count, tag))
+
+    def top(self, k: int) -> List[TagCount]:
+        if self.counts is None:
+            self.counts = SortedList((-len(objects), tag) for tag, objects in self.tags_map.items())
+            self.tags_map = None
+        return [TagCount(tag, -count) for count, tag in self.counts.islice(0, k)]
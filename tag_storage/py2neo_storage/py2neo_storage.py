@@ -1,9 +1,13 @@
 import dataclasses
-from typing import Collection
+from typing import Collection, Dict, Optional, List, Tuple
 
-from py2neo import Graph, NodeMatcher, Node, Relationship, RelationshipMatcher, IN
+from py2neo import Graph, ClientError, Neo4jError
 
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType, \
+    validate_bulk_operations
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
 from tag_storage.base_storage.sync_tag_storage import SyncTagStorage
+from tag_storage.neo4j_storage import graph_queries
 
 
 @dataclasses.dataclass
@@ -11,94 +15,121 @@ class Py2NeoStorageConfig:
     url: str
     username: str
     password: str
+    create_indexes: bool = True
 
 
 class Py2NeoStorage(SyncTagStorage):
-    TAG = 'tag'
-    OBJECT = 'object'
-    TAGGED = 'Tagged'
+    TAG = graph_queries.TAG
+    OBJECT = graph_queries.OBJECT
+    TAGGED = graph_queries.TAGGED
 
     def __init__(self, config: Py2NeoStorageConfig):
         self.config = config
         self.graph = Graph(config.url, auth=(config.username, config.password))
-
-    def get_tags(self, limit: int = 100, offset: int = 0) -> Collection[str]:
-        nodes = NodeMatcher(self.graph)
-        match = nodes.match(self.TAG).order_by("_.name").limit(limit).skip(offset)
-        return [x['name'] for x in match]
-
-    def get_objects(self, limit: int = 100, offset: int = 0) -> Collection[str]:
-        nodes = NodeMatcher(self.graph)
-        match = nodes.match(self.OBJECT).order_by("_.name").limit(limit).skip(offset).all()
-        return [x['name'] for x in match]
-
-    def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0) -> Collection[str]:
-        res = self.graph.run("MATCH p=(a)-[:%s]->(:%s {name:$name }) RETURN a.name order by a.name skip %d limit %d" % (
-        self.TAGGED, self.TAG, offset, limit), {'name': tag})
-        return [x[0] for x in res]
-
-    def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0) -> Collection[str]:
-        res = self.graph.run("MATCH p=(:%s {name:$name })-[:%s]->(a) RETURN a.name order by a.name skip %d limit %d" % (
-            self.OBJECT, self.TAGGED, offset, limit), {'name': tagged_object})
-        return [x[0] for x in res]
-
+        if config.create_indexes:
+            self.__create_indexes()
+
+    def __create_indexes(self):
+        for statement, legacy_statement in zip(graph_queries.CREATE_INDEXES, graph_queries.LEGACY_CREATE_INDEXES):
+            try:
+                self.graph.run(statement)
+            except ClientError:
+                self.graph.run(legacy_statement)
+
+    def __run(self, query: str, statement: graph_queries.Statement) -> List[Tuple]:
+        # query names the statement in the metrics
+        with self.instrumentation.timer('tagapi_query_duration_seconds', storage='py2neo', query=query):
+            return [tuple(x) for x in self.graph.run(*statement)]
+
+    def __column(self, query: str, statement: graph_queries.Statement) -> List[str]:
+        return [x[0] for x in self.__run(query, statement)]
+
+    def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                 prefix: Optional[str] = None, start: Optional[str] = None,
+                 end: Optional[str] = None) -> Collection[str]:
+        return self.__column('get_tags', graph_queries.get_tags(limit, offset, after, prefix, start, end))
+
+    def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                    prefix: Optional[str] = None, start: Optional[str] = None,
+                    end: Optional[str] = None) -> Collection[str]:
+        return self.__column('get_objects', graph_queries.get_objects(limit, offset, after, prefix, start, end))
+
+    def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                           prefix: Optional[str] = None, start: Optional[str] = None,
+                           end: Optional[str] = None) -> Collection[str]:
+        return self.__column('get_tagged_objects', graph_queries.get_tagged_objects(tag, limit, offset, after, prefix,
+                                                                                     start, end))
+
+    def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                        after: Optional[str] = None, prefix: Optional[str] = None,
+                        start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return self.__column('get_object_tags', graph_queries.get_object_tags(tagged_object, limit, offset, after,
+                                                                               prefix, start, end))
+
+    def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                      none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                      after: Optional[str] = None, prefix: Optional[str] = None,
+                      start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return self.__column('query_objects', graph_queries.query_objects(all_tags, any_tags, none_tags, limit, offset,
+                                                                           after, prefix, start, end))
+
+    def get_objects_with_tags(self, limit: int = 100, after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        return [(x[0], x[1]) for x in self.__run('get_objects_with_tags',
+                                                 graph_queries.get_objects_with_tags(limit, after))]
+
+    def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        rows = self.__run('get_many_tagged_objects', graph_queries.get_many_tagged_objects(tags, limit))
+        return graph_queries.pages_by_name(tags, rows)
+
+    def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        rows = self.__run('get_many_object_tags', graph_queries.get_many_object_tags(tagged_objects, limit))
+        return graph_queries.pages_by_name(tagged_objects, rows)
+
+    def count_tagged_objects(self, tag: str) -> int:
+        return self.__column('count_tagged_objects', graph_queries.count_tagged_objects(tag))[0]
+
+    def count_object_tags(self, tagged_object: str) -> int:
+        return self.__column('count_object_tags', graph_queries.count_object_tags(tagged_object))[0]
+
+    def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return [TagCount(x[0], x[1]) for x in self.__run('get_top_tags', graph_queries.get_top_tags(k))]
+
+    def get_related_tags(self, tag: str, k: int = 10, score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        query = graph_queries.get_related_tags(tag, k, jaccard=score == RelatedScore.JACCARD)
+        return [RelatedTag(x[0], x[1], x[2]) for x in self.__run('get_related_tags', query)]
+
+    # Writes are single auto-commit statements: one round trip, and atomic
     def tag(self, object_to_tag: str, tags: Collection[str]):
-        nodes = NodeMatcher(self.graph)
-        object_node = nodes.match(self.OBJECT, name=object_to_tag).first()
-        if object_node is None:
-            object_node = self.__create_object(object_to_tag)
-        existing_tags = {n['name']: n for n in nodes.match(self.TAG, name=IN(tags)).all()}
-        existing_edges = set()
-        for tag_name, tag_node in existing_tags.items():
-            edge = RelationshipMatcher(self.graph).match(nodes=(object_node, tag_node), r_type=self.TAGGED).first()
-            if edge is not None:
-                existing_edges.add(tag_name)
-
-        for each in tags:
-            if each not in existing_tags:
-                existing_tags[each] = self.__create_tag(each)
-        tx = self.graph.begin()
-        for tag_name, tag_node in existing_tags.items():
-            if tag_name not in existing_edges:
-                rel = Relationship(object_node, self.TAGGED, tag_node)
-                tx.create(rel)
-        self.graph.commit(tx)
-
-    def __create_tag(self, tag_name):
-        n = Node(self.TAG, name=tag_name)
-        self.graph.create(n)
-        return n
-
-    def __create_object(self, object_name):
-        n = Node(self.OBJECT, name=object_name)
-        self.graph.create(n)
-        return n
+        self.__run('tag', graph_queries.tag(object_to_tag, tags))
+        self._publish([BulkOperation(BulkOperationType.TAG, object_name=object_to_tag, tags=list(tags))])
 
     def untag(self, object_to_untag: str, tags: Collection[str]):
-        nodes = NodeMatcher(self.graph)
-        object_node = nodes.match(self.OBJECT, name=object_to_untag).first()
-        if object_node is None:
-            return
-        existing_tags = {n['name']: n for n in nodes.match(self.TAG, name=IN(tags)).all()}
-        existing_edges = []
-        for tag_name, tag_node in existing_tags.items():
-            edge = RelationshipMatcher(self.graph).match(nodes=(object_node, tag_node), r_type=self.TAGGED).first()
-            if edge is not None:
-                existing_edges.append(edge)
-        tx = self.graph.begin()
-        for each in existing_edges:
-            tx.separate(each)
-        self.graph.commit(tx)
+        self.__run('untag', graph_queries.untag(object_to_untag, tags))
+        self._publish([BulkOperation(BulkOperationType.UNTAG, object_name=object_to_untag, tags=list(tags))])
 
     def remove_object(self, object_to_remove: str):
-        object_node = NodeMatcher(self.graph).match(self.OBJECT, name=object_to_remove).first()
-        if object_node:
-            self.graph.delete(object_node)
+        self.__run('remove_object', graph_queries.remove_object(object_to_remove))
+        self._publish([BulkOperation(BulkOperationType.REMOVE_OBJECT, object_name=object_to_remove)])
 
     def remove_tag(self, tag_to_remove: str):
-        tag = NodeMatcher(self.graph).match(self.TAG, name=tag_to_remove).first()
-        if tag:
-            self.graph.delete(tag)
+        self.__run('remove_tag', graph_queries.remove_tag(tag_to_remove))
+        self._publish([BulkOperation(BulkOperationType.REMOVE_TAG, tag_name=tag_to_remove)])
+
+    def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        results, valid = validate_bulk_operations(operations)
+        tx = self.graph.begin()
+        try:
+            with self.instrumentation.timer('tagapi_query_duration_seconds', storage='py2neo', query='bulk_apply'):
+                for statement in graph_queries.bulk_statements([operation for operation, _ in valid]):
+                    tx.run(*statement)
+                self.graph.commit(tx)
+        except Neo4jError as e:
+            self.graph.rollback(tx)
+            for _, result in valid:
+                result.ok, result.error = False, str(e)
+        else:
+            self._publish([operation for operation, _ in valid])
+        return results
 
     def close(self):
         pass
@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextlib
+import dataclasses
+import functools
+import itertools
+import sqlite3
+import threading
+from typing import Any, Callable, Collection, Dict, List, Optional, Tuple
+
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationResult, BulkOperationType, \
+    validate_bulk_operations
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+
+# Edges are keyed by (tag, object) and indexed by (object, tag), both without rowid, so the objects of a tag and
+# the tags of an object are read from an index alone, in order. tags.objects is kept by the triggers and indexed to
+# read the top tags without counting the edges.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (name TEXT PRIMARY KEY, objects INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS objects (name TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS edges (tag TEXT NOT NULL, object TEXT NOT NULL, PRIMARY KEY (tag, object)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS edges_by_object ON edges (object, tag);
+CREATE INDEX IF NOT EXISTS tags_by_objects ON tags (objects DESC, name);
+CREATE TRIGGER IF NOT EXISTS edge_added AFTER INSERT ON edges
+    BEGIN UPDATE tags SET objects = objects + 1 WHERE name = NEW.tag; END;
+CREATE TRIGGER IF NOT EXISTS edge_removed AFTER DELETE ON edges
+    BEGIN UPDATE tags SET objects = objects - 1 WHERE name = OLD.tag; END;
+"""
+
+Condition = Tuple[str, List[Any]]
+
+
+@dataclasses.dataclass
+class SqliteStorageConfig:
+    path: str  # a file, every thread and process opens its own connection to it
+    max_workers: int = 8  # threads, and connections, that run the queries
+    busy_timeout: float = 5.0  # seconds a write waits for the writer of another process
+    synchronous: str = 'NORMAL'  # FULL also syncs the WAL on every commit, NORMAL only on checkpoints
+
+
+def _prefix_end(prefix: str) -> Optional[str]:
+    # The least name greater than every name that starts with prefix, None when there is none
+    while prefix and prefix[-1] == '\U0010ffff':
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    following = ord(prefix[-1]) + 1
+    if 0xd800 <= following <= 0xdfff:  # surrogates can't be encoded
+        following = 0xe000
+    return prefix[:-1] + chr(following)
+
+
+def _name_filter(column: str, after: Optional[str], prefix: Optional[str] = None, start: Optional[str] = None,
+                 end: Optional[str] = None) -> Condition:
+    # Conditions on column and their parameters. A prefix is a range, so they are all answered by the index
+    conditions, parameters = [], []
+    if prefix is not None:
+        prefix_end = _prefix_end(prefix)
+        conditions.append(f"{column} >= ?" if prefix_end is None else f"{column} >= ? AND {column} < ?")
+        parameters.extend([prefix] if prefix_end is None else [prefix, prefix_end])
+    for operator, value in (('>', after), ('>=', start), ('<', end)):
+        if value is not None:
+            conditions.append(f"{column} {operator} ?")
+            parameters.append(value)
+    return " AND ".join(conditions), parameters
+
+
+def _where(*conditions: str) -> str:
+    conditions = [each for each in conditions if each]
+    return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+
+def _marks(values: Collection) -> str:
+    return ", ".join("?" * len(values))
+
+
+class SqliteStorage(AsyncTagStorage):
+    """
+    Storage in a SQLite database in WAL mode: writes are durable one transaction at a time, readers don't block
+    the writer nor each other, also from other processes, and the data doesn't have to fit in memory. The queries
+    run in a pool of threads with a connection each, the writes of this process wait for each other on a lock
+    rather than on the busy timeout.
+    """
+    config: SqliteStorageConfig
+    executor: concurrent.futures.ThreadPoolExecutor
+    connections: List[sqlite3.Connection]
+
+    def __init__(self, config: SqliteStorageConfig):
+        self.config = config
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.max_workers,
+                                                              thread_name_prefix='sqlite-storage')
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        connection = self.__connect()
+        try:
+            # The journal mode is kept in the file, the connections opened later use it too
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def __connect(self) -> sqlite3.Connection:
+        # Transactions are begun explicitly, so a read of several statements can see a single snapshot
+        connection = sqlite3.connect(self.config.path, timeout=self.config.busy_timeout, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute(f"PRAGMA synchronous={self.config.synchronous}")
+        return connection
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.__connect()
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    @staticmethod
+    @contextlib.contextmanager
+    def __transaction(connection: sqlite3.Connection, begin: str = "BEGIN"):
+        connection.execute(begin)
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def __run_read(self, function: Callable, args: Tuple) -> Any:
+        connection = self.__connection()
+        with self.__transaction(connection):
+            return function(connection, *args)
+
+    def __run_write(self, operations: List[BulkOperation]):
+        connection = self.__connection()
+        # IMMEDIATE takes the write lock of the database at once, a deferred transaction that has read could not
+        # wait for it without a deadlock
+        with self.write_lock, self.__transaction(connection, "BEGIN IMMEDIATE"):
+            for operation_type, group in itertools.groupby(operations, key=lambda x: x.operation):
+                self.__apply(connection, operation_type, list(group))
+
+    async def _read(self, query: str, function: Callable, *args) -> Any:
+        # query names the statement in the metrics, function(connection, *args) runs in a read transaction
+        with self.instrumentation.timer('tagapi_query_duration_seconds', storage='sqlite', query=query):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(self.__run_read, function, args))
+
+    async def _write(self, query: str, operations: List[BulkOperation]):
+        # All the operations are applied in one transaction
+        with self.instrumentation.timer('tagapi_query_duration_seconds', storage='sqlite', query=query):
+            await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                             functools.partial(self.__run_write, operations))
+        self._publish(operations)
+
+    @staticmethod
+    def __apply(connection: sqlite3.Connection, operation_type: BulkOperationType, group: List[BulkOperation]):
+        if operation_type == BulkOperationType.TAG:
+            connection.executemany("INSERT OR IGNORE INTO objects (name) VALUES (?)",
+                                   [(x.object_name,) for x in group])
+            connection.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                                   [(tag,) for x in group for tag in x.tags])
+            connection.executemany("INSERT OR IGNORE INTO edges (tag, object) VALUES (?, ?)",
+                                   [(tag, x.object_name) for x in group for tag in x.tags])
+        elif operation_type == BulkOperationType.UNTAG:
+            connection.executemany("DELETE FROM edges WHERE tag = ? AND object = ?",
+                                   [(tag, x.object_name) for x in group for tag in x.tags])
+        elif operation_type == BulkOperationType.REMOVE_OBJECT:
+            connection.executemany("DELETE FROM edges WHERE object = ?", [(x.object_name,) for x in group])
+            connection.executemany("DELETE FROM objects WHERE name = ?", [(x.object_name,) for x in group])
+        else:
+            # The tag goes first, so the trigger has no count to update for each of its edges
+            connection.executemany("DELETE FROM tags WHERE name = ?", [(x.tag_name,) for x in group])
+            connection.executemany("DELETE FROM edges WHERE tag = ?", [(x.tag_name,) for x in group])
+
+    @staticmethod
+    def __column(connection: sqlite3.Connection, statement: str, parameters: List[Any]) -> List:
+        return [row[0] for row in connection.execute(statement, parameters)]
+
+    @classmethod
+    def __listing(cls, connection: sqlite3.Connection, table: str, column: str, key: Optional[Condition],
+                  limit: int, offset: int, after: Optional[str], prefix: Optional[str], start: Optional[str],
+                  end: Optional[str]) -> List[str]:
+        # The names in column of the rows of table that match key, sorted
+        conditions, parameters = _name_filter(column, after, prefix, start, end)
+        key_condition, key_parameters = key or ("", [])
+        return cls.__column(connection, f"SELECT {column} FROM {table} {_where(key_condition, conditions)} "
+                                        f"ORDER BY {column} LIMIT ? OFFSET ?",
+                            key_parameters + parameters + [limit, offset])
+
+    async def get_tags(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                       prefix: Optional[str] = None, start: Optional[str] = None,
+                       end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_tags', self.__listing, 'tags', 'name', None, limit, offset, after, prefix,
+                                start, end)
+
+    async def get_objects(self, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                          prefix: Optional[str] = None, start: Optional[str] = None,
+                          end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_objects', self.__listing, 'objects', 'name', None, limit, offset, after,
+                                prefix, start, end)
+
+    async def get_tagged_objects(self, tag: str, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+                                 prefix: Optional[str] = None, start: Optional[str] = None,
+                                 end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_tagged_objects', self.__listing, 'edges', 'object', ("tag = ?", [tag]), limit,
+                                offset, after, prefix, start, end)
+
+    async def get_object_tags(self, tagged_object: str, limit: int = 100, offset: int = 0,
+                              after: Optional[str] = None, prefix: Optional[str] = None,
+                              start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self._read('get_object_tags', self.__listing, 'edges', 'tag', ("object = ?", [tagged_object]),
+                                limit, offset, after, prefix, start, end)
+
+    @classmethod
+    def __many(cls, connection: sqlite3.Connection, column: str, key: str, names: Collection[str],
+               limit: int) -> Dict[str, List[str]]:
+        # A statement per name, each reads its page from the index, all in the same transaction
+        statement = f"SELECT {column} FROM edges WHERE {key} = ? ORDER BY {column} LIMIT ?"
+        return {name: cls.__column(connection, statement, [name, limit]) for name in dict.fromkeys(names)}
+
+    async def get_many_tagged_objects(self, tags: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return await self._read('get_many_tagged_objects', self.__many, 'object', 'tag', tags, limit)
+
+    async def get_many_object_tags(self, tagged_objects: Collection[str], limit: int = 100) -> Dict[str, List[str]]:
+        return await self._read('get_many_object_tags', self.__many, 'tag', 'object', tagged_objects, limit)
+
+    @classmethod
+    def __query_objects(cls, connection: sqlite3.Connection, all_tags: Collection[str], any_tags: Collection[str],
+                        none_tags: Collection[str], limit: int, offset: int, after: Optional[str],
+                        prefix: Optional[str], start: Optional[str], end: Optional[str]) -> List[str]:
+        all_tags, any_tags, none_tags = sorted(set(all_tags)), sorted(set(any_tags)), sorted(set(none_tags))
+        conditions: List[Condition] = []
+        if all_tags:
+            # Walk the edges of the tag with fewest objects and probe the others
+            counts = connection.execute(f"SELECT name, objects FROM tags WHERE name IN ({_marks(all_tags)})",
+                                        all_tags).fetchall()
+            if len(counts) < len(all_tags):
+                return []
+            anchor = min(counts, key=lambda row: row[1])[0]
+            select, column = "SELECT a.object FROM edges a", "a.object"
+            conditions.append(("a.tag = ?", [anchor]))
+            conditions.extend((f"EXISTS (SELECT 1 FROM edges e WHERE e.tag = ? AND e.object = {column})", [each])
+                              for each in all_tags if each != anchor)
+        elif any_tags:
+            select, column = "SELECT DISTINCT a.object FROM edges a", "a.object"
+            conditions.append((f"a.tag IN ({_marks(any_tags)})", any_tags))
+            any_tags = []
+        else:
+            select, column = "SELECT a.name FROM objects a", "a.name"
+        if any_tags:
+            conditions.append((f"EXISTS (SELECT 1 FROM edges e WHERE e.object = {column} "
+                               f"AND e.tag IN ({_marks(any_tags)}))", any_tags))
+        if none_tags:
+            conditions.append((f"NOT EXISTS (SELECT 1 FROM edges e WHERE e.object = {column} "
+                               f"AND e.tag IN ({_marks(none_tags)}))", none_tags))
+        conditions.append(_name_filter(column, after, prefix, start, end))
+        return cls.__column(connection, f"{select} {_where(*(condition for condition, _ in conditions))} "
+                                        f"ORDER BY {column} LIMIT ? OFFSET ?",
+                            [value for _, values in conditions for value in values] + [limit, offset])
+
+    async def query_objects(self, all_tags: Collection[str] = (), any_tags: Collection[str] = (),
+                            none_tags: Collection[str] = (), limit: int = 100, offset: int = 0,
+                            after: Optional[str] = None, prefix: Optional[str] = None,
+                            start: Optional[str] = None, end: Optional[str] = None) -> Collection[str]:
+        return await self._read('query_objects', self.__query_objects, all_tags, any_tags, none_tags, limit, offset,
+                                after, prefix, start, end)
+
+    @staticmethod
+    def __objects_with_tags(connection: sqlite3.Connection, limit: int,
+                            after: Optional[str]) -> List[Tuple[str, List[str]]]:
+        conditions, parameters = _name_filter('name', after)
+        rows = connection.execute(f"SELECT o.name, e.tag FROM (SELECT name FROM objects {_where(conditions)} "
+                                  f"ORDER BY name LIMIT ?) o LEFT JOIN edges e ON e.object = o.name "
+                                  f"ORDER BY o.name, e.tag", parameters + [limit])
+        return [(name, [tag for _, tag in group if tag is not None])
+                for name, group in itertools.groupby(rows, key=lambda row: row[0])]
+
+    async def get_objects_with_tags(self, limit: int = 100,
+                                    after: Optional[str] = None) -> List[Tuple[str, List[str]]]:
+        return await self._read('get_objects_with_tags', self.__objects_with_tags, limit, after)
+
+    async def count_tagged_objects(self, tag: str) -> int:
+        counts = await self._read('count_tagged_objects', self.__column, "SELECT objects FROM tags WHERE name = ?",
+                                  [tag])
+        return counts[0] if counts else 0
+
+    async def count_object_tags(self, tagged_object: str) -> int:
+        return (await self._read('count_object_tags', self.__column, "SELECT count(*) FROM edges WHERE object = ?",
+                                 [tagged_object]))[0]
+
+    @staticmethod
+    def __top_tags(connection: sqlite3.Connection, k: int) -> List[TagCount]:
+        return [TagCount(*row) for row in
+                connection.execute("SELECT name, objects FROM tags ORDER BY objects DESC, name LIMIT ?", [k])]
+
+    async def get_top_tags(self, k: int = 50) -> List[TagCount]:
+        return await self._read('get_top_tags', self.__top_tags, k)
+
+    @staticmethod
+    def __related_tags(connection: sqlite3.Connection, tag: str, k: int, score: RelatedScore) -> List[RelatedTag]:
+        # The tags of the objects of the tag, from the edges of each object in edges_by_object
+        together = "SELECT other.tag AS name, count(*) AS together FROM edges AS mine " \
+                   "JOIN edges AS other ON other.object = mine.object AND other.tag != mine.tag " \
+                   "WHERE mine.tag = ? GROUP BY other.tag"
+        if score == RelatedScore.COUNT:
+            rows = connection.execute(f"SELECT name, together, together FROM ({together}) "
+                                      f"ORDER BY together DESC, name LIMIT ?", [tag, k])
+        else:
+            rows = connection.execute(
+                f"SELECT related.name, together, CAST(together AS REAL) / (mine.objects + tags.objects - together) "
+                f"AS score FROM ({together}) AS related JOIN tags ON tags.name = related.name "
+                f"JOIN tags AS mine ON mine.name = ? ORDER BY score DESC, related.name LIMIT ?", [tag, tag, k])
+        return [RelatedTag(name, together, float(score)) for name, together, score in rows]
+
+    async def get_related_tags(self, tag: str, k: int = 10,
+                               score: RelatedScore = RelatedScore.COUNT) -> List[RelatedTag]:
+        return await self._read('get_related_tags', self.__related_tags, tag, k, score)
+
+    async def tag(self, object_to_tag: str, tags: Collection[str]):
+        await self._write('tag', [BulkOperation(BulkOperationType.TAG, object_name=object_to_tag, tags=list(tags))])
+
+    async def untag(self, object_to_untag: str, tags: Collection[str]):
+        await self._write('untag', [BulkOperation(BulkOperationType.UNTAG, object_name=object_to_untag,
+                                                  tags=list(tags))])
+
+    async def remove_object(self, object_to_remove: str):
+        await self._write('remove_object', [BulkOperation(BulkOperationType.REMOVE_OBJECT,
+                                                          object_name=object_to_remove)])
+
+    async def remove_tag(self, tag_to_remove: str):
+        await self._write('remove_tag', [BulkOperation(BulkOperationType.REMOVE_TAG, tag_name=tag_to_remove)])
+
+    async def bulk_apply(self, operations: Collection[BulkOperation]) -> List[BulkOperationResult]:
+        # The valid operations are applied in one transaction, they all fail if it does
+        results, valid = validate_bulk_operations(operations)
+        if not valid:
+            return results
+        try:
+            await self._write('bulk_apply', [operation for operation, _ in valid])
+        except sqlite3.Error as e:
+            for _, result in valid:
+                result.ok, result.error = False, str(e)
+        return results
+
+    async def close(self):
+        # The queries that are running end before their connections are closed
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
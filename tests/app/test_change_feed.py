@@ -0,0 +1,163 @@
+import asyncio
+import contextlib
+import json
+import os.path
+import tempfile
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from starlette.testclient import TestClient
+
+from app.create_app import create_app
+from tag_storage.base_storage.change_feed import ChangeFeed, ChangeFeedConfiguration
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration
+
+
+@contextlib.contextmanager
+def new_client(buffer_size: int = 100):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        feed = ChangeFeed(ChangeFeedConfiguration(buffer_size=buffer_size))
+        app = None
+
+        async def app_in_the_loop(scope, receive, send):
+            # The storage starts its synchronizer in the loop of the client, which closes it on shutdown
+            nonlocal app
+            if app is None:
+                client.storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(
+                    path=os.path.join(temp_dir, 'test')))
+                app = create_app(client.storage, change_feed=feed)
+            await app(scope, receive, send)
+
+        client = TestClient(app_in_the_loop)
+        client.feed = feed
+        with client:
+            yield client
+
+
+async def _read_events(app, query_string: str, count: int, headers: Dict[str, str],
+                       write: Optional[Callable[[], Awaitable]]) -> List[Dict]:
+    # The test client reads whole responses, the stream is read here until count events arrive
+    body = b""
+    requested = False
+    enough = asyncio.Event()
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await enough.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal body
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200
+            if write is not None:
+                await write()
+        elif message["type"] == "http.response.body":
+            body += message.get("body", b"")
+            if body.count(b"\n\n") >= count:
+                enough.set()
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": "/changes", "raw_path": b"/changes", "root_path": "", "query_string": query_string.encode(),
+             "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+             "server": ("testserver", 80), "client": ("testclient", 50000)}
+    await asyncio.wait_for(app(scope, receive, send), 10)
+    events = []
+    for block in body.decode().split("\n\n")[:count]:
+        event = {}
+        for line in block.split("\n"):
+            name, _, value = line.partition(": ")
+            event[name] = json.loads(value) if name == "data" else value
+        events.append(event)
+    return events
+
+
+def read_events(client: TestClient, query_string: str, count: int, headers: Optional[Dict[str, str]] = None,
+                write: Optional[Callable[[], Awaitable]] = None) -> List[Dict]:
+    """The first count Server-Sent Events of /changes, write is awaited once the stream started"""
+    return client.portal.call(_read_events, client.app, query_string, count, headers or {}, write)
+
+
+def test_server_sent_events():
+    with new_client() as client:
+        client.post('/objects/one_object/tags', json=['tag1', 'tag2'])
+        client.delete('/tags/tag2')
+        epoch = client.feed.epoch
+        events = read_events(client, 'after=0', 2)
+        assert [event['id'] for event in events] == [f'{epoch}-1', f'{epoch}-2']
+        assert events[0]['data'] == {'epoch': epoch, 'sequence': 1, 'operation': 'tag', 'object_name': 'one_object',
+                                     'tags': ['tag1', 'tag2'], 'tag_name': None}
+        assert events[1]['data']['operation'] == 'remove_tag'
+        assert events[1]['data']['tag_name'] == 'tag2'
+
+        # The changes made while the client is connected
+        events = read_events(client, '', 1, write=lambda: client.storage.tag('another_object', ['tag3']))
+        assert events[0]['id'] == f'{epoch}-3'
+        assert events[0]['data']['object_name'] == 'another_object'
+
+        # Only those of the tags asked for
+        client.post('/objects/one_object/tags', json=['tag4'])
+        events = read_events(client, 'after=0&tag=tag4&tag=tag3', 2)
+        assert [event['data']['sequence'] for event in events] == [3, 4]
+
+
+def test_server_sent_events_resume():
+    with new_client() as client:
+        for i in range(4):
+            client.post(f'/objects/object{i}/tags', json=['tag'])
+        epoch = client.feed.epoch
+        # Last-Event-ID, as the browsers send it when they reconnect, overrides after
+        events = read_events(client, 'after=0', 2, headers={'Last-Event-ID': f'{epoch}-2'})
+        assert [event['data']['object_name'] for event in events] == ['object2', 'object3']
+        events = read_events(client, f'after=3&epoch={epoch}', 1)
+        assert events[0]['data']['sequence'] == 4
+
+        # The changes of another epoch can't be resumed, the client is told to read everything again
+        events = read_events(client, '', 2, headers={'Last-Event-ID': 'other-2'},
+                             write=lambda: client.storage.tag('object4', ['tag']))
+        assert events[0]['event'] == 'reset'
+        assert events[0]['id'] == f'{epoch}-4'
+        assert events[0]['data']['epoch'] == epoch
+        assert events[0]['data']['sequence'] == 4
+        assert events[1]['data']['sequence'] == 5
+
+
+def test_server_sent_events_lost():
+    with new_client(buffer_size=2) as client:
+        for i in range(4):
+            client.post(f'/objects/object{i}/tags', json=['tag'])
+        # 1 and 2 are no longer buffered
+        events = read_events(client, 'after=2', 2)
+        assert [event['data']['sequence'] for event in events] == [3, 4]
+        events = read_events(client, 'after=1', 1)
+        assert events[0]['event'] == 'reset'
+        assert events[0]['data']['sequence'] == 4
+
+
+def test_websocket():
+    with new_client(buffer_size=2) as client:
+        client.post('/objects/one_object/tags', json=['tag1'])
+        epoch = client.feed.epoch
+        with client.websocket_connect('/changes/ws?after=0') as websocket:
+            change = websocket.receive_json()
+            assert change == {'epoch': epoch, 'sequence': 1, 'operation': 'tag', 'object_name': 'one_object',
+                              'tags': ['tag1'], 'tag_name': None, 'event': 'change'}
+            client.request('DELETE', '/objects/one_object/tags', json=['tag1'])
+            change = websocket.receive_json()
+            assert change['sequence'] == 2
+            assert change['operation'] == 'untag'
+
+        with client.websocket_connect('/changes/ws?object=another_object') as websocket:
+            client.post('/objects/one_object/tags', json=['tag2'])
+            client.delete('/objects/another_object')
+            change = websocket.receive_json()
+            assert change['sequence'] == 4
+            assert change['operation'] == 'remove_object'
+
+        with client.websocket_connect('/changes/ws?after=1&epoch=other') as websocket:
+            reset = websocket.receive_json()
+            assert reset['event'] == 'reset'
+            assert reset['epoch'] == epoch
+            assert reset['sequence'] == 4
@@ -0,0 +1,280 @@
+import contextlib
+import json
+import os.path
+import tempfile
+
+import pytest
+from starlette.testclient import TestClient
+
+from app.create_app import create_app
+from app import responses
+from app.metrics import MetricsRegistry
+from app.responses import MSGPACK_MEDIA_TYPE, NEXT_CURSOR_HEADER
+from tag_storage.base_storage.tag_count import TagCount
+from tag_storage.caching_storage.caching_storage import CachingAsyncTagStorage
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration
+
+
+@contextlib.contextmanager
+def new_client(cached: bool = False, **kwargs):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        app = None
+
+        async def app_in_the_loop(scope, receive, send):
+            # The storage starts its synchronizer in the loop of the client, which closes it on shutdown
+            nonlocal app
+            if app is None:
+                storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test')))
+                app = create_app(CachingAsyncTagStorage(storage) if cached else storage, **kwargs)
+            await app(scope, receive, send)
+
+        with TestClient(app_in_the_loop) as client:
+            yield client
+
+
+def tag_objects(client: TestClient, objects):
+    for object_name, tags in objects.items():
+        assert client.post(f'/objects/{object_name}/tags', json=tags).json() == {}
+
+
+def test_tag_and_list():
+    with new_client() as client:
+        tag_objects(client, {'one_object': ['tag1', 'tag2'], 'another_object': ['tag1']})
+        assert client.get('/tags').json() == ['tag1', 'tag2']
+        assert client.get('/objects').json() == ['another_object', 'one_object']
+        assert client.get('/tags/tag1/objects').json() == ['another_object', 'one_object']
+        assert client.get('/objects/one_object/tags', params={'limit': 1, 'offset': 1}).json() == ['tag2']
+        assert client.request('DELETE', '/objects/one_object/tags', json=['tag2']).json() == {}
+        assert client.get('/tags/tag2/objects').json() == []
+        assert client.delete('/objects/another_object').json() == {}
+        assert client.get('/tags/tag1/objects').json() == ['one_object']
+        assert client.delete('/tags/tag1').json() == {}
+        assert client.get('/objects/one_object/tags').json() == []
+
+
+def test_query_objects():
+    with new_client() as client:
+        tag_objects(client, {'car': ['red', 'big'], 'bike': ['red'], 'truck': ['big', 'sold'], 'boat': ['blue']})
+        assert client.get('/objects', params={'all': ['red', 'big']}).json() == ['car']
+        assert client.get('/objects', params={'any': ['red', 'big']}).json() == ['bike', 'car', 'truck']
+        assert client.get('/objects', params={'any': ['red', 'big'], 'none': ['sold']}).json() == ['bike', 'car']
+        assert client.get('/objects', params={'none': ['red', 'big']}).json() == ['boat']
+        assert client.get('/objects', params={'any': ['red', 'big'], 'limit': 1, 'offset': 1}).json() == ['car']
+        # A value is one name, commas included
+        assert client.get('/objects', params={'all': 'red,big'}).json() == []
+        assert client.get('/objects', params={'all': ['red', 'missing']}).json() == []
+        tag_objects(client, {'odd': ['red,big']})
+        assert client.get('/objects', params={'all': 'red,big'}).json() == ['odd']
+
+
+def test_next_cursor():
+    with new_client() as client:
+        tag_objects(client, {f'object{i}': ['tag'] for i in range(5)})
+        tag_objects(client, {'a b&c': ['tag']})
+        pages = []
+        after = None
+        while True:
+            params = {'limit': 2} if after is None else {'limit': 2, 'after': after}
+            response = client.get('/tags/tag/objects', params=params)
+            pages.append(response.json())
+            after = response.headers.get(NEXT_CURSOR_HEADER)
+            if after is None:
+                break
+        # The last full page has a cursor too, the next one is empty
+        assert pages == [['a b&c', 'object0'], ['object1', 'object2'], ['object3', 'object4'], []]
+        response = client.get('/objects', params={'limit': 1})
+        assert response.headers[NEXT_CURSOR_HEADER] == 'a%20b%26c'
+        assert client.get('/objects', params={'limit': 1, 'after': 'a b&c'}).json() == ['object0']
+        assert NEXT_CURSOR_HEADER not in client.get('/objects', params={'limit': 10}).headers
+
+
+def test_ranges():
+    with new_client() as client:
+        tag_objects(client, {'apple': ['fruit'], 'apricot': ['fruit'], 'banana': ['fruit'], 'cherry': ['fruit']})
+        assert client.get('/objects', params={'prefix': 'ap'}).json() == ['apple', 'apricot']
+        assert client.get('/objects', params={'start': 'apricot', 'end': 'cherry'}).json() == ['apricot', 'banana']
+        assert client.get('/tags/fruit/objects', params={'start': 'b'}).json() == ['banana', 'cherry']
+        assert client.get('/objects', params={'any': ['fruit'], 'prefix': 'b'}).json() == ['banana']
+        assert client.get('/objects/apple/tags', params={'prefix': 'f'}).json() == ['fruit']
+
+
+def test_counts_and_top_tags():
+    with new_client() as client:
+        tag_objects(client, {'one_object': ['tag1', 'tag2'], 'another_object': ['tag1']})
+        assert client.get('/tags/tag1/count').json() == 2
+        assert client.get('/tags/missing/count').json() == 0
+        assert client.get('/objects/one_object/count').json() == 2
+        assert client.get('/tags/top').json() == [{'tag': 'tag1', 'count': 2}, {'tag': 'tag2', 'count': 1}]
+        assert client.get('/tags/top', params={'k': 1}).json() == [{'tag': 'tag1', 'count': 2}]
+        assert client.get('/tags/top', params={'k': -1}).status_code == 422
+        assert client.get('/tags/tag2/related').json() == [{'tag': 'tag1', 'count': 1, 'score': 1.0}]
+
+
+def test_batch_get():
+    with new_client() as client:
+        tag_objects(client, {'one_object': ['tag1', 'tag2'], 'another_object': ['tag1']})
+        response = client.post('/objects/tags:batchGet', json={'keys': ['one_object', 'missing'], 'limit': 1})
+        assert response.json() == {'one_object': ['tag1'], 'missing': []}
+        response = client.post('/tags/objects:batchGet', json={'keys': ['tag1', 'tag2']})
+        assert response.json() == {'tag1': ['another_object', 'one_object'], 'tag2': ['one_object']}
+        assert client.post('/tags/objects:batchGet', json={'limit': 1}).status_code == 422
+
+
+def test_bulk():
+    with new_client() as client:
+        tag_objects(client, {'b': ['t3'], 'c': ['t3', 't4']})
+        response = client.post('/bulk', json=[
+            {'operation': 'tag', 'object_name': 'a', 'tags': ['t1', 't2']},
+            {'operation': 'untag', 'object_name': 'a', 'tags': ['t2']},
+            {'operation': 'tag', 'tags': ['t5']},
+            {'operation': 'remove_object', 'object_name': 'b'},
+            {'operation': 'remove_tag', 'tag_name': 't3'},
+            {'operation': 'remove_tag'},
+        ])
+        assert response.status_code == 200
+        results = response.json()
+        assert [each['ok'] for each in results] == [True, True, False, True, True, False]
+        assert results[0]['error'] is None
+        assert 'object_name' in results[2]['error']
+        assert 'tag_name' in results[5]['error']
+        assert client.get('/objects').json() == ['a', 'c']
+        assert client.get('/objects/a/tags').json() == ['t1']
+        assert client.get('/tags/t3/objects').json() == []
+        assert client.post('/bulk', json=[{'operation': 'rename'}]).status_code == 422
+
+
+def test_export_import():
+    with new_client() as client:
+        tag_objects(client, {f'object{i}': [f'tag{i % 3}', 'all'] for i in range(5)})
+        response = client.get('/export', params={'chunk_size': 2})
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        exported = response.text
+        lines = [json.loads(line) for line in exported.splitlines()]
+        assert lines[0] == {'object': 'object0', 'tags': ['all', 'tag0']}
+        assert len(lines) == 5
+
+        with new_client() as other:
+            body = exported + 'not json\n{"object": "bad", "tags": [1]}\n\n{"object": "extra"}'
+            result = other.post('/import', params={'batch_size': 2}, content=body).json()
+            assert result['imported'] == 6
+            assert result['failed'] == 2
+            assert result['errors'][0].startswith('line 6: ')
+            assert result['errors'][1].startswith('line 7: expected')
+            assert other.get('/export').text == '{"object": "extra", "tags": []}\n' + exported
+
+
+def test_etags():
+    with new_client() as client:
+        tag_objects(client, {'one_object': ['tag1'], 'another_object': ['tag2']})
+        response = client.get('/objects')
+        etag = response.headers['etag']
+        assert etag.startswith('W/')
+        response = client.get('/objects', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['etag'] == etag
+        # The weak comparison ignores the W/
+        assert client.get('/objects', headers={'If-None-Match': f'"x", {etag[2:]}'}).status_code == 304
+
+        object_etag = client.get('/objects/one_object/tags').headers['etag']
+        tag_etag = client.get('/tags/tag1/count').headers['etag']
+        tag_objects(client, {'another_object': ['tag3']})
+        assert client.get('/objects/one_object/tags', headers={'If-None-Match': object_etag}).status_code == 304
+        assert client.get('/tags/tag1/count', headers={'If-None-Match': tag_etag}).status_code == 304
+        response = client.get('/objects', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+        assert response.json() == ['another_object', 'one_object']
+        client.post('/objects/one_object/tags', json=['tag4'])
+        response = client.get('/objects/one_object/tags', headers={'If-None-Match': object_etag})
+        assert response.status_code == 200
+        assert response.json() == ['tag1', 'tag4']
+
+
+def test_fast_responses():
+    with new_client(fast_responses=True) as client:
+        tag_objects(client, {'one_object': ['tag1', 'tag2'], 'another_object': ['tag1']})
+        response = client.get('/objects', params={'limit': 1})
+        assert response.headers['content-type'] == 'application/json'
+        assert response.headers['vary'] == 'Accept'
+        assert response.headers[NEXT_CURSOR_HEADER] == 'another_object'
+        assert 'etag' in response.headers
+        assert response.json() == ['another_object']
+        assert client.get('/tags/top').json() == [{'tag': 'tag1', 'count': 2}, {'tag': 'tag2', 'count': 1}]
+
+        msgpack = pytest.importorskip('msgpack')
+        response = client.get('/tags', headers={'Accept': MSGPACK_MEDIA_TYPE})
+        assert response.headers['content-type'] == MSGPACK_MEDIA_TYPE
+        assert msgpack.unpackb(response.content) == ['tag1', 'tag2']
+        response = client.get('/tags/top', headers={'Accept': f'application/json, {MSGPACK_MEDIA_TYPE};q=0.5'})
+        assert response.headers['content-type'] == 'application/json'
+        response = client.get('/tags/top', headers={'Accept': f'application/json;q=0.5, {MSGPACK_MEDIA_TYPE}'})
+        assert msgpack.unpackb(response.content) == [{'tag': 'tag1', 'count': 2}, {'tag': 'tag2', 'count': 1}]
+        # Wildcards only count for JSON
+        response = client.get('/tags', headers={'Accept': '*/*'})
+        assert response.headers['content-type'] == 'application/json'
+
+
+def test_fast_responses_schema():
+    with new_client(fast_responses=True) as client:
+        content = client.get('/openapi.json').json()['paths']['/tags']['get']['responses']['200']['content']
+        assert 'application/json' in content
+        pytest.importorskip('msgpack')
+        assert MSGPACK_MEDIA_TYPE in content
+
+
+def test_fast_responses_match_validated():
+    objects = {'one_object': ['tag1', 'tag2'], 'another_object': ['tag1'], 'café': ['été', 'tag1']}
+    paths = ['/tags', '/objects?limit=2', '/tags/tag1/objects', '/objects/café/tags', '/objects?any=tag2&any=été',
+             '/tags/top', '/tags/tag1/count']
+    pages = {}
+    for fast_responses in (False, True):
+        with new_client(fast_responses=fast_responses) as client:
+            tag_objects(client, objects)
+            pages[fast_responses] = [client.get(path) for path in paths]
+    for validated, fast in zip(pages[False], pages[True]):
+        assert fast.content == validated.content
+        assert fast.headers.get(NEXT_CURSOR_HEADER) == validated.headers.get(NEXT_CURSOR_HEADER)
+
+
+def test_fast_responses_without_orjson(monkeypatch):
+    monkeypatch.setattr(responses, 'orjson', None)
+    assert responses.dump_json([TagCount('tag1', 2), 'été']) == '[{"tag":"tag1","count":2},"été"]'.encode()
+    with new_client(fast_responses=True) as client:
+        tag_objects(client, {'one_object': ['tag1', 'tag2']})
+        response = client.get('/tags/top')
+        assert response.headers['content-type'] == 'application/json'
+        assert response.content == b'[{"tag":"tag1","count":1},{"tag":"tag2","count":1}]'
+
+
+def test_metrics():
+    metrics = MetricsRegistry()
+    with new_client(metrics=metrics) as client:
+        tag_objects(client, {'one_object': ['tag1']})
+        client.get('/objects/one_object/tags')
+        client.get('/missing')
+        response = client.get('/metrics')
+        assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+        text = response.text
+        assert '# TYPE tagapi_http_request_duration_seconds histogram' in text
+        assert 'tagapi_http_request_duration_seconds_count{method="GET",path="/objects/{object_name}/tags",' \
+               'status="200"} 1' in text
+        assert 'tagapi_http_request_duration_seconds_count{method="POST",path="/objects/{object_name}/tags",' \
+               'status="200"} 1' in text
+        assert 'path="unmatched",status="404"} 1' in text
+        assert 'tagapi_lock_wait_seconds' in text
+    with new_client() as client:
+        assert client.get('/metrics').status_code == 404
+
+
+def test_cache_metrics():
+    with new_client(cached=True, metrics=MetricsRegistry()) as client:
+        tag_objects(client, {'one_object': ['tag1']})
+        client.get('/tags/tag1/objects')
+        client.get('/tags/tag1/objects')
+        text = client.get('/metrics').text
+    # Totals, so rate() applies to them
+    assert '# TYPE tagapi_cache_hits_total counter' in text
+    assert 'tagapi_cache_hits_total 1\n' in text
+    assert 'tagapi_cache_misses_total 1\n' in text
+    assert 'tagapi_cache_evictions_total 0\n' in text
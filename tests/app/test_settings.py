@@ -0,0 +1,99 @@
+import os.path
+import tempfile
+
+import pytest
+from pydantic import ValidationError
+from starlette.testclient import TestClient
+
+from app import backends
+from app.backends import TagStorageSettings, UnknownStorageBackend, get_backend, parse_storage_settings
+from app.backends.pickle_db_settings import PickleDbSettings
+from app.backends.sqlite_settings import SqliteSettings
+from app.create_app import create_app
+from app.settings import Settings
+from tag_storage.caching_storage.caching_storage import CachingAsyncTagStorage
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage
+from tag_storage.sqlite_storage.sqlite_storage import SqliteStorage
+
+
+class OtherSettings(TagStorageSettings):
+    other_option: int = 1
+
+
+def test_backend_by_key():
+    settings = Settings(_env_file=None, tag_storage_settings={'pickledb_path': 'test', 'pickledb_compact': True})
+    assert isinstance(settings.tag_storage_settings, PickleDbSettings)
+    assert settings.tag_storage_settings.pickledb_compact
+    settings = Settings(_env_file=None, tag_storage_settings={'sqlite_path': 'test.db'})
+    assert isinstance(settings.tag_storage_settings, SqliteSettings)
+
+
+def test_backend_by_name(monkeypatch):
+    monkeypatch.setenv('tag_storage_settings', '{"backend": "sqlite", "sqlite_path": "test.db", "pickledb_path": "x"}')
+    settings = Settings(_env_file=None)
+    assert isinstance(settings.tag_storage_settings, SqliteSettings)
+    assert settings.tag_storage_settings.sqlite_path == 'test.db'
+    settings = Settings(_env_file=None, tag_storage_settings=PickleDbSettings(pickledb_path='test'))
+    assert settings.tag_storage_settings.pickledb_path == 'test'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValidationError, match='no storage backend redis'):
+        Settings(_env_file=None, tag_storage_settings={'backend': 'redis'})
+    with pytest.raises(ValidationError, match='need a backend'):
+        Settings(_env_file=None, tag_storage_settings={'path': 'test'})
+    with pytest.raises(UnknownStorageBackend):
+        parse_storage_settings({'backend': 'redis'})
+    with pytest.raises(ValidationError):
+        Settings(_env_file=None, tag_storage_settings={'pickledb_path': 'test', 'pickledb_durability': 'never'})
+
+
+def test_backend_entry_point(monkeypatch):
+    class EntryPoint:
+        name = 'other'
+        value = f'{__name__}:OtherSettings'
+
+    monkeypatch.setattr(backends, '_entry_points', lambda: [EntryPoint()])
+    monkeypatch.setattr(backends, 'BACKENDS', dict(backends.BACKENDS))
+    settings = Settings(_env_file=None, tag_storage_settings={'backend': 'other', 'other_option': 2})
+    assert isinstance(settings.tag_storage_settings, OtherSettings)
+    assert settings.tag_storage_settings.other_option == 2
+    assert get_backend('other').settings == f'{__name__}:OtherSettings'
+
+
+def test_old_settings_names():
+    # The settings of the storages moved to app.backends
+    from app.settings import PickleDbSettings as OldPickleDbSettings, SqliteSettings as OldSqliteSettings
+    assert OldPickleDbSettings is PickleDbSettings
+    assert OldSqliteSettings is SqliteSettings
+    import app.settings
+    with pytest.raises(AttributeError, match='MissingSettings'):
+        app.settings.MissingSettings
+
+
+def test_settings_storage():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'test.db')
+        settings = Settings(_env_file=None, tag_storage_settings={'sqlite_path': path}, cache_max_entries=10)
+        storage = settings.get_storage()
+        assert isinstance(storage, CachingAsyncTagStorage)
+        assert isinstance(storage.storage, SqliteStorage)
+        with TestClient(create_app(storage, settings.app_name)) as client:
+            client.post('/objects/one_object/tags', json=['tag1'])
+            assert client.get('/tags/tag1/objects').json() == ['one_object']
+        assert os.path.isfile(path)
+
+
+@pytest.mark.asyncio
+async def test_settings_pickle_storage():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'test')
+        settings = Settings(_env_file=None, tag_storage_settings={'pickledb_path': path})
+        storage = settings.get_storage()
+        assert isinstance(storage, PickledSetTagStorage)
+        await storage.tag('one_object', ['tag1'])
+        await storage.close()
+        storage = Settings(_env_file=None, tag_storage_settings={'backend': 'pickle', 'pickledb_path': path}) \
+            .get_storage()
+        assert await storage.get_tags() == ['tag1']
+        await storage.close()
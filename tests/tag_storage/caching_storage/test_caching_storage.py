@@ -0,0 +1,107 @@
+import os.path
+import tempfile
+
+import pytest
+
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+from tag_storage.caching_storage.caching_storage import CachingAsyncTagStorage
+from tag_storage.caching_storage.page_cache import PageCache, PageCacheConfiguration, TAGS
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_hits_and_invalidation():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test')))
+        cached = CachingAsyncTagStorage(storage)
+        await cached.tag("object1", ["a", "b"])
+        await cached.tag("object2", ["a"])
+        assert await cached.get_tagged_objects("a") == ["object1", "object2"]
+        assert await cached.get_tagged_objects("a") == ["object1", "object2"]
+        assert await cached.get_object_tags("object2") == ["a"]
+        assert await cached.get_tagged_objects("b", limit=1) == ["object1"]
+        assert (cached.stats.hits, cached.stats.misses) == (1, 3)
+
+        # Only the listings of the written names are dropped
+        await cached.tag("object2", ["c"])
+        assert await cached.get_tagged_objects("a") == ["object1", "object2"]
+        assert await cached.get_tagged_objects("b", limit=1) == ["object1"]
+        assert (cached.stats.hits, cached.stats.misses) == (3, 3)
+        assert await cached.get_object_tags("object2") == ["a", "c"]
+
+        # A name after a full page does not change it
+        await cached.tag("object3", ["b"])
+        assert await cached.get_tagged_objects("b", limit=1) == ["object1"]
+        assert cached.stats.hits == 4
+
+        await cached.untag("object1", ["a"])
+        assert await cached.get_tagged_objects("a") == ["object2"]
+        await cached.remove_object("object2")
+        assert await cached.get_tagged_objects("a") == []
+        assert await cached.get_objects() == ["object1", "object3"]
+        await cached.remove_tag("b")
+        assert await cached.get_object_tags("object1") == []
+        assert await cached.get_tags() == ["a", "c"]
+        await cached.bulk_apply([BulkOperation(BulkOperationType.TAG, object_name="object4", tags=["a"])])
+        assert await cached.get_tags() == ["a", "c"]
+        assert await cached.get_tagged_objects("a") == ["object4"]
+        assert await cached.query_objects(any_tags=["a"]) == ["object4"]
+        await cached.tag("object1", ["a"])
+        assert await cached.query_objects(any_tags=["a"]) == ["object1", "object4"]
+
+        # Pages of other prefixes are kept
+        assert await cached.get_objects(prefix="object1") == ["object1"]
+        hits = cached.stats.hits
+        await cached.tag("object5", ["a"])
+        assert await cached.get_objects(prefix="object1") == ["object1"]
+        assert cached.stats.hits == hits + 1
+        await cached.tag("object10", ["a"])
+        assert await cached.get_objects(prefix="object1") == ["object1", "object10"]
+        await cached.close()
+
+
+@pytest.mark.asyncio
+async def test_get_many():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test')))
+        cached = CachingAsyncTagStorage(storage)
+        await cached.tag("object1", ["a", "b"])
+        await cached.tag("object2", ["a"])
+        assert await cached.get_object_tags("object1") == ["a", "b"]
+        # The pages of the single listings are shared, only the missing ones are read
+        assert await cached.get_many_object_tags(["object2", "object1"]) == {"object2": ["a"], "object1": ["a", "b"]}
+        assert (cached.stats.hits, cached.stats.misses) == (1, 2)
+        assert await cached.get_object_tags("object2") == ["a"]
+        assert cached.stats.hits == 2
+        await cached.untag("object1", ["b"])
+        assert await cached.get_many_object_tags(["object1", "object2"]) == {"object1": ["a"], "object2": ["a"]}
+        assert await cached.get_many_tagged_objects(["a", "b"], limit=1) == {"a": ["object1"], "b": []}
+        await cached.close()
+
+
+def test_page_cache_bounds():
+    clock = Clock()
+    cache = PageCache(PageCacheConfiguration(max_entries=2, ttl=10), clock=clock)
+    listing = (TAGS, None)
+    for offset in range(3):
+        cache.put(listing + (1, offset, None), listing, [str(offset)], 1, None, cache.generation)
+    assert cache.get(listing + (1, 0, None)) is None
+    assert cache.get(listing + (1, 1, None)) == ["1"]
+    assert cache.stats.evictions == 1
+    clock.now = 10
+    assert cache.get(listing + (1, 2, None)) is None
+
+    # A page read before a write finished is not stored
+    generation = cache.generation
+    cache.invalidate(listing, ["x"])
+    cache.put(listing + (1, 0, None), listing, ["0"], 1, None, generation)
+    assert cache.get(listing + (1, 0, None)) is None
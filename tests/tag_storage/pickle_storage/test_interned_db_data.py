@@ -0,0 +1,92 @@
+import os.path
+import pickle
+import tempfile
+
+import pytest
+from sortedcontainers import SortedDict, SortedSet
+
+from tag_storage.pickle_storage.interned_db_data import InternedPickleDbData
+from tag_storage.pickle_storage.pickle_db_data import PickleDbData
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration
+
+
+def test_interned_set():
+    data = InternedPickleDbData()
+    for name in ["d", "b", "a", "c", "e"]:
+        data.objects[name] = SortedSet()
+    data.tags["tag"] = ["c", "a"]
+    tagged = data.tags["tag"]
+    assert list(tagged) == ["a", "c"]
+    tagged.add("b")
+    tagged.add("b")
+    tagged.update(["e", "d"])
+    assert list(tagged) == ["a", "b", "c", "d", "e"]
+    assert len(tagged) == 5
+    assert "c" in tagged and "f" not in tagged
+    assert list(tagged.islice(1, 3)) == ["b", "c"]
+    assert list(tagged.irange("b", "d")) == ["b", "c", "d"]
+    assert list(tagged.irange("b", "d", inclusive=(False, False))) == ["c"]
+    tagged.discard("c")
+    tagged.discard("f")
+    tagged.difference_update(["a", "e"])
+    assert list(tagged) == ["b", "d"]
+    with pytest.raises(KeyError):
+        tagged.remove("a")
+    with pytest.raises(KeyError):
+        tagged.add("not an object")
+
+
+def test_interned_ids_are_reused():
+    data = InternedPickleDbData()
+    data.objects["one_object"] = []
+    data.tags["tag1"] = ["one_object"]
+    data.objects["one_object"].add("tag1")
+    data.objects["one_object"].discard("tag1")
+    assert data.tags.pop("tag1") == SortedSet(["one_object"])
+    assert data.tags.pop("tag1", None) is None
+    data.tags["tag2"] = ["one_object"]
+    assert len(data.tags.names) == 1
+    assert list(data.tags) == ["tag2"]
+    assert list(data.tags["tag2"]) == ["one_object"]
+
+
+def test_conversion():
+    data = PickleDbData(tags=SortedDict({"tag1": SortedSet(["a", "b"]), "tag2": SortedSet(["b"]), "tag3": SortedSet()}),
+                       objects=SortedDict({"a": SortedSet(["tag1"]), "b": SortedSet(["tag1", "tag2"])}))
+    interned = InternedPickleDbData.from_pickle_db_data(data)
+    assert list(interned.tags.islice(1, 3)) == ["tag2", "tag3"]
+    assert list(interned.objects["b"]) == ["tag1", "tag2"]
+    assert list(interned.tags["tag1"]) == ["a", "b"]
+    assert interned.to_pickle_db_data() == data
+    assert pickle.loads(pickle.dumps(interned)).to_pickle_db_data() == data
+
+
+@pytest.mark.asyncio
+async def test_compact_storage():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, compact=True)
+        storage = PickledSetTagStorage(config)
+        tags = ["tag1", "tag2"]
+        await storage.tag("one_object", tags)
+        await storage.tag("another_object", [tags[0]])
+        assert await storage.get_objects() == ["another_object", "one_object"]
+        assert await storage.get_tagged_objects(tags[0]) == ["another_object", "one_object"]
+        assert await storage.get_tagged_objects(tags[0], limit=1, offset=1) == ["one_object"]
+        await storage.untag("one_object", [tags[0]])
+        assert await storage.get_object_tags("one_object") == [tags[1]]
+        await storage.remove_tag(tags[1])
+        assert await storage.get_tags() == [tags[0]]
+        assert await storage.get_object_tags("one_object") == []
+        await storage.remove_object("another_object")
+        assert await storage.get_tagged_objects(tags[0]) == []
+        await storage.tag("third_object", tags)
+        await storage.close()
+
+        with open(file_path, 'rb') as db_file:
+            assert isinstance(pickle.load(db_file), InternedPickleDbData)
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path))
+        assert isinstance(storage.db_data, PickleDbData)
+        assert await storage.get_objects() == ["one_object", "third_object"]
+        assert await storage.get_tagged_objects(tags[1]) == ["third_object"]
+        await storage.close()
@@ -0,0 +1,131 @@
+import copy
+import os.path
+import pickle
+import tempfile
+
+import pytest
+from sortedcontainers import SortedDict, SortedSet
+
+from tag_storage.base_storage.tag_count import TagCount
+from tag_storage.pickle_storage.mapped_db_data import MappedDbData, write_mapped_db_data, convert_pickle_file
+from tag_storage.pickle_storage.pickle_db_data import PickleDbData
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration, \
+    SnapshotMode
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration
+
+
+def sample_data():
+    return PickleDbData(
+        tags=SortedDict({"tag1": SortedSet(["a", "b", "é"]), "tag2": SortedSet(["b"]), "tag3": SortedSet()}),
+        objects=SortedDict({"a": SortedSet(["tag1"]), "b": SortedSet(["tag1", "tag2"]), "é": SortedSet(["tag1"])}))
+
+
+def mapped(temp_dir, data):
+    file_path = os.path.join(temp_dir, 'mapped')
+    with open(file_path, 'wb') as f:
+        write_mapped_db_data(data, f)
+    return MappedDbData.open(file_path)
+
+
+def test_mapped_set():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data = mapped(temp_dir, sample_data())
+        tagged = data.tags["tag1"]
+        assert list(tagged) == ["a", "b", "é"]
+        assert len(tagged) == 3
+        assert "b" in tagged and "c" not in tagged
+        assert list(tagged.islice(1, 3)) == ["b", "é"]
+        assert list(tagged.irange("b", "z")) == ["b"]
+        assert list(tagged.irange("a", "b", inclusive=(False, True))) == ["b"]
+        data.objects["c"] = []
+        tagged.add("c")
+        tagged.add("b")
+        tagged.discard("a")
+        tagged.discard("not an object")
+        assert list(tagged) == ["b", "c", "é"]
+        assert len(tagged) == 3
+        assert list(tagged.irange("c")) == ["c", "é"]
+        assert list(tagged.islice(1, 2)) == ["c"]
+        assert list(reversed(tagged)) == ["é", "c", "b"]
+        tagged.update(["a"])
+        tagged.difference_update(["c", "é"])
+        assert list(tagged) == ["a", "b"]
+        with pytest.raises(KeyError):
+            tagged.remove("c")
+
+
+def test_mapped_keys():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data = mapped(temp_dir, sample_data())
+        assert list(data.tags) == ["tag1", "tag2", "tag3"]
+        assert len(data.objects) == 3
+        assert list(data.objects.islice(1, 3)) == ["b", "é"]
+        data.tags["tag0"] = ["b"]
+        data.objects["b"].add("tag0")
+        data.objects["b"].discard("tag2")
+        data.tags["tag2"].discard("b")
+        assert data.tags.pop("tag2") == SortedSet()
+        assert data.tags.pop("tag2", None) is None
+        assert "tag2" not in data.tags and "tag0" in data.tags
+        assert list(data.tags) == ["tag0", "tag1", "tag3"]
+        assert list(data.tags.irange("tag1", "tag3", inclusive=(False, True))) == ["tag3"]
+        assert list(data.tags.islice(0, 2)) == ["tag0", "tag1"]
+        # Replacing a key hides its set in the file
+        data.tags["tag1"] = ["a"]
+        assert list(data.tags["tag1"]) == ["a"]
+        assert len(data.tags) == 3
+        assert [(name, list(values)) for name, values in data.tags.items()] == \
+               [("tag0", ["b"]), ("tag1", ["a"]), ("tag3", [])]
+
+        snapshot = copy.deepcopy(data)
+        data.tags["tag3"].add("a")
+        assert list(snapshot.tags["tag3"]) == []
+
+
+def test_conversion():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data = sample_data()
+        assert mapped(temp_dir, data).to_pickle_db_data() == data
+        pickle_path = os.path.join(temp_dir, 'pickle')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(data, f)
+        mapped_path = os.path.join(temp_dir, 'converted')
+        convert_pickle_file(pickle_path, mapped_path)
+        assert MappedDbData.open(mapped_path).to_pickle_db_data() == data
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("snapshot_mode", [SnapshotMode.COPY, SnapshotMode.FORK])
+async def test_mapped_storage(snapshot_mode):
+    if snapshot_mode == SnapshotMode.FORK and not hasattr(os, 'fork'):
+        pytest.skip("fork is not available")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        with open(file_path, 'wb') as f:
+            pickle.dump(sample_data(), f)
+        config = PickledSetTagStorageConfiguration(path=file_path, mapped=True, snapshot_mode=snapshot_mode,
+                                                   journal=PickledSetTagStorageJournalConfiguration(
+                                                       checkpoint_bytes=1))
+        # The pickle file is converted when loaded
+        storage = PickledSetTagStorage(config)
+        assert isinstance(storage.db_data, MappedDbData)
+        await storage.tag("c", ["tag3"])
+        await storage.remove_tag("tag2")
+        await storage.online_sync()
+        # The new snapshot is mapped instead of the old file with the changes
+        assert not storage.db_data.tags.added_keys and not storage.db_data.tags.added
+        assert await storage.get_tags() == ["tag1", "tag3"]
+        assert await storage.get_top_tags() == [TagCount("tag1", 3), TagCount("tag3", 1)]
+        await storage.untag("a", ["tag1"])
+        await storage.close()
+
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_tagged_objects("tag1") == ["b", "é"]
+        assert await storage.get_object_tags("c") == ["tag3"]
+        await storage.close()
+
+        # And back to a pickle
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path))
+        assert isinstance(storage.db_data, PickleDbData)
+        assert await storage.get_objects() == ["a", "b", "c", "é"]
+        await storage.close()
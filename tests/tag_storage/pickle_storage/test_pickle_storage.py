@@ -1,13 +1,25 @@
+import asyncio
+import collections
 import os.path
 import pickle
 import tempfile
+import threading
 import unittest
 
 import pytest
 
+from tag_storage.base_storage.async_tag_storage import AsyncTagStorage
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType, BulkOperationResult
+from tag_storage.base_storage.change_feed import ChangeFeed, ChangeFeedConfiguration, ChangesLost, SubscriberTooSlow
+from tag_storage.base_storage.instrumentation import Instrumentation
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+from tag_storage.base_storage.versions import Versions
 from tag_storage.pickle_storage.pickle_db_data import PickleDbData
 from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration, \
-    InvalidPickleDatabaseFile
+    InvalidPickleDatabaseFile, SnapshotFailed, SnapshotMode
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration
+from tag_storage.pickle_storage.pickle_storage_synchronizer import PickledSetTagStorageSynchronizer
+from tag_storage.pickle_storage.tag_cooccurrence import TagCooccurrenceConfiguration
 
 
 @pytest.mark.asyncio
@@ -122,3 +134,571 @@ async def test_load_db_wrong_content():
         with pytest.raises(InvalidPickleDatabaseFile):
             PickledSetTagStorage(config)
         await config.synchronizer.close()
+
+
+@pytest.mark.asyncio
+async def test_journal_replay():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, journal=PickledSetTagStorageJournalConfiguration())
+        storage = PickledSetTagStorage(config)
+        tags = ["tag1", "tag2", "tag3"]
+        await storage.tag("one_object", tags)
+        await storage.tag("another_object", tags)
+        await storage.untag("one_object", [tags[0]])
+        await storage.remove_tag(tags[1])
+        await storage.remove_object("another_object")
+        await storage.close()
+        with open(file_path, 'rb') as db_file:
+            assert pickle.load(db_file) == PickleDbData()  # everything is still in the journal
+        assert os.path.getsize(file_path + '.journal') > 0
+
+        config = PickledSetTagStorageConfiguration(path=file_path, journal=PickledSetTagStorageJournalConfiguration())
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_objects() == ["one_object"]
+        assert await storage.get_tags() == [tags[0], tags[2]]
+        assert await storage.get_object_tags("one_object") == [tags[2]]
+        assert await storage.get_tagged_objects(tags[0]) == []
+        assert await storage.get_tagged_objects(tags[2]) == ["one_object"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_journal_checkpoint():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, journal=PickledSetTagStorageJournalConfiguration(
+            checkpoint_bytes=1))
+        storage = PickledSetTagStorage(config)
+        await storage.tag("one_object", ["tag1"])
+        await storage.online_sync()
+        assert os.path.getsize(file_path + '.journal') == 0
+        with open(file_path, 'rb') as db_file:
+            assert list(pickle.load(db_file).objects) == ["one_object"]
+        await storage.tag("another_object", ["tag1"])
+        await storage.close()
+
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_tagged_objects("tag1") == ["another_object", "one_object"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_journal_torn_write():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, journal=PickledSetTagStorageJournalConfiguration())
+        storage = PickledSetTagStorage(config)
+        await storage.tag("one_object", ["tag1"])
+        await storage.close()
+        with open(file_path + '.journal', 'ab') as journal_file:
+            journal_file.write(pickle.dumps(('t', 'another_object', ['tag1']))[:-3])
+
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_objects() == ["one_object"]
+        await storage.tag("another_object", ["tag2"])
+        await storage.close()
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_objects() == ["another_object", "one_object"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("snapshot_mode", [SnapshotMode.COPY, SnapshotMode.FORK])
+async def test_online_sync(snapshot_mode):
+    if snapshot_mode == SnapshotMode.FORK and not hasattr(os, 'fork'):
+        pytest.skip("fork is not available")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, snapshot_mode=snapshot_mode)
+        storage = PickledSetTagStorage(config)
+        await storage.tag("one_object", ["tag1", "tag2"])
+        await storage.online_sync()
+        assert not storage.dirty
+        assert os.listdir(temp_dir) == ['test']
+        with open(file_path, 'rb') as db_file:
+            data = pickle.load(db_file)
+        assert list(data.objects) == ["one_object"]
+        assert list(data.tags["tag2"]) == ["one_object"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_online_sync_child_fails(monkeypatch):
+    if not hasattr(os, 'fork'):
+        pytest.skip("fork is not available")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, snapshot_mode=SnapshotMode.FORK,
+                                                   journal=PickledSetTagStorageJournalConfiguration(
+                                                       checkpoint_bytes=1))
+        storage = PickledSetTagStorage(config)
+        await storage.tag("one_object", ["tag1"])
+
+        def fail(db_data, f):
+            raise OSError("disk full")
+        # The forked child that writes the snapshot inherits it
+        monkeypatch.setattr(storage, '_dump', fail)
+        with pytest.raises(SnapshotFailed):
+            await storage.online_sync()
+        assert storage.dirty
+        assert sorted(os.listdir(temp_dir)) == ['test', 'test.journal']
+        monkeypatch.undo()
+        await storage.online_sync()
+        assert not storage.dirty
+        await storage.close()
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_object_tags("one_object") == ["tag1"]
+        await storage.close()
+
+
+class ManualSynchronizer(PickledSetTagStorageSynchronizer):
+    """Leaves the syncs to the test"""
+
+    def __init__(self, config=None):
+        pass
+
+    def sync_store(self, store: PickledSetTagStorage):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_online_sync_copy_on_write(monkeypatch, compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test'), compact=compact,
+                                                   synchronizer=ManualSynchronizer())
+        storage = PickledSetTagStorage(config)
+        await storage.tag("one_object", ["tag1", "tag2"])
+        await storage.tag("another_object", ["tag1"])
+        writing, writes_done = threading.Event(), threading.Event()
+        written = []
+        dump = storage._dump
+
+        def dump_after_the_writes(db_data, f):
+            writing.set()
+            writes_done.wait(10)
+            written.append(({name: list(db_data.objects[name]) for name in db_data.objects},
+                            {name: list(db_data.tags[name]) for name in db_data.tags}))
+            dump(db_data, f)
+        monkeypatch.setattr(storage, '_dump', dump_after_the_writes)
+        sync = asyncio.ensure_future(storage.online_sync())
+        await asyncio.get_running_loop().run_in_executor(None, writing.wait, 10)
+        # They change sets the snapshot being written shares
+        await storage.tag("one_object", ["tag3"])
+        await storage.untag("another_object", ["tag1"])
+        await storage.remove_tag("tag2")
+        writes_done.set()
+        await sync
+        assert storage.snapshot is None
+        assert written[0] == ({"another_object": ["tag1"], "one_object": ["tag1", "tag2"]},
+                              {"tag1": ["another_object", "one_object"], "tag2": ["one_object"]})
+        assert await storage.get_object_tags("one_object") == ["tag1", "tag3"]
+        assert await storage.get_object_tags("another_object") == []
+        assert await storage.get_tagged_objects("tag1") == ["one_object"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_query_objects():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path)
+        storage = PickledSetTagStorage(config)
+        await storage.tag("object1", ["a", "b"])
+        await storage.tag("object2", ["a", "c"])
+        await storage.tag("object3", ["b"])
+        await storage.tag("object4", [])
+        assert await storage.query_objects(all_tags=["a"]) == ["object1", "object2"]
+        assert await storage.query_objects(all_tags=["a", "b"]) == ["object1"]
+        assert await storage.query_objects(all_tags=["a"], none_tags=["c"]) == ["object1"]
+        assert await storage.query_objects(any_tags=["b", "c"]) == ["object1", "object2", "object3"]
+        assert await storage.query_objects(any_tags=["b", "c"], limit=1, offset=1) == ["object2"]
+        assert await storage.query_objects(all_tags=["a"], any_tags=["b", "fake tag"]) == ["object1"]
+        assert await storage.query_objects(none_tags=["a"]) == ["object3", "object4"]
+        assert await storage.query_objects(all_tags=["a", "fake tag"]) == []
+        assert await storage.query_objects(any_tags=["fake tag"]) == []
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_keyset_pagination(compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, compact=compact)
+        storage = PickledSetTagStorage(config)
+        tags = ["tag1", "tag2", "tag3"]
+        await storage.tag("object1", tags)
+        await storage.tag("object2", tags[:1])
+        assert await storage.get_tags(limit=2, after="tag1") == ["tag2", "tag3"]
+        assert await storage.get_tags(after="tag11") == ["tag2", "tag3"]
+        assert await storage.get_tags(offset=1, after="tag1") == ["tag3"]
+        assert await storage.get_objects(after="object1") == ["object2"]
+        assert await storage.get_objects(after="object2") == []
+        assert await storage.get_object_tags("object1", limit=1, after="tag2") == ["tag3"]
+        assert await storage.get_tagged_objects("tag1", after="object1") == ["object2"]
+        assert await storage.get_tagged_objects("fake tag", after="object1") == []
+        assert await storage.query_objects(all_tags=["tag1"], after="object1") == ["object2"]
+        assert await storage.query_objects(any_tags=["tag1", "tag2"], after="object1") == ["object2"]
+        assert await storage.query_objects(none_tags=["tag2"], after="object1") == ["object2"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_bulk_apply():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, journal=PickledSetTagStorageJournalConfiguration())
+        storage = PickledSetTagStorage(config)
+        results = await storage.bulk_apply([
+            BulkOperation(BulkOperationType.TAG, object_name="object1", tags=["tag1", "tag2"]),
+            BulkOperation(BulkOperationType.TAG, object_name="object2", tags=["tag1", "tag3"]),
+            BulkOperation(BulkOperationType.TAG, tags=["tag1"]),
+            BulkOperation(BulkOperationType.UNTAG, object_name="object1", tags=["tag1"]),
+            BulkOperation(BulkOperationType.REMOVE_TAG, tag_name="tag3"),
+            BulkOperation(BulkOperationType.REMOVE_OBJECT, object_name="fake object"),
+        ])
+        assert [result.ok for result in results] == [True, True, False, True, True, True]
+        assert results[2] == BulkOperationResult(ok=False, error="tag needs an object_name")
+        assert await storage.get_tags() == ["tag1", "tag2"]
+        assert await storage.get_tagged_objects("tag1") == ["object2"]
+        assert await storage.get_object_tags("object1") == ["tag2"]
+        await storage.close()
+
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_object_tags("object1") == ["tag2"]
+        assert await storage.get_object_tags("object2") == ["tag1"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_get_objects_with_tags(compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path, compact=compact))
+        await storage.tag("object1", ["tag2", "tag1"])
+        await storage.tag("object2", ["tag1"])
+        await storage.tag("object3", ["tag3"])
+        await storage.untag("object3", ["tag3"])
+        assert await storage.get_objects_with_tags(limit=2) == [("object1", ["tag1", "tag2"]),
+                                                                ("object2", ["tag1"])]
+        assert await storage.get_objects_with_tags(after="object2") == [("object3", [])]
+        # The default implementation, on the listings
+        assert await AsyncTagStorage.get_objects_with_tags(storage, limit=1, after="object1") == \
+               [("object2", ["tag1"])]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_get_many(compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path, compact=compact))
+        await storage.tag("object1", ["tag2", "tag1", "tag3"])
+        await storage.tag("object2", ["tag1"])
+        assert await storage.get_many_object_tags(["object2", "object1", "fake object", "object2"], limit=2) == \
+               {"object2": ["tag1"], "object1": ["tag1", "tag2"], "fake object": []}
+        assert list(await storage.get_many_object_tags(["object2", "object1"])) == ["object2", "object1"]
+        assert await storage.get_many_tagged_objects(["tag1", "fake tag"], limit=1) == {"tag1": ["object1"],
+                                                                                       "fake tag": []}
+        # The default implementation, on the listings
+        assert await AsyncTagStorage.get_many_tagged_objects(storage, ["tag3", "tag1"]) == \
+               {"tag3": ["object1"], "tag1": ["object1", "object2"]}
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_counts_and_top_tags(compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, compact=compact,
+                                                   journal=PickledSetTagStorageJournalConfiguration())
+        storage = PickledSetTagStorage(config)
+        await storage.tag("object1", ["tag1", "tag2", "tag3"])
+        await storage.tag("object2", ["tag1", "tag2"])
+        await storage.tag("object3", ["tag1"])
+        assert await storage.count_tagged_objects("tag1") == 3
+        assert await storage.count_tagged_objects("fake tag") == 0
+        assert await storage.count_object_tags("object1") == 3
+        assert await storage.get_top_tags(2) == [TagCount("tag1", 3), TagCount("tag2", 2)]
+        await storage.untag("object1", ["tag1", "tag1"])
+        await storage.remove_object("object2")
+        await storage.tag("object4", ["tag3", "tag4"])
+        assert await storage.get_top_tags() == [TagCount("tag3", 2), TagCount("tag1", 1), TagCount("tag2", 1),
+                                                TagCount("tag4", 1)]
+        await storage.remove_tag("tag3")
+        await storage.untag("object4", ["tag4"])
+        expected = [TagCount("tag1", 1), TagCount("tag2", 1), TagCount("tag4", 0)]
+        assert await storage.get_top_tags() == expected
+        await storage.close()
+
+        # Rebuilt from the snapshot and the journal
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_top_tags() == expected
+        await storage.close()
+
+
+
+async def _assert_related_as_without_index(storage: PickledSetTagStorage):
+    cooccurrence = storage.tag_cooccurrence
+    related = {tag: await storage.get_related_tags(tag, score=score) for tag in await storage.get_tags()
+               for score in RelatedScore}
+    storage.tag_cooccurrence = None
+    try:
+        assert related == {tag: await storage.get_related_tags(tag, score=score) for tag in await storage.get_tags()
+                           for score in RelatedScore}
+    finally:
+        storage.tag_cooccurrence = cooccurrence
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_related_tags(compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, compact=compact,
+                                                   journal=PickledSetTagStorageJournalConfiguration(),
+                                                   cooccurrence=TagCooccurrenceConfiguration())
+        storage = PickledSetTagStorage(config)
+        await storage.tag("object1", ["tag1", "tag2", "tag3"])
+        await storage.tag("object2", ["tag1", "tag2", "tag2"])
+        await storage.tag("object3", ["tag1"])
+        assert await storage.get_related_tags("tag1") == [RelatedTag("tag2", 2, 2.0), RelatedTag("tag3", 1, 1.0)]
+        assert await storage.get_related_tags("tag1", k=1, score=RelatedScore.JACCARD) == \
+               [RelatedTag("tag2", 2, 2 / 3)]
+        assert await storage.get_related_tags("fake tag") == []
+        await _assert_related_as_without_index(storage)
+        await storage.untag("object1", ["tag1"])
+        await storage.remove_object("object2")
+        await storage.tag("object4", ["tag3", "tag4"])
+        assert await storage.get_related_tags("tag1") == []
+        assert await storage.get_related_tags("tag3") == [RelatedTag("tag2", 1, 1.0), RelatedTag("tag4", 1, 1.0)]
+        await _assert_related_as_without_index(storage)
+        await storage.remove_tag("tag3")
+        await storage.bulk_apply([BulkOperation(BulkOperationType.TAG, object_name="object3", tags=["tag2", "tag4"]),
+                                  BulkOperation(BulkOperationType.UNTAG, object_name="object4", tags=["tag4"]),
+                                  BulkOperation(BulkOperationType.TAG, object_name="object1", tags=["tag4"])])
+        expected = [RelatedTag("tag2", 2, 1.0), RelatedTag("tag1", 1, 0.5)]
+        assert await storage.get_related_tags("tag4", score=RelatedScore.JACCARD) == expected
+        await _assert_related_as_without_index(storage)
+        await storage.close()
+
+        # Rebuilt from the snapshot and the journal
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_related_tags("tag4", score=RelatedScore.JACCARD) == expected
+        await _assert_related_as_without_index(storage)
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_related_tags_sketch():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test'), cooccurrence=
+                                                   TagCooccurrenceConfiguration(max_exact=4, sketch_size=3))
+        storage = PickledSetTagStorage(config)
+        for i in range(1, 6):
+            for j in range(i):
+                await storage.tag(f"object{i}:{j}", ["common", f"tag{i}"])
+        # The sketch kept tag4, tag3 and tag2, then tag5 replaced tag2 and inherited its count, over its own objects
+        assert await storage.get_related_tags("common", k=3) == [RelatedTag("tag5", 5, 5.0),
+                                                                 RelatedTag("tag4", 4, 4.0),
+                                                                 RelatedTag("tag3", 3, 3.0)]
+        await storage.remove_tag("tag3")
+        assert [related.tag for related in await storage.get_related_tags("common")] == ["tag5", "tag4"]
+        # The tags with few objects still count exactly
+        assert await storage.get_related_tags("tag1") == [RelatedTag("common", 1, 1.0)]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compact", [False, True])
+async def test_prefix_and_range(compact):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path, compact=compact))
+        for name in ["user:1:a", "user:1:b", "user:12:a", "user:2:a", "group:1"]:
+            await storage.tag(name, ["tag:" + name, "common"])
+        assert await storage.get_objects(prefix="user:1:") == ["user:1:a", "user:1:b"]
+        assert await storage.get_objects(prefix="user:1:", after="user:1:a") == ["user:1:b"]
+        assert await storage.get_objects(prefix="user:", limit=1, offset=1, after="user:1:a") == ["user:2:a"]
+        assert await storage.get_objects(start="user:1:b", end="user:2:a") == ["user:1:b"]
+        assert await storage.get_objects(start="user:1:b", after="user:1:b") == ["user:2:a"]
+        assert await storage.get_objects(prefix="nobody") == []
+        assert await storage.get_tags(prefix="tag:g") == ["tag:group:1"]
+        assert await storage.get_tagged_objects("common", end="user") == ["group:1"]
+        assert await storage.get_object_tags("group:1", start="d") == ["tag:group:1"]
+        assert await storage.query_objects(any_tags=["common"], prefix="user:2") == ["user:2:a"]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_remove_tag_in_chunks():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, remove_chunk_size=10)
+        storage = PickledSetTagStorage(config)
+        objects = [f"object{i:03}" for i in range(100)]
+        await storage.bulk_apply([BulkOperation(BulkOperationType.TAG, object_name=each, tags=["big", "other"])
+                                  for each in objects])
+        removal = asyncio.get_event_loop().create_task(storage.remove_tag("big"))
+        while await storage.count_tagged_objects("big") == 100:
+            await asyncio.sleep(0)
+        # Writes on other keys and reads go on between the chunks
+        await storage.tag("unrelated", ["small"])
+        assert not removal.done()
+        await removal
+        assert await storage.get_tags() == ["other", "small"]
+        assert await storage.get_object_tags(objects[-1]) == ["other"]
+        assert await storage.get_top_tags() == [TagCount("other", 100), TagCount("small", 1)]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_remove_tag_interrupted_after_snapshot():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, remove_chunk_size=10,
+                                                   journal=PickledSetTagStorageJournalConfiguration())
+        storage = PickledSetTagStorage(config)
+        for i in range(100):
+            await storage.tag(f"object{i:03}", ["big"])
+        removal = asyncio.get_event_loop().create_task(storage.remove_tag("big"))
+        while await storage.count_tagged_objects("big") == 100:
+            await asyncio.sleep(0)
+        # The snapshot has half of the removal and the journal is truncated, the removal must still be replayed
+        await storage.offline_sync()
+        removal.cancel()
+        await storage.close()
+
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_tags() == []
+        assert await storage.get_object_tags("object099") == []
+        await storage.close()
+
+
+class RecordingInstrumentation(Instrumentation):
+    enabled = True
+
+    def __init__(self):
+        self.observed = collections.defaultdict(list)
+        self.values = {}
+
+    def observe(self, name: str, value: float, **labels: str):
+        self.observed[name, tuple(sorted(labels.items()))].append(value)
+
+    def set(self, name: str, value: float, **labels: str):
+        self.values[name] = value
+
+
+@pytest.mark.asyncio
+async def test_versions():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test')))
+        versions = storage.versions
+        etags = {"tag1": versions.etag(tag="tag1"), "object1": versions.etag(tagged_object="object1"),
+                 None: versions.etag()}
+        await storage.tag("object1", ["tag1"])
+        await storage.tag("object2", ["tag2"])
+        assert versions.etag(tag="tag2") != versions.etag(tag="tag1") != etags["tag1"]
+        etags = {"tag1": versions.etag(tag="tag1"), "object1": versions.etag(tagged_object="object1"),
+                 None: versions.etag()}
+        await storage.untag("object2", ["tag2"])
+        assert versions.etag(tag="tag1") == etags["tag1"]
+        assert versions.etag(tagged_object="object1") == etags["object1"]
+        assert versions.etag() != etags[None]
+        await storage.remove_tag("tag1")
+        assert versions.etag(tagged_object="object1") != etags["object1"]
+        await storage.close()
+
+    # Forgotten names report the newest forgotten version, they never go back
+    versions = Versions(max_names=2)
+    versions.changed(tags=["tag1"])
+    versions.changed(tags=["tag2", "tag3"])
+    assert versions.of_tag("tag1") == versions.of_tag("fake tag") == 1 and versions.of_tag("tag3") == 2
+    versions.changed(objects=["object%d" % i for i in range(3)])
+    assert versions.of_object("object1") == versions.of_tag("fake tag") == 3
+
+
+@pytest.mark.asyncio
+async def test_change_feed():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=os.path.join(temp_dir, 'test')))
+        feed = ChangeFeed(ChangeFeedConfiguration(buffer_size=4, queue_size=2))
+        storage.watch_changes(feed)
+        everything = feed.subscribe()
+        of_tag1 = feed.subscribe(tags=["tag1"])
+        of_object2 = feed.subscribe(objects=["object2"])
+        await storage.tag("object1", ["tag1"])
+        await storage.bulk_apply([BulkOperation(BulkOperationType.TAG, object_name="object2", tags=["tag2"]),
+                                  BulkOperation(BulkOperationType.TAG, tags=["tag2"])])
+        assert [(change.sequence, change.object_name) async for change in _take(everything, 2)] == \
+               [(1, "object1"), (2, "object2")]
+        assert [change.sequence async for change in _take(of_tag1, 1)] == [1]
+        assert [change.sequence async for change in _take(of_object2, 1)] == [2]
+        await storage.remove_tag("tag2")
+        # The objects of the tag are not in the change, it reaches the subscribers of any object
+        assert (await of_object2.__anext__()).tag_name == "tag2" and not of_tag1.queue
+
+        # Resumed from the buffer, until it no longer has the changes
+        resumed = feed.subscribe(after=1, epoch=feed.epoch)
+        assert [change.sequence async for change in _take(resumed, 2)] == [2, 3]
+        await storage.untag("object1", ["tag1"])
+        await storage.remove_object("object1")
+        with pytest.raises(ChangesLost):
+            feed.subscribe(after=0, epoch=feed.epoch)
+        with pytest.raises(ChangesLost):
+            feed.subscribe(after=5, epoch="another epoch")
+        assert [change.operation async for change in _take(of_tag1, 2)] == [BulkOperationType.UNTAG,
+                                                                               BulkOperationType.REMOVE_OBJECT]
+
+        # everything fell 3 changes behind, it gets those queued and then it is dropped
+        assert [change.operation async for change in _take(everything, 2)] == [BulkOperationType.REMOVE_TAG,
+                                                                                 BulkOperationType.UNTAG]
+        with pytest.raises(SubscriberTooSlow):
+            await everything.__anext__()
+        assert everything not in feed.subscribers
+        resumed.close()
+        with pytest.raises(StopAsyncIteration):
+            await resumed.__anext__()
+        await storage.close()
+
+
+async def _take(subscription, n):
+    for _ in range(n):
+        yield await subscription.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_instrumentation():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path,
+                                                                         snapshot_mode=SnapshotMode.COPY))
+        instrumentation = RecordingInstrumentation()
+        storage.instrument(instrumentation)
+        await storage.tag("one_object", ["tag1", "tag2"])
+        storage.collect_metrics()
+        assert instrumentation.values['tagapi_tags'] == 2
+        assert instrumentation.values['tagapi_objects'] == 1
+        assert instrumentation.values['tagapi_dirty_age_seconds'] > 0
+        await storage.online_sync()
+        storage.collect_metrics()
+        assert instrumentation.values['tagapi_dirty_age_seconds'] == 0
+        assert instrumentation.values['tagapi_snapshot_bytes'] == os.path.getsize(file_path)
+        assert len(instrumentation.observed['tagapi_lock_wait_seconds', (('mode', 'shared'),)]) == 1
+        assert len(instrumentation.observed['tagapi_lock_hold_seconds', (('mode', 'exclusive'),)]) == 1
+        assert len(instrumentation.observed['tagapi_sync_duration_seconds', (('mode', 'online'),)]) == 1
+        # A batch takes the lock once, exclusively, so no snapshot lands in the middle of it
+        await storage.bulk_apply([BulkOperation(BulkOperationType.TAG, object_name=f"object{i}", tags=["tag1"])
+                                  for i in range(10)] + [BulkOperation(BulkOperationType.REMOVE_TAG, tag_name="tag2")])
+        assert len(instrumentation.observed['tagapi_lock_wait_seconds', (('mode', 'exclusive'),)]) == 2
+        assert len(instrumentation.observed['tagapi_lock_wait_seconds', (('mode', 'shared'),)]) == 1
+        assert await storage.get_tags() == ["tag1"]
+        await storage.close()
@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import os.path
+import tempfile
+
+import pytest
+
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorage, PickledSetTagStorageConfiguration, \
+    SnapshotMode
+from tag_storage.pickle_storage.pickle_storage_group_commit_synchronizer import \
+    PickledSetTagStorageGroupCommitSynchronizer, PickledSetTagStorageGroupCommitSynchronizerConfiguration
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration
+
+
+def counting_flushes(storage: PickledSetTagStorage):
+    flushes = []
+    flush = storage.journal.flush
+
+    async def counted_flush(fsync: bool = False):
+        flushes.append(len(storage.journal.pending))
+        await flush(fsync)
+
+    storage.journal.flush = counted_flush
+    return flushes
+
+
+@pytest.mark.asyncio
+async def test_group_commit():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        synchronizer = PickledSetTagStorageGroupCommitSynchronizer(
+            PickledSetTagStorageGroupCommitSynchronizerConfiguration())
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path, synchronizer=synchronizer))
+        assert storage.journal is not None
+        flushes = counting_flushes(storage)
+        await storage.tag("one_object", ["tag1"])
+        # Durable when it returns: a storage opened from the files has it
+        assert not storage.journal.pending
+        replica = PickledSetTagStorage(PickledSetTagStorageConfiguration(
+            path=file_path, synchronizer=PickledSetTagStorageGroupCommitSynchronizer(
+                PickledSetTagStorageGroupCommitSynchronizerConfiguration())))
+        assert await replica.get_objects() == ["one_object"]
+        await replica.synchronizer.close()
+
+        flushes.clear()
+        await asyncio.gather(*[storage.tag(f"object{i}", ["tag2"]) for i in range(100)])
+        assert len(flushes) < 100 and sum(flushes) == 100
+        await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_adaptive_flush():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        synchronizer = PickledSetTagStorageGroupCommitSynchronizer(
+            PickledSetTagStorageGroupCommitSynchronizerConfiguration(wait=False, max_changes=10,
+                                                                     max_delay=datetime.timedelta(hours=1)))
+        storage = PickledSetTagStorage(PickledSetTagStorageConfiguration(path=file_path, synchronizer=synchronizer))
+        flushes = counting_flushes(storage)
+        for i in range(9):
+            await storage.tag(f"object{i}", ["tag1"])
+        await asyncio.sleep(0.01)
+        assert flushes == [] and len(storage.journal.pending) == 9
+        await storage.tag("object9", ["tag1"])
+        for _ in range(100):
+            if not storage.journal.pending:
+                break
+            await asyncio.sleep(0.01)
+        assert flushes == [10]
+        await storage.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mapped", [False, True])
+async def test_flush_during_snapshot(mapped):
+    # Records flushed while a snapshot is written are not in it, the journal must keep them when it restarts
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        config = PickledSetTagStorageConfiguration(path=file_path, snapshot_mode=SnapshotMode.COPY, mapped=mapped,
+                                                   journal=PickledSetTagStorageJournalConfiguration(
+                                                       checkpoint_bytes=1))
+        storage = PickledSetTagStorage(config)
+        await storage.tag("one_object", ["tag1"])
+        sync = asyncio.get_event_loop().create_task(storage.online_sync())
+        while not storage.journal.since_mark == []:
+            await asyncio.sleep(0)
+        await storage.tag("another_object", ["tag1"])
+        await storage.journal.flush()
+        await sync
+        assert await storage.get_objects() == ["another_object", "one_object"]
+        await storage.close()
+
+        storage = PickledSetTagStorage(config)
+        assert await storage.get_objects() == ["another_object", "one_object"]
+        await storage.close()
@@ -0,0 +1,82 @@
+import importlib.util
+import os.path
+import tempfile
+
+import pytest
+
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+from tag_storage.base_storage.tag_count import TagCount
+from tag_storage.pickle_storage.pickle_storage import PickledSetTagStorageConfiguration
+from tag_storage.pickle_storage.pickle_storage_journal import PickledSetTagStorageJournalConfiguration
+from tag_storage.pickle_storage.pickle_storage_replica import ReadOnlyReplica
+from tag_storage.pickle_storage.pickle_storage_workers import SharedPickledSetTagStorage, \
+    PickledSetTagStorageWorkersConfiguration
+
+pytestmark = pytest.mark.skipif(importlib.util.find_spec("fcntl") is None, reason="Workers need fcntl")
+
+
+def new_worker(file_path, checkpoint_bytes=64 * 1024 * 1024):
+    config = PickledSetTagStorageConfiguration(path=file_path, journal=PickledSetTagStorageJournalConfiguration(
+        checkpoint_bytes=checkpoint_bytes))
+    return SharedPickledSetTagStorage(config, PickledSetTagStorageWorkersConfiguration(owner_timeout=1.0))
+
+
+@pytest.mark.asyncio
+async def test_writes_are_forwarded_to_the_owner():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        owner = new_worker(file_path)
+        replica = new_worker(file_path)
+        assert owner.is_owner and not replica.is_owner
+
+        await replica.tag("one_object", ["tag1", "tag2"])
+        # Visible at once to the owner and to the worker that wrote it
+        assert await owner.get_object_tags("one_object") == ["tag1", "tag2"]
+        assert await replica.get_object_tags("one_object") == ["tag1", "tag2"]
+        results = await replica.bulk_apply([BulkOperation(BulkOperationType.UNTAG, object_name="one_object",
+                                                          tags=["tag2"]),
+                                            BulkOperation(BulkOperationType.TAG, tags=["tag1"])])
+        assert [result.ok for result in results] == [True, False]
+        assert await owner.get_object_tags("one_object") == ["tag1"]
+        with pytest.raises(ReadOnlyReplica):
+            await replica.storage.tag("another_object", ["tag1"])
+        await replica.close()
+        await owner.close()
+
+
+@pytest.mark.asyncio
+async def test_replicas_follow_the_journal_and_snapshots():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        owner = new_worker(file_path, checkpoint_bytes=200)
+        replica = new_worker(file_path)
+        await owner.tag("one_object", ["tag1"])
+        await owner.storage.online_sync()  # flushes the journal
+        await replica.refresh()
+        assert await replica.get_objects() == ["one_object"]
+
+        for i in range(10):
+            await owner.tag(f"object{i}", ["tag2"])
+        await owner.storage.online_sync()  # past checkpoint_bytes, writes a snapshot and restarts the journal
+        await owner.remove_tag("tag1")
+        await owner.storage.online_sync()
+        await replica.refresh()
+        assert await replica.get_tags() == ["tag2"]
+        assert await replica.get_top_tags() == [TagCount("tag2", 10)]
+        await replica.close()
+        await owner.close()
+
+
+@pytest.mark.asyncio
+async def test_a_replica_takes_over():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'test')
+        owner = new_worker(file_path)
+        replica = new_worker(file_path)
+        await replica.tag("one_object", ["tag1"])
+        await owner.close()
+
+        await replica.tag("another_object", ["tag1"])
+        assert replica.is_owner
+        assert await replica.get_tagged_objects("tag1") == ["another_object", "one_object"]
+        await replica.close()
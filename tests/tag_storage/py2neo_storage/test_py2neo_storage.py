@@ -6,6 +6,8 @@ import pytest
 from py2neo import Graph
 
 
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
 from tag_storage.py2neo_storage.py2neo_storage import Py2NeoStorageConfig, Py2NeoStorage
 
 def there_is_a_ongdb():
@@ -84,3 +86,106 @@ class Py2NeoTest(unittest.TestCase):
         self.tag_store.remove_object('fake object')  # must not fail
         self.tag_store.untag("fake object 2", ['fake tag 2']) # must not fail
         self.tag_store.close()
+
+    def test_single_statement_writes(self):
+        graph = self.tag_store.graph
+        run = graph.run
+        statements = []
+
+        def counted_run(*args, **kwargs):
+            statements.append(args[0])
+            return run(*args, **kwargs)
+        graph.run = counted_run
+        self.tag_store.tag("object1", ["tag1", "tag2", "tag3"])
+        self.tag_store.tag("object1", ["tag1", "tag1", "tag2"])
+        self.tag_store.untag("object1", ["tag2", "fake tag"])
+        self.tag_store.untag("fake object", ["tag1"])
+        # One auto-commit statement per write, whatever the number of tags
+        assert len(statements) == 4
+        del graph.run
+        # Tagging again creates no node nor edge
+        assert run("MATCH (o:object {name: $name})-[r:Tagged]->(t:tag) RETURN count(r)", name="object1").evaluate() == 2
+        assert run("MATCH (t:tag) RETURN count(t)").evaluate() == 3
+        assert self.tag_store.get_object_tags("object1") == ["tag1", "tag3"]
+        assert self.tag_store.get_objects() == ["object1"]
+        self.tag_store.close()
+
+    def test_query_objects(self):
+        self.tag_store.tag("object1", ["a", "b"])
+        self.tag_store.tag("object2", ["a", "c"])
+        self.tag_store.tag("object3", ["b"])
+        assert self.tag_store.query_objects(all_tags=["a"]) == ["object1", "object2"]
+        assert self.tag_store.query_objects(all_tags=["a", "b"]) == ["object1"]
+        assert self.tag_store.query_objects(all_tags=["a"], none_tags=["c"]) == ["object1"]
+        assert self.tag_store.query_objects(any_tags=["b", "c"]) == ["object1", "object2", "object3"]
+        assert self.tag_store.query_objects(any_tags=["b", "c"], limit=1, offset=1) == ["object2"]
+        assert self.tag_store.query_objects(none_tags=["a"]) == ["object3"]
+        assert self.tag_store.query_objects(all_tags=["a", "fake tag"]) == []
+        self.tag_store.close()
+
+    def test_keyset_pagination(self):
+        tags = ["tag1", "tag2", "tag3"]
+        self.tag_store.tag("object1", tags)
+        self.tag_store.tag("object2", tags[:1])
+        assert self.tag_store.get_tags(limit=2, after="tag1") == ["tag2", "tag3"]
+        assert self.tag_store.get_tags(offset=1, after="tag1") == ["tag3"]
+        assert self.tag_store.get_objects(after="object1") == ["object2"]
+        assert self.tag_store.get_object_tags("object1", limit=1, after="tag2") == ["tag3"]
+        assert self.tag_store.get_tagged_objects("tag1", after="object1") == ["object2"]
+        assert self.tag_store.query_objects(all_tags=["tag1"], after="object1") == ["object2"]
+        self.tag_store.close()
+
+    def test_get_objects_with_tags(self):
+        self.tag_store.tag("object1", ["tag2", "tag1"])
+        self.tag_store.tag("object2", [])
+        assert self.tag_store.get_objects_with_tags() == [("object1", ["tag1", "tag2"]), ("object2", [])]
+        assert self.tag_store.get_objects_with_tags(limit=1, after="object1") == [("object2", [])]
+        self.tag_store.close()
+
+    def test_counts_and_top_tags(self):
+        self.tag_store.tag("object1", ["tag1", "tag2"])
+        self.tag_store.tag("object2", ["tag1"])
+        self.tag_store.untag("object2", ["tag2"])
+        assert self.tag_store.count_tagged_objects("tag1") == 2
+        assert self.tag_store.count_tagged_objects("fake tag") == 0
+        assert self.tag_store.count_object_tags("object1") == 2
+        assert self.tag_store.get_top_tags(1) == [TagCount("tag1", 2)]
+        self.tag_store.untag("object1", ["tag2"])
+        assert self.tag_store.get_top_tags() == [TagCount("tag1", 2), TagCount("tag2", 0)]
+        self.tag_store.close()
+
+    def test_related_tags(self):
+        self.tag_store.tag("object1", ["tag1", "tag2", "tag3"])
+        self.tag_store.tag("object2", ["tag1", "tag2"])
+        self.tag_store.tag("object3", ["tag1", "tag4"])
+        self.tag_store.tag("object4", ["tag4"])
+        assert self.tag_store.get_related_tags("tag1", k=2) == [RelatedTag("tag2", 2, 2.0), RelatedTag("tag3", 1, 1.0)]
+        assert self.tag_store.get_related_tags("tag1", score=RelatedScore.JACCARD) == \
+               [RelatedTag("tag2", 2, 2 / 3), RelatedTag("tag3", 1, 1 / 3), RelatedTag("tag4", 1, 1 / 4)]
+        self.tag_store.close()
+
+    def test_prefix_and_range(self):
+        for name in ["user:1:a", "user:1:b", "user:12:a", "group:1"]:
+            self.tag_store.tag(name, ["tag:" + name, "common"])
+        assert self.tag_store.get_objects(prefix="user:1:") == ["user:1:a", "user:1:b"]
+        assert self.tag_store.get_objects(prefix="user:", after="user:1:b") == []
+        assert self.tag_store.get_objects(start="user:1:b", end="user:2") == ["user:1:b"]
+        assert self.tag_store.get_tags(prefix="tag:g") == ["tag:group:1"]
+        assert self.tag_store.get_tagged_objects("common", end="user") == ["group:1"]
+        assert self.tag_store.query_objects(all_tags=["common"], prefix="user:12") == ["user:12:a"]
+        self.tag_store.close()
+
+    def test_bulk_apply(self):
+        results = self.tag_store.bulk_apply([
+            BulkOperation(BulkOperationType.TAG, object_name="object1", tags=["tag1", "tag2"]),
+            BulkOperation(BulkOperationType.TAG, object_name="object2", tags=["tag1", "tag3"]),
+            BulkOperation(BulkOperationType.TAG, tags=["tag1"]),
+            BulkOperation(BulkOperationType.UNTAG, object_name="object1", tags=["tag1"]),
+            BulkOperation(BulkOperationType.REMOVE_TAG, tag_name="tag3"),
+            BulkOperation(BulkOperationType.REMOVE_OBJECT, object_name="fake object"),
+        ])
+        assert [result.ok for result in results] == [True, True, False, True, True, True]
+        assert self.tag_store.get_tags() == ["tag1", "tag2"]
+        assert self.tag_store.get_tagged_objects("tag1") == ["object2"]
+        assert self.tag_store.get_object_tags("object1") == ["tag2"]
+        self.tag_store.close()
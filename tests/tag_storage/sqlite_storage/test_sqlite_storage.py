@@ -0,0 +1,174 @@
+import asyncio
+import contextlib
+import os.path
+import sqlite3
+import tempfile
+
+import pytest
+
+from tag_storage.base_storage.bulk_operation import BulkOperation, BulkOperationType
+from tag_storage.base_storage.tag_count import RelatedScore, RelatedTag, TagCount
+from tag_storage.sqlite_storage.sqlite_storage import SqliteStorage, SqliteStorageConfig
+
+
+@contextlib.asynccontextmanager
+async def new_tag_store(path=None):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tag_store = SqliteStorage(SqliteStorageConfig(path=path or os.path.join(temp_dir, 'test.db'), max_workers=4))
+        try:
+            yield tag_store
+        finally:
+            await tag_store.close()
+
+
+@pytest.mark.asyncio
+async def test_create_one():
+    async with new_tag_store() as tag_store:
+        assert await tag_store.get_tags() == []
+        assert await tag_store.get_objects() == []
+        with sqlite3.connect(tag_store.config.path) as connection:
+            assert connection.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+
+@pytest.mark.asyncio
+async def test_add_objects():
+    async with new_tag_store() as tag_store:
+        tags = ["tag1", "tag2"]
+        one_object = "one_object"
+        await tag_store.tag(one_object, tags)
+        assert await tag_store.get_object_tags(one_object) == tags
+        assert await tag_store.get_object_tags(one_object, limit=1) == [tags[0]]
+        assert await tag_store.get_object_tags(one_object, limit=1, offset=1) == [tags[1]]
+        assert await tag_store.get_objects() == [one_object]
+        assert await tag_store.get_tags() == tags
+        assert await tag_store.get_tagged_objects(tags[0]) == [one_object]
+        another_object = "another_object"
+        await tag_store.tag(another_object, [tags[0]])
+        await tag_store.tag(another_object, [tags[0]])
+        assert await tag_store.get_objects() == [another_object, one_object]
+        assert await tag_store.get_tagged_objects(tags[0]) == [another_object, one_object]
+        assert await tag_store.get_tagged_objects(tags[0], after=another_object) == [one_object]
+        assert await tag_store.get_tagged_objects(tags[1]) == [one_object]
+
+
+@pytest.mark.asyncio
+async def test_tag_and_untag():
+    async with new_tag_store() as tag_store:
+        tags = ["tag1", "tag2"]
+        one_object = "one_object"
+        await tag_store.tag(one_object, tags)
+        await tag_store.untag(one_object, [tags[1]])
+        assert await tag_store.get_object_tags(one_object) == [tags[0]]
+        assert await tag_store.get_tags() == tags  # Tags are not removed
+        assert await tag_store.get_tagged_objects(tags[1]) == []
+        await tag_store.remove_tag(tags[0])
+        assert await tag_store.get_tags() == [tags[1]]
+        assert await tag_store.get_object_tags(one_object) == []
+        await tag_store.remove_object(one_object)
+        assert await tag_store.get_objects() == []
+
+        await tag_store.remove_tag('fake tag')  # must not fail
+        await tag_store.remove_object('fake object')  # must not fail
+        await tag_store.untag("fake object 2", ['fake tag 2'])  # must not fail
+
+
+@pytest.mark.asyncio
+async def test_reopen():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'test.db')
+        async with new_tag_store(path) as tag_store:
+            await tag_store.tag("object1", ["tag1", "tag2"])
+            await tag_store.untag("object1", ["tag2"])
+        async with new_tag_store(path) as tag_store:
+            assert await tag_store.get_object_tags("object1") == ["tag1"]
+            assert await tag_store.get_top_tags() == [TagCount("tag1", 1), TagCount("tag2", 0)]
+
+
+@pytest.mark.asyncio
+async def test_query_and_bulk():
+    async with new_tag_store() as tag_store:
+        results = await tag_store.bulk_apply([
+            BulkOperation(BulkOperationType.TAG, object_name="object1", tags=["a", "b"]),
+            BulkOperation(BulkOperationType.TAG, object_name="object2", tags=["a", "c"]),
+            BulkOperation(BulkOperationType.TAG, tags=["a"]),
+            BulkOperation(BulkOperationType.TAG, object_name="object3", tags=["b"]),
+            BulkOperation(BulkOperationType.UNTAG, object_name="object3", tags=["b"]),
+            BulkOperation(BulkOperationType.TAG, object_name="object3", tags=["b"]),
+        ])
+        assert [result.ok for result in results] == [True, True, False, True, True, True]
+        assert await tag_store.query_objects(all_tags=["a"], none_tags=["c"]) == ["object1"]
+        assert await tag_store.query_objects(all_tags=["a", "b"]) == ["object1"]
+        assert await tag_store.query_objects(all_tags=["a", "fake tag"]) == []
+        assert await tag_store.query_objects(all_tags=["a"], any_tags=["b", "c"], limit=1, offset=1) == ["object2"]
+        assert await tag_store.query_objects(any_tags=["b", "c"]) == ["object1", "object2", "object3"]
+        assert await tag_store.query_objects(any_tags=["b", "c"], after="object1") == ["object2", "object3"]
+        assert await tag_store.query_objects(none_tags=["a"]) == ["object3"]
+
+
+@pytest.mark.asyncio
+async def test_get_objects_with_tags():
+    async with new_tag_store() as tag_store:
+        await tag_store.tag("object1", ["tag2", "tag1"])
+        await tag_store.tag("object2", [])
+        assert await tag_store.get_objects_with_tags() == [("object1", ["tag1", "tag2"]), ("object2", [])]
+        assert await tag_store.get_objects_with_tags(limit=1, after="object1") == [("object2", [])]
+
+
+@pytest.mark.asyncio
+async def test_get_many():
+    async with new_tag_store() as tag_store:
+        await tag_store.tag("object1", ["tag2", "tag1", "tag3"])
+        await tag_store.tag("object2", ["tag1"])
+        assert await tag_store.get_many_object_tags(["object2", "object1", "fake object"], limit=2) == \
+               {"object2": ["tag1"], "object1": ["tag1", "tag2"], "fake object": []}
+        assert await tag_store.get_many_tagged_objects(["tag1", "tag1", "fake tag"]) == \
+               {"tag1": ["object1", "object2"], "fake tag": []}
+
+
+@pytest.mark.asyncio
+async def test_counts_and_top_tags():
+    async with new_tag_store() as tag_store:
+        await tag_store.tag("object1", ["tag1", "tag2"])
+        await tag_store.tag("object2", ["tag1", "tag3"])
+        assert await tag_store.count_tagged_objects("tag1") == 2
+        assert await tag_store.count_tagged_objects("fake tag") == 0
+        assert await tag_store.count_object_tags("object1") == 2
+        await tag_store.untag("object1", ["tag2"])
+        await tag_store.remove_object("object2")
+        await tag_store.tag("object3", ["tag3"])
+        assert await tag_store.get_top_tags() == [TagCount("tag1", 1), TagCount("tag3", 1), TagCount("tag2", 0)]
+        await tag_store.remove_tag("tag1")
+        assert await tag_store.get_top_tags(k=1) == [TagCount("tag3", 1)]
+
+
+@pytest.mark.asyncio
+async def test_related_tags():
+    async with new_tag_store() as tag_store:
+        await tag_store.tag("object1", ["tag1", "tag2", "tag3"])
+        await tag_store.tag("object2", ["tag1", "tag2"])
+        await tag_store.tag("object3", ["tag1", "tag4"])
+        await tag_store.tag("object4", ["tag4"])
+        assert await tag_store.get_related_tags("tag1", k=2) == [RelatedTag("tag2", 2, 2.0), RelatedTag("tag3", 1, 1.0)]
+        assert await tag_store.get_related_tags("tag1", score=RelatedScore.JACCARD) == \
+               [RelatedTag("tag2", 2, 2 / 3), RelatedTag("tag3", 1, 1 / 3), RelatedTag("tag4", 1, 1 / 4)]
+        assert await tag_store.get_related_tags("fake tag") == []
+
+
+@pytest.mark.asyncio
+async def test_prefix_and_range():
+    async with new_tag_store() as tag_store:
+        for name in ["user:1:a", "user:1:b", "user:12:a", "group:1", "user:1\U0010ffff"]:
+            await tag_store.tag(name, ["tag:" + name, "common"])
+        assert await tag_store.get_objects(prefix="user:1:") == ["user:1:a", "user:1:b"]
+        assert await tag_store.get_objects(prefix="user:1\U0010ffff") == ["user:1\U0010ffff"]
+        assert await tag_store.get_objects(start="user:1:b", end="user:2") == ["user:1:b", "user:1\U0010ffff"]
+        assert await tag_store.get_object_tags("group:1", prefix="tag") == ["tag:group:1"]
+        assert await tag_store.query_objects(any_tags=["common"], prefix="user:12") == ["user:12:a"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writes():
+    async with new_tag_store() as tag_store:
+        await asyncio.gather(*(tag_store.tag("object%03d" % i, ["tag%d" % (i % 3), "common"]) for i in range(100)))
+        assert await tag_store.count_tagged_objects("common") == 100
+        assert len(await tag_store.get_objects(limit=1000)) == 100